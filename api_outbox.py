@@ -0,0 +1,163 @@
+import json
+import logging
+import sqlite3
+from threading import Thread, Lock, Event
+from typing import Callable
+
+
+class ApiOutbox:
+    """
+    Durable store and forward outbox for the API telemetry, backed by SQLite
+
+    update_api appends its datums here, the ApiOutboxSender drains them to the API, so relay state
+    history survives network blips (and restarts). The outbox keeps at most max_rows datums,
+    when it is full the oldest datums are dropped to bound the disk usage.
+    """
+
+    def __init__(self, outbox_file: str, max_rows: int = 100000):
+        self.logger = logging.getLogger(__name__)
+
+        self._lock = Lock()
+        self._max_rows = max_rows
+        self._n_dropped = 0
+
+        self._connection = sqlite3.connect(outbox_file, check_same_thread=False)
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                     "datum TEXT NOT NULL)")
+            self._connection.commit()
+            self._depth = self._connection.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+        # set whenever datums are appended, the sender waits on it
+        self.has_data = Event()
+        if self._depth > 0:
+            self.has_data.set()
+
+    def append(self, batch: list[dict]):
+        """
+        Append a batch of datums
+        :param batch:
+        :return:
+        """
+        if len(batch) == 0:
+            return
+
+        with self._lock:
+            self._connection.executemany("INSERT INTO outbox (datum) VALUES (?)",
+                                         [(json.dumps(datum),) for datum in batch])
+            self._depth += len(batch)
+
+            n_over = self._depth - self._max_rows
+            if n_over > 0:
+                self._connection.execute("DELETE FROM outbox WHERE id IN "
+                                         "(SELECT id FROM outbox ORDER BY id LIMIT ?)", (n_over,))
+                self._depth -= n_over
+                self._n_dropped += n_over
+                self.logger.warning("API outbox is full, dropped the {} oldest datums".format(n_over))
+
+            self._connection.commit()
+
+        self.has_data.set()
+
+    def peek(self, limit: int) -> tuple[int, list[dict]]:
+        """
+        The oldest datums in the outbox
+        :param limit:
+        :return: (id of the last datum returned, datums)
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT id, datum FROM outbox ORDER BY id LIMIT ?", (limit,)).fetchall()
+
+        if len(rows) == 0:
+            return -1, list()
+        return rows[-1][0], [json.loads(datum) for _, datum in rows]
+
+    def remove_through(self, last_id: int):
+        """
+        Remove the datums up to and including last_id, once they have been sent
+        :param last_id:
+        :return:
+        """
+        with self._lock:
+            n_removed = self._connection.execute("DELETE FROM outbox WHERE id <= ?", (last_id,)).rowcount
+            self._connection.commit()
+            self._depth -= n_removed
+            if self._depth == 0:
+                self.has_data.clear()
+
+    def get_depth(self) -> int:
+        """
+        The backlog depth (number of datums waiting to be sent)
+        :return:
+        """
+        return self._depth
+
+    def get_n_dropped(self) -> int:
+        return self._n_dropped
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class ApiOutboxSender(Thread):
+    """
+    Drains the outbox to the API in batches of up to max_batch_size datums, so a backlog built up
+    during an outage goes out in a few large requests. A failed send backs off exponentially from
+    retry_min_ms up to retry_max_ms before the next attempt.
+    """
+
+    def __init__(self, outbox: ApiOutbox, send_batch: Callable[[list[dict]], bool],
+                 max_batch_size: int = 500, retry_min_ms: int = 1000, retry_max_ms: int = 300000):
+
+        super(ApiOutboxSender, self).__init__()
+
+        # a request hanging on the API must not keep the daemon from exiting, the outbox keeps the datums
+        self.daemon = True
+
+        self.logger = logging.getLogger(__name__)
+
+        self._outbox = outbox
+        self._send_batch = send_batch
+        self._max_batch_size = max_batch_size
+        self._retry_min_ms = retry_min_ms
+        self._retry_max_ms = retry_max_ms
+        self._stop_event = Event()
+
+        self.n_sent = 0
+        self.n_failed_sends = 0
+
+    def stop(self):
+        self._stop_event.set()
+        self._outbox.has_data.set()
+
+    def run(self):
+        retry_ms = 0
+
+        while not self._stop_event.is_set():
+            if retry_ms > 0:
+                # back off, but still wake up promptly on stop
+                self._stop_event.wait(retry_ms / 1000.0)
+            else:
+                self._outbox.has_data.wait()
+
+            if self._stop_event.is_set():
+                break
+
+            last_id, batch = self._outbox.peek(self._max_batch_size)
+            if len(batch) == 0:
+                continue
+
+            if self._send_batch(batch) is True:
+                self._outbox.remove_through(last_id)
+                self.n_sent += len(batch)
+                retry_ms = 0
+            else:
+                self.n_failed_sends += 1
+                retry_ms = min(self._retry_max_ms, max(self._retry_min_ms, retry_ms * 2))
+                self.logger.warning("Sending {} datums to the API failed, {} in the outbox, retrying in {} ms".format(
+                    len(batch), self._outbox.get_depth(), retry_ms))
+
+        self.logger.info("API outbox sender stopped, {} datums left in the outbox".format(self._outbox.get_depth()))
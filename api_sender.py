@@ -0,0 +1,100 @@
+import logging
+import queue
+from threading import Thread
+from typing import Callable
+
+from api_outbox import ApiOutbox
+
+
+class ApiSender(Thread):
+    """
+    Takes the API telemetry off the controller thread
+
+    The controller submits batches into a bounded queue and never waits: when the queue is full
+    (the API is hanging and the sender is stuck in a request) the oldest queued batch is dropped.
+    The sender thread either sends the batches itself or, when there is an outbox, appends them to
+    the outbox and leaves the network to the ApiOutboxSender.
+    """
+
+    def __init__(self, send_batch: Callable[[list[dict]], bool], outbox: ApiOutbox = None, queue_size: int = 16):
+
+        super(ApiSender, self).__init__()
+
+        # a request hanging on the API must not keep the daemon from exiting
+        self.daemon = True
+
+        self.logger = logging.getLogger(__name__)
+
+        self._send_batch = send_batch
+        self._outbox = outbox
+        self._queue = queue.Queue(maxsize=queue_size)
+
+        self.n_submitted = 0
+        self.n_dropped = 0
+        self.n_sent = 0
+        self.n_failed = 0
+
+    def submit(self, batch: list[dict]):
+        """
+        Queue a batch without blocking, dropping the oldest queued batch if the queue is full
+        :param batch:
+        :return:
+        """
+        self.n_submitted += 1
+        while True:
+            try:
+                self._queue.put_nowait(batch)
+                return
+            except queue.Full:
+                pass
+
+            try:
+                self._queue.get_nowait()
+                self.n_dropped += 1
+                self.logger.warning("API send queue is full, dropped the oldest batch")
+            except queue.Empty:
+                pass
+
+    def get_queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def get_stats(self) -> dict:
+        return {
+            "submitted": self.n_submitted,
+            "dropped": self.n_dropped,
+            "sent": self.n_sent,
+            "failed": self.n_failed,
+            "queued": self.get_queue_depth()
+        }
+
+    def stop(self):
+        # None tells the worker to stop once the batches ahead of it are handled
+        while True:
+            try:
+                self._queue.put_nowait(None)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self.n_dropped += 1
+                except queue.Empty:
+                    pass
+
+    def run(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                break
+
+            if self._outbox is not None:
+                self._outbox.append(batch)
+                self.n_sent += len(batch)
+                continue
+
+            self.logger.info("Sending batch len {} to API:".format(len(batch)))
+            if self._send_batch(batch) is True:
+                self.n_sent += len(batch)
+            else:
+                self.n_failed += 1
+
+        self.logger.info("API sender stopped, stats:{}".format(self.get_stats()))
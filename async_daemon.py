@@ -0,0 +1,456 @@
+"""
+asyncio runtime for the relay controller (runtime = asyncio in config.cfg)
+
+The cache fetch, the control logic, the relay writes and the API uploads all run as tasks on one event loop
+instead of as threads that sleep and poll. Every task sleeps until its next deadline or until it is woken,
+so SIGINT / SIGTERM stop the daemon right away and an idle daemon does no work between deadlines.
+
+RedisMonitor and BangBangController are reused for their fetch, deduplication and control logic, the
+tasks here only drive them:
+
+- the cache is read with the redis.asyncio client, fetched messages go straight to the controller
+- the relay board and the Aretas API client are blocking libraries, the relay writes and the uploads
+  are awaited on worker threads so they never block the loop
+"""
+import asyncio
+import collections
+import configparser
+import logging
+import signal
+import threading
+import time
+from typing import Callable
+
+import redis.asyncio
+
+from WaveshareRelayControl.relaycontrolmain import WaveshareRelayController
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+from api_outbox import ApiOutbox
+from bang_bang_controller import BangBangController
+from control_def_watcher import ControlDefWatcher
+from control_defs import ControlDef
+from redis_monitor import RedisMonitor
+from relay_boards import build_relay_boards
+from relay_command_dispatcher import RelayCommandQueue
+from sensor_message_item import SensorMessageItem
+
+
+async def run_in_daemon_thread(func: Callable, *args):
+    """
+    Await a blocking call on its own daemon thread, unlike asyncio.to_thread a call that hangs
+    (a stuck HTTP request) can't hold up the interpreter exit
+    :param func:
+    :param args:
+    :return: the result of func
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def set_result(result, exception):
+        if future.cancelled():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def run():
+        try:
+            result = func(*args)
+        except Exception as e:
+            loop.call_soon_threadsafe(set_result, None, e)
+            return
+        loop.call_soon_threadsafe(set_result, result, None)
+
+    threading.Thread(target=run, daemon=True).start()
+    return await future
+
+
+class AsyncRelayWriter:
+    """
+    The event loop counterpart of RelayCommandDispatcher: the controller's set_channel_on / set_channel_off
+    return right away and the writes are awaited one at a time on a worker thread.
+    Commands for the same channel within coalesce_window_ms collapse into the last one, and the same
+    RelayCommandQueue as the dispatcher's skips the writes of channels already in their target state and
+    retries the failed ones.
+    """
+
+    def __init__(self, relay_controller: WaveshareRelayController, coalesce_window_ms: float = 50.0,
+                 retry_min_ms: int = 100, retry_max_ms: int = 10000):
+        self.logger = logging.getLogger(__name__)
+
+        self._relay_controller = relay_controller
+        self._coalesce_window_ms = coalesce_window_ms
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+
+        # only touched from the loop
+        self._commands = RelayCommandQueue(relay_controller.get_channel_states(), retry_min_ms, retry_max_ms)
+
+    def set_channel_on(self, channel: WaveshareDef):
+        self.submit(channel, 1)
+
+    def set_channel_off(self, channel: WaveshareDef):
+        self.submit(channel, 0)
+
+    def set_default_states(self):
+        self._relay_controller.set_default_states()
+
+    def submit(self, channel: WaveshareDef, state: int):
+        self._commands.submit(channel, state)
+        self._wakeup.set()
+
+    def get_channel_states(self) -> dict[WaveshareDef, int | None]:
+        """
+        The channel states, including the commands that have been submitted but not written yet
+        :return:
+        """
+        return self._commands.get_channel_states()
+
+    def get_stats(self) -> dict:
+        return self._commands.stats.as_dict()
+
+    def stop(self):
+        """
+        Stop the writer once the pending commands are written
+        :return:
+        """
+        self._stopping = True
+        self._wakeup.set()
+
+    async def write_channel(self, channel: WaveshareDef, state: int, submit_time: float):
+        if self._commands.skip_write(channel, state) is True:
+            return
+
+        try:
+            if state == 1:
+                await asyncio.to_thread(self._relay_controller.set_channel_on, channel)
+            else:
+                await asyncio.to_thread(self._relay_controller.set_channel_off, channel)
+
+        except Exception as e:
+            self.logger.error("Error writing relay command {} to channel {}:{}".format(state, channel, e))
+            self._commands.record_failure(channel, state, submit_time)
+            return
+
+        self._commands.record_write(channel, state, submit_time)
+
+    async def run(self):
+        while True:
+            next_retry_s = self._commands.get_next_retry_s()
+            if next_retry_s is None:
+                await self._wakeup.wait()
+            elif next_retry_s > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=next_retry_s)
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+
+            if (self._commands.has_pending() is True) and (self._stopping is False) and \
+                    (self._coalesce_window_ms > 0):
+                await asyncio.sleep(self._coalesce_window_ms / 1000.0)
+
+            pending = self._commands.take_pending()
+            for channel, (state, submit_time) in pending.items():
+                await self.write_channel(channel, state, submit_time)
+
+            if (self._stopping is True) and (self._commands.has_pending() is False):
+                failed_commands = self._commands.get_failed_commands()
+                if len(failed_commands) > 0:
+                    self.logger.error("Async relay writer stopping with failed commands not written:{}".format(
+                        failed_commands))
+                break
+
+        self.logger.info("Async relay writer stopped, stats:{}".format(self.get_stats()))
+
+
+class AsyncApiSender:
+    """
+    The event loop counterpart of ApiSender: submit never waits, a full queue drops the oldest batch, and the
+    batches are sent (or appended to the outbox) one at a time off the loop
+    """
+
+    def __init__(self, send_batch: Callable[[list[dict]], bool], outbox: ApiOutbox = None, queue_size: int = 16):
+        self.logger = logging.getLogger(__name__)
+
+        self._send_batch = send_batch
+        self._outbox = outbox
+        self._queue = collections.deque()
+        self._queue_size = queue_size
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+
+        self.n_submitted = 0
+        self.n_dropped = 0
+        self.n_sent = 0
+        self.n_failed = 0
+
+    def submit(self, batch: list[dict]):
+        self.n_submitted += 1
+        if len(self._queue) >= self._queue_size:
+            self._queue.popleft()
+            self.n_dropped += 1
+            self.logger.warning("API send queue is full, dropped the oldest batch")
+        self._queue.append(batch)
+        self._wakeup.set()
+
+    def get_queue_depth(self) -> int:
+        return len(self._queue)
+
+    def get_stats(self) -> dict:
+        return {
+            "submitted": self.n_submitted,
+            "dropped": self.n_dropped,
+            "sent": self.n_sent,
+            "failed": self.n_failed,
+            "queued": self.get_queue_depth()
+        }
+
+    def stop(self):
+        """
+        Stop once the queued batches are handled
+        :return:
+        """
+        self._stopping = True
+        self._wakeup.set()
+
+    async def run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            while len(self._queue) > 0:
+                batch = self._queue.popleft()
+                if self._outbox is not None:
+                    await asyncio.to_thread(self._outbox.append, batch)
+                    self.n_sent += len(batch)
+                    continue
+
+                self.logger.info("Sending batch len {} to API:".format(len(batch)))
+                if await run_in_daemon_thread(self._send_batch, batch) is True:
+                    self.n_sent += len(batch)
+                else:
+                    self.n_failed += 1
+
+            if self._stopping is True:
+                break
+
+        self.logger.info("Async API sender stopped, stats:{}".format(self.get_stats()))
+
+
+class AsyncDaemon:
+    """
+    Runs the cache fetch, the controller deadlines, the relay writer and the API sender as tasks on one loop
+    """
+
+    def __init__(self, redis_client=None,
+                 relay_controller: WaveshareRelayController = None,
+                 control_defs: list[ControlDef] = None,
+                 api_writer=None,
+                 control_def_watcher: ControlDefWatcher = None,
+                 relay_boards: dict[str, WaveshareRelayController] = None):
+
+        self.logger = logging.getLogger(__name__)
+
+        # read in the global app config
+        config = configparser.ConfigParser()
+        config.read('config.cfg')
+
+        if (control_defs is None) and (control_def_watcher is None):
+            control_def_watcher = ControlDefWatcher(config.get("DEFAULT", "control_defs_file",
+                                                               fallback="control_defs.json"))
+        self.control_def_watcher = control_def_watcher
+
+        if redis_client is None:
+            redis_client = redis.asyncio.StrictRedis(config.get("REDIS", "redis_host", fallback="localhost"),
+                                                     config.getint("REDIS", "redis_port", fallback=6379),
+                                                     db=config.getint("REDIS", "redis_db", fallback=0),
+                                                     password=config.get("REDIS", "redis_authpw", fallback="FooBaz"),
+                                                     decode_responses=True)
+        self.redis_client = redis_client
+
+        # the threads' sig_event is never set, the loop has its own stop event
+        self.stop_event = asyncio.Event()
+        self.controller_wakeup = asyncio.Event()
+        unused_sig_event = threading.Event()
+
+        self.redis_monitor = RedisMonitor(None, unused_sig_event, redis_client=redis_client,
+                                          control_defs=control_defs, control_def_watcher=control_def_watcher)
+
+        if relay_controller is None:
+            serial_port = config.get("RELAY_CONTROLLER", "serial_port", fallback="/dev/ttyUSB0")
+            default_states_str = config.get("RELAY_CONTROLLER", "default_relay_states", fallback=None)
+            relay_controller = WaveshareRelayController(
+                serial_port, default_states=WaveshareRelayController.parse_default_states(default_states_str))
+        self.relay_writer = AsyncDaemon.make_relay_writer(relay_controller, config)
+        # one writer per additional board, each awaits its own writes so the boards are written in parallel
+        if relay_boards is None:
+            relay_boards = build_relay_boards(config)
+        self.relay_board_writers = {board_id: AsyncDaemon.make_relay_writer(relay_board, config)
+                                    for board_id, relay_board in relay_boards.items()}
+
+        api_send_queue_size = config.getint('DEFAULT', 'api_send_queue_size', fallback=16)
+
+        def make_api_sender(send_batch: Callable[[list[dict]], bool], outbox: ApiOutbox | None) -> AsyncApiSender:
+            return AsyncApiSender(send_batch, outbox, queue_size=api_send_queue_size)
+
+        # the relay writers already take the writes off the loop, the controller writes to them inline
+        self.controller = BangBangController(None, unused_sig_event, relay_controller=self.relay_writer,
+                                             control_defs=control_defs, api_writer=api_writer,
+                                             control_def_watcher=control_def_watcher,
+                                             relay_boards=self.relay_board_writers,
+                                             inline_relay_commands=True,
+                                             api_sender_factory=make_api_sender)
+        self.api_sender = self.controller.api_sender
+        self.api_sender_stop_timeout_s = 5.0
+
+    @staticmethod
+    def make_relay_writer(relay_controller: WaveshareRelayController,
+                          config: configparser.ConfigParser) -> AsyncRelayWriter:
+        return AsyncRelayWriter(
+            relay_controller,
+            config.getfloat("RELAY_CONTROLLER", "relay_command_coalesce_window_ms", fallback=50),
+            retry_min_ms=config.getint("RELAY_CONTROLLER", "relay_retry_min_ms", fallback=100),
+            retry_max_ms=config.getint("RELAY_CONTROLLER", "relay_retry_max_ms", fallback=10000))
+
+    def stop(self):
+        self.stop_event.set()
+        self.controller_wakeup.set()
+
+    async def wait_for_stop(self, timeout_s: float) -> bool:
+        """
+        :param timeout_s:
+        :return: True if the daemon is stopping
+        """
+        try:
+            await asyncio.wait_for(self.stop_event.wait(), timeout=max(0.0, timeout_s))
+        except asyncio.TimeoutError:
+            pass
+        return self.stop_event.is_set()
+
+    async def fetch_redis_messages(self, macs: list[int] = None):
+        """
+        RedisMonitor.fetch_redis_messages over the async client, every chunk is one pipelined round trip
+        :param macs:
+        :return:
+        """
+        redis_monitor = self.redis_monitor
+        start = time.perf_counter()
+        if macs is None:
+            macs = list(redis_monitor.observables.keys())
+
+        sensor_messages = list()
+        for chunk_macs in redis_monitor.get_fetch_chunks(macs):
+            pipe = self.redis_client.pipeline(transaction=False)
+            redis_monitor.queue_fetch_commands(pipe, chunk_macs)
+
+            try:
+                chunk_results = await pipe.execute(raise_on_error=False)
+            except Exception as e:
+                # a connection error loses the whole chunk, the next cycle will pick it up again
+                self.logger.error("Error fetching sensor message chunk of {} macs:{}".format(len(chunk_macs), e))
+                continue
+
+            redis_monitor.decode_chunk_results(chunk_macs, chunk_results, sensor_messages)
+
+        redis_monitor.record_fetch_latency(start, len(sensor_messages), len(macs))
+        redis_monitor.deduplicate_sensor_messages(sensor_messages)
+
+    def process_messages(self, sensor_messages: list[SensorMessageItem]):
+        if len(sensor_messages) == 0:
+            return
+        self.controller.process_messages(sensor_messages)
+        # the messages may have created triggers that expire before the deadline the controller task sleeps on
+        self.controller_wakeup.set()
+
+    async def run_fetch(self):
+        """
+        Fetch the cache every cache_fetch_interval_ms, on a fixed schedule rather than sleeping a fixed
+        time after each fetch
+        :return:
+        """
+        interval_s = self.redis_monitor.cache_fetch_interval_ms / 1000.0
+        loop = asyncio.get_running_loop()
+        next_fetch = loop.time()
+
+        while not self.stop_event.is_set():
+            self.redis_monitor.reload_control_defs()
+            await self.fetch_redis_messages()
+            self.process_messages(self.redis_monitor.take_unsent_messages())
+
+            next_fetch = max(next_fetch + interval_s, loop.time())
+            await self.wait_for_stop(next_fetch - loop.time())
+
+    async def run_controller(self):
+        """
+        Sleep until the controller's next deadline (or a wakeup) and run the timed work that is due
+        :return:
+        """
+        while not self.stop_event.is_set():
+            now = int(time.time() * 1000)
+            wait_s = max(0, self.controller.get_next_deadline_ms() - now) / 1000.0
+            try:
+                await asyncio.wait_for(self.controller_wakeup.wait(), timeout=wait_s)
+            except asyncio.TimeoutError:
+                pass
+            self.controller_wakeup.clear()
+
+            if self.stop_event.is_set():
+                break
+            self.controller.run_due_deadlines()
+
+    def add_signal_handlers(self):
+        loop = asyncio.get_running_loop()
+        for sig_name in ["SIGINT", "SIGTERM"]:
+            if hasattr(signal, sig_name):
+                try:
+                    loop.add_signal_handler(getattr(signal, sig_name), self.stop)
+                except (NotImplementedError, RuntimeError):
+                    # no loop signal handlers on Windows or off the main thread
+                    pass
+
+        if hasattr(signal, "SIGHUP") and (self.control_def_watcher is not None):
+            try:
+                loop.add_signal_handler(signal.SIGHUP, self.control_def_watcher.request_reload)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+    async def run(self):
+        self.add_signal_handlers()
+
+        if self.controller.api_outbox_sender is not None:
+            self.controller.api_outbox_sender.start()
+
+        relay_writers = [self.relay_writer] + list(self.relay_board_writers.values())
+        relay_writer_tasks = [asyncio.create_task(relay_writer.run()) for relay_writer in relay_writers]
+        api_sender_task = asyncio.create_task(self.api_sender.run())
+        fetch_task = asyncio.create_task(self.run_fetch())
+        controller_task = asyncio.create_task(self.run_controller())
+        self.logger.info("Async runtime started")
+
+        await asyncio.gather(fetch_task, controller_task)
+
+        # write the relay commands that are still pending, the API sender may be stuck in a hanging request
+        for relay_writer in relay_writers:
+            relay_writer.stop()
+        await asyncio.gather(*relay_writer_tasks)
+        self.api_sender.stop()
+        try:
+            await asyncio.wait_for(api_sender_task, timeout=self.api_sender_stop_timeout_s)
+        except asyncio.TimeoutError:
+            self.logger.warning("API sender did not stop within {} s".format(self.api_sender_stop_timeout_s))
+
+        outbox_sender = self.controller.api_outbox_sender
+        if outbox_sender is not None:
+            outbox_sender.stop()
+            outbox_sender.join(timeout=self.api_sender_stop_timeout_s)
+            if (not outbox_sender.is_alive()) and api_sender_task.done():
+                self.controller.api_outbox.close()
+
+        await self.redis_client.aclose()
+        print("Exiting {}".format(self.__class__.__name__))
+
+
+def run_async():
+    asyncio.run(AsyncDaemon().run())
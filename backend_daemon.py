@@ -12,10 +12,15 @@ from threading import Event
 from queue import Queue
 import configparser
 import logging
+import multiprocessing
 from logging.handlers import RotatingFileHandler
 
 from bang_bang_controller import BangBangController
+from control_def_watcher import ControlDefWatcher
+from async_daemon import run_async
+from metrics import start_metrics_server
 from redis_monitor import RedisMonitor
+from sharded_daemon import run_sharded
 
 # An example of using logging.basicConfig rather than logging.fileHandler()
 logging.basicConfig(level=logging.INFO,
@@ -33,8 +38,20 @@ if __name__ == "__main__":
     config = configparser.ConfigParser()
     config.read('config.cfg')
 
-    # this is a shared event handler among all the threads
-    thread_sig_event = Event()
+    # "asyncio" runs everything as tasks on one event loop (see async_daemon), "threads" is the threaded runtime
+    if config.get("DEFAULT", "runtime", fallback="threads") == "asyncio":
+        start_metrics_server(config)
+        run_async()
+        raise SystemExit(0)
+
+    # with n_shards > 1 the observed macs are split across worker processes (see sharded_daemon)
+    n_shards = config.getint("DEFAULT", "n_shards", fallback=1)
+
+    # this is a shared event handler among all the threads (and shard processes)
+    if n_shards > 1:
+        thread_sig_event = multiprocessing.Event()
+    else:
+        thread_sig_event = Event()
 
 
     def signal_handler(sig, frame):
@@ -45,16 +62,35 @@ if __name__ == "__main__":
     # define the signal handler for SIGINT
     signal.signal(signal.SIGINT, signal_handler)
 
+    if n_shards > 1:
+        run_sharded(config, n_shards, thread_sig_event)
+        raise SystemExit(0)
+
+    # Prometheus text format metrics on metrics_port (see metrics.py)
+    start_metrics_server(config)
+
+    # the control defs are shared by both threads and reloaded when the file changes or on SIGHUP
+    control_def_watcher = ControlDefWatcher(config.get("DEFAULT", "control_defs_file"))
+
+
+    def reload_signal_handler(sig, frame):
+        control_def_watcher.request_reload()
+
+
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, reload_signal_handler)
+
     # this is the shared message queue for the redis message harvester and the controller
     mq_payload_queue: Queue = Queue()
 
     logger.info("Redis Cache Monitor thread starting:")
-    redis_monitor_thread = RedisMonitor(mq_payload_queue, thread_sig_event)
+    redis_monitor_thread = RedisMonitor(mq_payload_queue, thread_sig_event, control_def_watcher=control_def_watcher)
     redis_monitor_thread.start()
     logger.info("Redis Cache Monitor thread started.")
 
     logger.info("BangBang Controller thread starting:")
-    bang_bang_controller = BangBangController(mq_payload_queue,thread_sig_event)
+    bang_bang_controller = BangBangController(mq_payload_queue, thread_sig_event,
+                                              control_def_watcher=control_def_watcher)
     bang_bang_controller.start()
     logger.info("BangBang Controller thread started.")
 
@@ -63,4 +99,4 @@ if __name__ == "__main__":
     # thread_sig_event.set()
 
     redis_monitor_thread.join()
-    redis_monitor_thread.join()
+    bang_bang_controller.join()
@@ -1,68 +1,51 @@
 import configparser
 import logging
+import queue
 import time
 from multiprocessing import Queue, Event
 from threading import Thread
+from typing import Callable
 
 import requests
 import urllib3
 
+import metrics
 from AretasPythonAPI.api_config import APIConfig
 from AretasPythonAPI.auth import APIAuth
 from AretasPythonAPI.sensor_data_ingest import SensorDataIngest
+from api_outbox import ApiOutbox, ApiOutboxSender
+from api_sender import ApiSender
 from WaveshareRelayControl.relaycontrolmain import WaveshareRelayController
-from control_defs import ControlDefUtils, ControlDef, ThresholdType, ControlFunc
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+from control_def_watcher import ControlDefWatcher
+from control_defs import AggregateFunc, ControlDef, ThresholdType, ControlFunc, ControlDefIndex, ControlDefUtils, \
+    ControlRule, DEFAULT_BOARD_ID
+from control_rules import ControlRuleEngine
+from control_state_journal import ControlStateJournal
+from control_trigger_store import ControlTrigger, ControlTriggerStore
+from deadline_scheduler import DeadlineScheduler
+from relay_boards import build_relay_boards, get_relay_board_api_macs
+from relay_command_dispatcher import RelayCommandDispatcher
+from relay_cycle_limits import RelayCycleGuard
+from sensor_liveness import SensorLivenessTracker
 from sensor_message_item import SensorMessageItem
-
-
-class ControlTrigger:
-    """
-    The control trigger will keep information about the Control Def execution in memory (or cache eventually)
-    """
-
-    def __init__(self, time_exceeded_millis: int, expire_millis: int, sensor_data: float):
-        self._time_exceeded_millis = time_exceeded_millis
-        self._sensor_data = sensor_data
-        self._expire_millis = expire_millis
-
-        # when did we last see this sensor?
-        self._last_sensor_read_ms = None
-        self._last_sensor_data = None
-
-        # when did we execute the control function
-        self._control_func_execute_time_ms = None
-
-    def get_time_exceeded_millis(self) -> int:
-        return int(self._time_exceeded_millis)
-
-    def get_sensor_data(self) -> float:
-        return float(self._sensor_data)
-
-    def get_expire_millis(self) -> int:
-        return self._expire_millis
-
-    def set_last_sensor_read_ms(self, last_sensor_read_ms: int):
-        self._last_sensor_read_ms = last_sensor_read_ms
-
-    def get_last_sensor_read_ms(self) -> int:
-        return self._last_sensor_read_ms
-
-    def set_last_sensor_data(self, last_sensor_data: float):
-        self._last_sensor_data = last_sensor_data
-
-    def get_last_sensor_data(self) -> float:
-        return self._last_sensor_data
-
-    def set_control_func_execution_time_ms(self, control_func_execution_time_ms: int):
-        self._control_func_execute_time_ms = control_func_execution_time_ms
-
-    def get_control_func_execution_time_ms(self) -> int | None:
-        return self._control_func_execute_time_ms
+from window_operators import SensorWindowStore
 
 
 class BangBangController(Thread):
 
-    def __init__(self, message_queue: Queue, sig_event: Event):
+    def __init__(self, message_queue: Queue, sig_event: Event,
+                 relay_controller: WaveshareRelayController = None,
+                 control_defs: list[ControlDef] = None,
+                 api_writer: SensorDataIngest = None,
+                 control_def_watcher: ControlDefWatcher = None,
+                 report_to_api: bool = True,
+                 clock: Callable[[], float] = time.time,
+                 control_state_file: str = None,
+                 relay_boards: dict[str, WaveshareRelayController] = None,
+                 shard: tuple[int, int] = None,
+                 inline_relay_commands: bool = False,
+                 api_sender_factory: Callable[[Callable[[list[dict]], bool], ApiOutbox | None], ApiSender] = None):
 
         super(BangBangController, self).__init__()
 
@@ -76,23 +59,113 @@ class BangBangController(Thread):
         self.message_queue = message_queue
         self.sig_event = sig_event
 
-        self.api_update_interval = config.getint('DEFAULT', 'api_update_interval')
-        self.api_mac = config.getint('DEFAULT', 'api_mac')
-
-        self.api_config = APIConfig()
-        self.api_auth = APIAuth(self.api_config)
-        self.api_writer = SensorDataIngest(self.api_auth)
+        # seconds since the epoch like time.time(), the replay engine drives the controller with a virtual clock
+        self.clock = clock
 
-        self.last_api_update_time = 0
-
-        self.thread_sleep = config.getboolean('DEFAULT', 'thread_sleep')
-        self.thread_sleep_time = config.getfloat('DEFAULT', 'thread_sleep_time')
+        self.api_update_interval = config.getint('DEFAULT', 'api_update_interval', fallback=120000)
+        self.api_mac = config.getint('DEFAULT', 'api_mac', fallback=-1)
 
-        self.control_defs_file = config.get("DEFAULT", "control_defs_file")
-
-        self.control_defs = ControlDefUtils.fetch_control_defs(self.control_defs_file)
+        if (api_writer is None) and (report_to_api is True):
+            self.api_config = APIConfig()
+            self.api_auth = APIAuth(self.api_config)
+            self.api_writer = SensorDataIngest(self.api_auth)
+        else:
+            self.api_writer = api_writer
 
-        self.control_triggers: dict[str, ControlTrigger] = dict()
+        self.last_api_update_time = 0
+        # shard workers leave reporting the relay states to the process that owns the relays
+        self.report_to_api = report_to_api
+
+        # update_api hands its batches to the api sender thread, which sends them or, with an api_outbox_file,
+        # writes them to a durable outbox that the outbox sender thread drains to the API with retries
+        # (a controller that doesn't report to the API leaves the outbox to the one that does)
+        self.api_outbox = None
+        self.api_outbox_sender = None
+        api_outbox_file = config.get('DEFAULT', 'api_outbox_file', fallback="")
+        if (api_outbox_file != "") and (report_to_api is True):
+            self.api_outbox = ApiOutbox(api_outbox_file,
+                                        max_rows=config.getint('DEFAULT', 'api_outbox_max_rows', fallback=100000))
+            self.api_outbox_sender = ApiOutboxSender(
+                self.api_outbox,
+                self.send_batch_to_api,
+                max_batch_size=config.getint('DEFAULT', 'api_max_batch_size', fallback=500),
+                retry_min_ms=config.getint('DEFAULT', 'api_retry_min_ms', fallback=1000),
+                retry_max_ms=config.getint('DEFAULT', 'api_retry_max_ms', fallback=300000))
+        # with api_report_changes, a relay state change is reported as soon as it happens (coalesced over
+        # api_change_coalesce_ms) and the full snapshot every api_update_interval becomes a heartbeat
+        self.api_report_changes = config.getboolean('DEFAULT', 'api_report_changes', fallback=False)
+        self.api_change_coalesce_ms = config.getint('DEFAULT', 'api_change_coalesce_ms', fallback=1000)
+        # (board id, channel) -> time of its latest change, for the channels changed since the last report
+        self.changed_channels: dict[tuple[str, WaveshareDef], int] = dict()
+        self.change_report_due_ms = None
+        self.last_reported_states: dict[tuple[str, WaveshareDef], int] = dict()
+
+        self.api_sender_join_timeout_s = 5.0
+        # a runtime that sends the batches its own way (the asyncio one) passes a factory for its sender
+        if api_sender_factory is None:
+            self.api_sender = ApiSender(self.send_batch_to_api, self.api_outbox,
+                                        queue_size=config.getint('DEFAULT', 'api_send_queue_size', fallback=16))
+        else:
+            self.api_sender = api_sender_factory(self.send_batch_to_api, self.api_outbox)
+
+        self.thread_sleep = config.getboolean('DEFAULT', 'thread_sleep', fallback=False)
+        self.thread_sleep_time = config.getfloat('DEFAULT', 'thread_sleep_time', fallback=0.1)
+
+        # block on the message queue until a message arrives or the next deadline is due,
+        # instead of polling it (set to False for the old polling loop)
+        self.blocking_queue = config.getboolean('DEFAULT', 'blocking_queue', fallback=True)
+        # upper bound on how long the loop blocks, so a shutdown is noticed promptly
+        self.max_wait_ms = config.getint('DEFAULT', 'max_wait_ms', fallback=500)
+        # maximum number of messages drained from the queue into one batch
+        self.max_batch_size = config.getint('DEFAULT', 'max_batch_size', fallback=1000)
+
+        self.control_defs_file = config.get("DEFAULT", "control_defs_file", fallback="control_defs.json")
+
+        self.control_defs: list[ControlDef] = list()
+        self.control_def_index = ControlDefIndex()
+        # the rolling windows of the defs with an aggregate func, per (mac, type)
+        self.sensor_windows = SensorWindowStore(config.getint('DEFAULT', 'window_max_samples', fallback=1024))
+        # the control defs with a composite condition (see control_rules)
+        self.control_rules = ControlRuleEngine()
+        # the (mac, type) of the sensors read by defs with a staleness timeout, a sensor whose timer runs out
+        # before its next reading is stale and the failsafe of its defs runs (see sensor_liveness)
+        self.sensor_liveness = SensorLivenessTracker(config.getint('DEFAULT', 'stale_sensor_timeout_ms', fallback=0),
+                                                     config.getint('DEFAULT', 'stale_check_tick_ms', fallback=1000))
+        # (shard id, number of shards) when the controller only gets the readings of its shard's macs
+        self.shard = shard
+
+        # evaluate each drained batch of messages in one vectorized pass (requires numpy)
+        self.batch_evaluator = None
+        if config.getboolean('DEFAULT', 'batch_evaluation', fallback=False) is True:
+            from batch_evaluator import ControlDefBatchEvaluator
+            self.batch_evaluator = ControlDefBatchEvaluator(sensor_windows=self.sensor_windows)
+
+        # control defs passed in directly are static, otherwise they are hot reloaded from the control defs file
+        self.control_def_watcher = None
+        self.control_def_generation = 0
+        self.control_defs_reload_interval_ms = config.getint('DEFAULT', 'control_defs_reload_interval_ms',
+                                                             fallback=5000)
+        self.last_control_defs_check_time = self.now_ms()
+        if control_defs is None:
+            if control_def_watcher is None:
+                control_def_watcher = ControlDefWatcher(self.control_defs_file)
+            self.control_def_watcher = control_def_watcher
+            self.control_def_generation, control_defs = control_def_watcher.get_control_defs()
+        self.set_control_defs(control_defs)
+
+        # 0 means the number of live control triggers is unbounded
+        max_control_triggers = config.getint('DEFAULT', 'max_control_triggers', fallback=0)
+        self.control_triggers = ControlTriggerStore(max_control_triggers)
+        # a pending trigger lives for the threshold duration (plus 20%) and this long again after the latest
+        # exceeding reading, so a sensor that reports less often than the duration can still complete it
+        self.control_trigger_stale_ms = config.getint('DEFAULT', 'control_trigger_stale_ms', fallback=300000)
+
+        # timed work that isn't tied to a reading (the relay cycle limits), the run loop sleeps until the earliest
+        self.deadlines = DeadlineScheduler()
+        # the commanded state of every relay channel, for the min dwell and max switches per hour of the defs
+        self.relay_cycles = RelayCycleGuard()
+        # (board id, channel) -> (trigger key, back to normal) of the switch held back by the cycle limits
+        self.held_back_switches: dict[tuple[str, WaveshareDef], tuple[str, bool]] = dict()
 
         serial_port = config.get("RELAY_CONTROLLER", "serial_port", fallback="/dev/ttyUSB0")
         set_default_state_at_boot = config.getboolean("RELAY_CONTROLLER", "set_default_state_at_boot", fallback=False)
@@ -100,15 +173,246 @@ class BangBangController(Thread):
         default_states_str = config.get("RELAY_CONTROLLER", "default_relay_states", fallback=None)
         default_states_dict = WaveshareRelayController.parse_default_states(default_states_str)
 
-        self.relay_controller = WaveshareRelayController(serial_port, default_states=default_states_dict)
+        if relay_controller is None:
+            self.relay_controller = WaveshareRelayController(serial_port, default_states=default_states_dict)
+        else:
+            self.relay_controller = relay_controller
         if set_default_state_at_boot is True:
             self.relay_controller.set_default_states()
 
+        # the relay boards beyond the default one, by board id (see relay_boards)
+        if relay_boards is None:
+            relay_boards = build_relay_boards(config)
+        if set_default_state_at_boot is True:
+            for relay_board in relay_boards.values():
+                relay_board.set_default_states()
+        self.relay_board_api_macs = get_relay_board_api_macs(config)
+
+        # write the relay commands from a worker thread per board instead of the controller thread, always with
+        # more than one board so a serial round trip to one board doesn't hold up the others. inline_relay_commands
+        # is for relay controllers that already take the writes off the controller thread (the asyncio runtime's
+        # writers) or forward them to an owner with dispatchers of its own (a shard worker's proxies, where a
+        # dispatcher here would skip commands based on this controller's view of the channels only)
+        use_dispatchers = (inline_relay_commands is False) and (
+            (config.getboolean("RELAY_CONTROLLER", "async_relay_commands", fallback=False) is True) or
+            (len(relay_boards) > 0))
+        self.relay_dispatcher = None
+        if use_dispatchers is True:
+            self.relay_dispatcher = BangBangController.make_relay_dispatcher(self.relay_controller, config)
+            if self.relay_dispatcher is not None:
+                self.relay_controller = self.relay_dispatcher
+
+        self.relay_boards = dict()
+        self.relay_board_dispatchers: dict[str, RelayCommandDispatcher] = dict()
+        for board_id, relay_board in relay_boards.items():
+            relay_board_dispatcher = None
+            if use_dispatchers is True:
+                relay_board_dispatcher = BangBangController.make_relay_dispatcher(relay_board, config)
+            if relay_board_dispatcher is not None:
+                self.relay_board_dispatchers[board_id] = relay_board_dispatcher
+                relay_board = relay_board_dispatcher
+            self.relay_boards[board_id] = relay_board
+
+        # journal the control triggers and the commanded relay states, so a restart carries on from them
+        # instead of starting every duration timer over (control_state_file defaults to the config's)
+        self.control_state_journal = None
+        if control_state_file is None:
+            control_state_file = config.get('DEFAULT', 'control_state_file', fallback="")
+        if control_state_file != "":
+            self.control_state_journal = ControlStateJournal(
+                control_state_file,
+                fsync=config.getboolean('DEFAULT', 'control_state_fsync', fallback=False),
+                compact_min_records=config.getint('DEFAULT', 'control_state_compact_min_records', fallback=10000))
+            self.restore_control_state()
+
         # track how many messages we've processed
         self.n_messages_processed = 0
 
+        # read when the metrics are scraped
+        if message_queue is not None:
+            metrics.MESSAGE_QUEUE_DEPTH.set_function(message_queue.qsize)
+        metrics.LIVE_CONTROL_TRIGGERS.set_function(self.control_triggers.__len__)
+        metrics.STALE_SENSORS.set_function(self.sensor_liveness.get_n_stale)
+
         self.cache_fetch_interval_ms = config.getint("REDIS", "cache_fetch_interval_ms", fallback=30000)
 
+    def now_ms(self) -> int:
+        return int(self.clock() * 1000)
+
+    @staticmethod
+    def make_relay_dispatcher(relay_controller: WaveshareRelayController,
+                              config: configparser.ConfigParser) -> RelayCommandDispatcher | None:
+        """
+        A dispatcher to write a board's relay commands from its own worker thread
+        :param relay_controller:
+        :param config:
+        :return: None if the relay controller already is a dispatcher
+        """
+        if isinstance(relay_controller, RelayCommandDispatcher):
+            # the owner of a dispatcher passed in starts and stops it
+            return None
+
+        return RelayCommandDispatcher(
+            relay_controller,
+            config.getfloat("RELAY_CONTROLLER", "relay_command_coalesce_window_ms", fallback=50),
+            retry_min_ms=config.getint("RELAY_CONTROLLER", "relay_retry_min_ms", fallback=100),
+            retry_max_ms=config.getint("RELAY_CONTROLLER", "relay_retry_max_ms", fallback=10000))
+
+    def get_relay_controller(self, board_id: str) -> WaveshareRelayController | None:
+        """
+        :param board_id:
+        :return: the relay controller (or dispatcher) of the board, None for an unknown board
+        """
+        if board_id == DEFAULT_BOARD_ID:
+            return self.relay_controller
+        return self.relay_boards.get(board_id, None)
+
+    def get_relay_dispatchers(self) -> dict[str, RelayCommandDispatcher]:
+        """
+        The dispatchers this controller starts and stops, by board id
+        :return:
+        """
+        relay_dispatchers = dict()
+        if self.relay_dispatcher is not None:
+            relay_dispatchers[DEFAULT_BOARD_ID] = self.relay_dispatcher
+        relay_dispatchers.update(self.relay_board_dispatchers)
+        return relay_dispatchers
+
+    def get_relay_board_stats(self) -> dict[str, dict]:
+        """
+        Command counts, latency and health of each board written through a dispatcher, by board id
+        :return:
+        """
+        return {board_id: relay_dispatcher.get_stats()
+                for board_id, relay_dispatcher in self.get_relay_dispatchers().items()}
+
+    def restore_control_state(self):
+        """
+        Restore the journaled control triggers of the current control defs and re-issue the journaled relay
+        states (the board may have been reset to its default states at boot), then start journaling
+        :return:
+        """
+        start = time.perf_counter()
+        control_triggers, relay_states = self.control_state_journal.load()
+
+        control_defs = {control_def.get_uuid(): control_def for control_def in self.control_defs}
+        for key, control_trigger in control_triggers.items():
+            control_def = control_defs.get(control_trigger.get_control_def_uuid(), None)
+            if control_def is None:
+                self.logger.warning("Not restoring control trigger {}, its control def no longer exists".format(key))
+                continue
+            if control_trigger.get_control_func_execution_time_ms() is None:
+                # expiry refreshes aren't journaled, a pending trigger gets a full expiry from the restart
+                control_trigger.set_expire_millis(self.get_control_trigger_expiry_ms(control_def))
+            self.control_triggers.put(key, control_trigger)
+            execution_time_ms = control_trigger.get_control_func_execution_time_ms()
+            if (execution_time_ms is not None) and (control_def.get_max_on_millis() > 0):
+                # the reading that executed the control isn't journaled, only its timestamp matters here
+                self.schedule_max_on(key, SensorMessageItem(timestamp=execution_time_ms), control_def,
+                                     execution_time_ms)
+
+        for (board_id, channel), state in relay_states.items():
+            relay_controller = self.get_relay_controller(board_id)
+            if relay_controller is None:
+                self.logger.warning("Not restoring relay state of {} on unknown relay board {}".format(
+                    channel, board_id))
+                continue
+            if state == 1:
+                relay_controller.set_channel_on(channel)
+            else:
+                relay_controller.set_channel_off(channel)
+            self.relay_cycles.record(board_id, channel, state, self.now_ms())
+
+        self.control_state_journal.write_snapshot(dict(self.control_triggers.items()), relay_states)
+        self.control_triggers.set_journal(self.control_state_journal)
+        self.logger.info("Restored {} control triggers and {} relay states in {:.1f} ms".format(
+            len(self.control_triggers), len(relay_states), (time.perf_counter() - start) * 1000.0))
+
+    def journal_relay_state(self, board_id: str, channel: WaveshareDef, control_func: ControlFunc):
+        if self.control_state_journal is None:
+            return
+        if control_func == ControlFunc.ON:
+            self.control_state_journal.set_relay_state(board_id, channel, 1)
+        elif control_func == ControlFunc.OFF:
+            self.control_state_journal.set_relay_state(board_id, channel, 0)
+
+    def set_control_defs(self, control_defs: list[ControlDef]):
+        """
+        Swap in a new set of control defs and rebuild the dispatch index from them, the control rules
+        are compiled into the rule engine instead
+        :param control_defs:
+        :return:
+        """
+        plain_defs, control_rules = ControlDefUtils.split_control_rules(control_defs)
+        self.control_def_index.rebuild(plain_defs)
+        self.sensor_windows.compile(ControlDefUtils.get_predicates(control_defs))
+        if self.batch_evaluator is not None:
+            self.batch_evaluator.compile(plain_defs)
+        self.control_rules.compile(control_rules)
+        owns_mac = None
+        if self.shard is not None:
+            shard_id, n_shards = self.shard
+
+            def owns_mac(mac: int) -> bool:
+                return (mac % n_shards) == shard_id
+        self.sensor_liveness.compile(control_defs, self.now_ms(), owns_mac)
+        self.control_defs = control_defs
+
+    def reload_control_defs(self):
+        """
+        Pick up a new generation of control defs from the watcher. Control triggers are carried over
+        when their control def UUID still exists on the same relay board and channel, the rest are released
+        :return:
+        """
+        self.control_def_watcher.check_for_changes()
+        generation, control_defs = self.control_def_watcher.get_control_defs()
+        if generation == self.control_def_generation:
+            return
+
+        previous_defs = {control_def.get_uuid(): control_def for control_def in self.control_defs}
+        new_defs = {control_def.get_uuid(): control_def for control_def in control_defs}
+        for key, control_trigger in list(self.control_triggers.items()):
+            previous_def = previous_defs.get(control_trigger.get_control_def_uuid(), None)
+            new_def = new_defs.get(control_trigger.get_control_def_uuid(), None)
+            if (new_def is not None) and ((previous_def is None) or (
+                    (new_def.get_board_id() == previous_def.get_board_id()) and
+                    (new_def.get_control_channel() == previous_def.get_control_channel()))):
+                continue
+            self.release_control_trigger(key, control_trigger, previous_def)
+
+        self.set_control_defs(control_defs)
+        self.control_def_generation = generation
+        self.logger.info("Reloaded control defs generation {}, {} control triggers carried over".format(
+            generation, len(self.control_triggers)))
+
+    def release_control_trigger(self, key: str, control_trigger: ControlTrigger, control_def: ControlDef | None):
+        """
+        Drop a trigger whose control def was removed or moved to another channel, returning the channel it holds
+        to normal with the def it was executed for
+        :param key:
+        :param control_trigger:
+        :param control_def: the def the trigger was created for, None if it is unknown
+        :return:
+        """
+        self.control_triggers.pop(key)
+        self.deadlines.cancel(("max_on", key))
+        if control_def is None:
+            return
+        self.cancel_held_back_switch(control_def, key, back_to_normal=True)
+        self.cancel_held_back_switch(control_def, key, back_to_normal=False)
+        if control_trigger.get_control_func_execution_time_ms() is None:
+            return
+
+        if control_def.get_allow_back_to_normal() is False:
+            self.logger.warning("Control def for trigger {} was removed or moved while its control was active, "
+                                "it is not allowed to return {} to normal".format(key,
+                                                                                  control_def.get_control_channel()))
+            return
+        self.logger.warning("Control def for trigger {} was removed or moved while its control was active, "
+                            "returning {} of relay board {} to normal".format(key, control_def.get_control_channel(),
+                                                                               control_def.get_board_id()))
+        self.write_relay_command(control_def, control_def.get_back_to_normal_func())
+
     def process_message(self, sensor_message: SensorMessageItem):
         """
         Process incoming sensor messages
@@ -120,14 +424,212 @@ class BangBangController(Thread):
         if (self.n_messages_processed % 400) == 0:
             self.logger.info("Processed {} messages".format(self.n_messages_processed))
 
-        for control_def in self.control_defs:
-            # check if the mac and the sensor type match the control strategy
-            if (sensor_message.get_mac() in control_def.get_macs()) and (
-                    sensor_message.get_type() in control_def.get_sensor_types()):
+        self.sensor_windows.update(sensor_message.get_mac(), sensor_message.get_type(),
+                                   sensor_message.get_timestamp(), sensor_message.get_data())
+        if self.sensor_liveness.is_tracking() is True:
+            self.note_sensor_reading(sensor_message, self.now_ms())
+
+        # the index only hands back the defs whose mac and sensor type match the control strategy
+        for control_def in self.control_def_index.get_matching_defs(sensor_message.get_mac(),
+                                                                    sensor_message.get_type()):
+            if control_def.get_aggregate_func() is AggregateFunc.RAW:
                 exceeded = self.exceeded_threshold(sensor_message, control_def)
                 self.do_post_threshold_logic(sensor_message, control_def, exceeded)
+                continue
+
+            # the threshold and the hysteresis are checked against the window, the trigger keeps the reading
+            window_message = self.get_window_message(sensor_message, control_def)
+            if window_message is None:
+                continue
+            self.do_post_threshold_logic(sensor_message, control_def,
+                                         self.exceeded_threshold(window_message, control_def),
+                                         self.check_hysteresis(window_message, control_def) is True)
+
+        if self.control_rules.has_rules() is True:
+            self.process_rules(sensor_message, self.update_rules(sensor_message))
+
+    def evaluate_leaf(self, sensor_message: SensorMessageItem, leaf: ControlDef) -> tuple[bool, bool] | None:
+        """
+        Check a reading against a control rule's leaf predicate
+        :param sensor_message:
+        :param leaf:
+        :return: (exceeded, hysteresis check passed), None while the leaf's window has no value yet
+        """
+        if leaf.get_aggregate_func() is not AggregateFunc.RAW:
+            sensor_message = self.get_window_message(sensor_message, leaf)
+            if sensor_message is None:
+                return None
+        return (self.exceeded_threshold(sensor_message, leaf),
+                self.check_hysteresis(sensor_message, leaf) is True)
+
+    def update_rules(self, sensor_message: SensorMessageItem) -> list[tuple[ControlRule, bool]]:
+        """
+        Apply a reading to the control rules that depend on its mac and type
+        :param sensor_message:
+        :return: (rule, value of its condition) of the rules the reading updated
+        """
+        return self.control_rules.update(sensor_message.get_mac(), sensor_message.get_type(),
+                                         lambda leaf: self.evaluate_leaf(sensor_message, leaf))
+
+    def process_rules(self, sensor_message: SensorMessageItem, rule_values: list[tuple[ControlRule, bool]]):
+        """
+        Run the control logic of the updated rules, a rule's condition stops holding only once its leaves
+        passed their hysteresis checks, so a condition that doesn't hold is also the rule's hysteresis check
+        :param sensor_message:
+        :param rule_values:
+        :return:
+        """
+        for control_rule, value in rule_values:
+            self.do_post_threshold_logic(sensor_message, control_rule, value, value is False)
 
-    def do_post_threshold_logic(self, sensor_message: SensorMessageItem, control_def: ControlDef, exceeded: bool):
+    def note_sensor_reading(self, sensor_message: SensorMessageItem, now: int):
+        """
+        Push back the staleness timer of the reading's sensor
+        :param sensor_message:
+        :param now:
+        :return:
+        """
+        if self.sensor_liveness.seen(sensor_message.get_mac(), sensor_message.get_type(), now) is True:
+            self.logger.info("Sensor {} type {} is reporting again".format(sensor_message.get_mac(),
+                                                                           sensor_message.get_type()))
+
+    def check_sensor_liveness(self, now: int):
+        """
+        Run the failsafe of the defs that read the sensors which went stale by now
+        :param now:
+        :return:
+        """
+        for mac, sensor_type in self.sensor_liveness.advance(now):
+            self.on_sensor_stale(mac, sensor_type, now)
+
+    def on_sensor_stale(self, mac: int, sensor_type: int, now: int):
+        """
+        A sensor sent no reading for its staleness timeout: its pending triggers are dropped, and the defs
+        that read it run their failsafe
+        :param mac:
+        :param sensor_type:
+        :param now:
+        :return:
+        """
+        self.logger.warning("Sensor {} type {} sent no reading for {} ms, running the failsafe of its control defs"
+                            .format(mac, sensor_type, self.sensor_liveness.get_sensor_timeout_ms(mac, sensor_type)))
+        metrics.SENSORS_WENT_STALE.inc()
+
+        # stands in for the reading that never came
+        stale_message = SensorMessageItem(mac, sensor_type, float("nan"), now)
+        for control_def in self.control_def_index.get_matching_defs(mac, sensor_type):
+            if self.sensor_liveness.get_timeout_ms(control_def) > 0:
+                self.run_stale_failsafe(stale_message, control_def)
+
+        if self.control_rules.has_rules() is True:
+            for control_rule in self.control_rules.clear(
+                    mac, sensor_type, lambda rule: self.sensor_liveness.get_timeout_ms(rule) > 0):
+                self.run_stale_failsafe(stale_message, control_rule)
+
+    def run_stale_failsafe(self, sensor_message: SensorMessageItem, control_def: ControlDef):
+        """
+        Put the def's channel in its stale func state, or without one return an executed control to normal,
+        regardless of the cycle limits
+        :param sensor_message:
+        :param control_def:
+        :return:
+        """
+        key = BangBangController.get_control_trigger_key(sensor_message, control_def)
+        control_trigger = self.control_triggers.get(key, None)
+
+        control_func = control_def.get_stale_func()
+        if (control_func is None) and (control_trigger is not None) and \
+                (control_trigger.get_control_func_execution_time_ms() is not None):
+            if control_def.get_allow_back_to_normal() is False:
+                self.logger.warning("Control def {} is not allowed to return to normal, leaving its control on "
+                                    "for stale trigger {}".format(control_def.get_uuid(), key))
+                return
+            control_func = control_def.get_back_to_normal_func()
+
+        if control_trigger is not None:
+            # the readings that would complete the trigger or return it to normal stopped
+            self.control_triggers.pop(key)
+            self.deadlines.cancel(("max_on", key))
+            self.cancel_held_back_switch(control_def, key, back_to_normal=True)
+            self.cancel_held_back_switch(control_def, key, back_to_normal=False)
+
+        if control_func is not None:
+            self.execute_stale_command(sensor_message, control_def, control_func)
+
+    def execute_stale_command(self, sensor_message: SensorMessageItem, control_def: ControlDef,
+                              control_func: ControlFunc):
+        """
+        :param sensor_message: stands in for the missing reading, its data is NaN
+        :param control_def:
+        :param control_func:
+        :return:
+        """
+        self.write_relay_command(control_def, control_func)
+
+    def get_window_message(self, sensor_message: SensorMessageItem,
+                           control_def: ControlDef) -> SensorMessageItem | None:
+        """
+        The reading with its data replaced by the value of the def's rolling window
+        :param sensor_message:
+        :param control_def:
+        :return: None while the window has no value yet
+        """
+        value = self.sensor_windows.get_value(sensor_message.get_mac(), sensor_message.get_type(), control_def)
+        if value is None:
+            return None
+        return SensorMessageItem(sensor_message.get_mac(), sensor_message.get_type(), value,
+                                 sensor_message.get_timestamp())
+
+    def process_messages(self, sensor_messages: list[SensorMessageItem]):
+        """
+        Process a batch of incoming sensor messages, with the batch evaluator if it is enabled
+        :param sensor_messages:
+        :return:
+        """
+        if len(sensor_messages) == 0:
+            return
+        start = time.perf_counter()
+
+        if self.batch_evaluator is None:
+            for sensor_message in sensor_messages:
+                self.process_message(sensor_message)
+        else:
+            n_messages_processed = self.n_messages_processed + len(sensor_messages)
+            if (n_messages_processed // 400) > (self.n_messages_processed // 400):
+                self.logger.info("Processed {} messages".format(n_messages_processed))
+            self.n_messages_processed = n_messages_processed
+            if self.sensor_liveness.is_tracking() is True:
+                now = self.now_ms()
+                for sensor_message in sensor_messages:
+                    self.note_sensor_reading(sensor_message, now)
+
+            # the rules are updated as the evaluator pushes each reading into the windows, and their control
+            # logic runs after the defs of the reading like on the per message path
+            rule_updates = list()
+            on_reading = None
+            if self.control_rules.has_rules() is True:
+                def on_reading(position: int):
+                    rule_values = self.update_rules(sensor_messages[position])
+                    if len(rule_values) > 0:
+                        rule_updates.append((position, rule_values))
+
+            evaluation = self.batch_evaluator.evaluate(sensor_messages, on_reading)
+            next_update = 0
+            for message_position, control_def, exceeded, hysteresis_check in evaluation:
+                while (next_update < len(rule_updates)) and (rule_updates[next_update][0] < message_position):
+                    self.process_rules(sensor_messages[rule_updates[next_update][0]], rule_updates[next_update][1])
+                    next_update += 1
+                self.do_post_threshold_logic(sensor_messages[message_position], control_def, exceeded,
+                                             hysteresis_check)
+            for position, rule_values in rule_updates[next_update:]:
+                self.process_rules(sensor_messages[position], rule_values)
+
+        # timed per batch rather than per message to keep the instrumentation off the per message path
+        metrics.MESSAGES_PROCESSED.inc(len(sensor_messages))
+        metrics.EVALUATION_SECONDS.observe((time.perf_counter() - start) / len(sensor_messages))
+
+    def do_post_threshold_logic(self, sensor_message: SensorMessageItem, control_def: ControlDef, exceeded: bool,
+                                hysteresis_check: bool = None):
 
         key = BangBangController.get_control_trigger_key(sensor_message, control_def)
         control_trigger = self.control_triggers.get(key, None)
@@ -140,6 +642,8 @@ class BangBangController(Thread):
             # to the message arrival duration, it might not get triggered until the *next* interval unless
             # there is some fuzz_ms added in
             exceeded_duration_ms = BangBangController.exceeded_duration_ms(sensor_message, control_def, control_trigger)
+            control_trigger.set_last_sensor_read_ms(sensor_message.get_timestamp())
+            control_trigger.set_last_sensor_data(sensor_message.get_data())
 
             # check if the control has already been activated
             # note that we MAY want to keep executing the control
@@ -148,6 +652,10 @@ class BangBangController(Thread):
                 # it means we already turned on the control
                 is_on = True
 
+            if (is_on is True) and (len(self.held_back_switches) > 0):
+                # exceeding again, a return to normal held back by the cycle limits is no longer wanted
+                self.cancel_held_back_switch(control_def, key, back_to_normal=True)
+
             if (exceeded_duration_ms is True) and (is_on is False):
                 self.logger.debug(
                     "ALERT LOGIC: Value has exceeded threshold, duration millis is exceeded, turning control on"
@@ -156,26 +664,33 @@ class BangBangController(Thread):
             else:
                 self.logger.debug("ALERT LOGIC: Value has exceeded threshold, exceeded_duration_ms:{} control is:{}"
                                   .format(exceeded_duration_ms, is_on))
+            if (is_on is False) and (control_trigger.get_control_func_execution_time_ms() is None):
+                # still exceeding, keep the pending trigger alive from this reading (a control switch held back
+                # by the cycle limits leaves it pending too, and it must not restart its duration timer)
+                self.control_triggers.refresh_expiry(key, self.get_control_trigger_expiry_ms(control_def))
             return
 
         if (exceeded is True) and (control_trigger is None):
             # we've exceeded the threshold, and now we need to create a control_trigger to log the action
             # so when the next sensor message comes in from this device, we can check it against the
             # duration requirements
-            now = int(time.time() * 1000)
-            expire = now + int(control_def.get_threshold_duration_millis() * 1.2)
+            expire = self.get_control_trigger_expiry_ms(control_def)
 
             # we use the sensor message timestamps for duration exceeded
-            trigger = ControlTrigger(sensor_message.get_timestamp(), expire, sensor_message.get_data())
+            trigger = ControlTrigger(sensor_message.get_timestamp(), expire, sensor_message.get_data(),
+                                     control_def.get_uuid())
             self.control_triggers[key] = trigger
             self.logger.debug("ALERT LOGIC: value has exceeded the threshold, creating control trigger")
             return
 
         if (exceeded is False) and (control_trigger is not None):
+            control_trigger.set_last_sensor_read_ms(sensor_message.get_timestamp())
+            control_trigger.set_last_sensor_data(sensor_message.get_data())
             # we have an existing control trigger, and we've returned to a non-aberrant state
             # we don't want flapping so we check to see if the value has exceeded the hysteresis point
-            # check the various hystereses
-            hysteresis_check = self.check_hysteresis(sensor_message, control_def)
+            # check the various hystereses (unless the batch evaluator already did)
+            if hysteresis_check is None:
+                hysteresis_check = self.check_hysteresis(sensor_message, control_def)
             if hysteresis_check is True:
 
                 if control_def.get_allow_back_to_normal():
@@ -191,6 +706,14 @@ class BangBangController(Thread):
             else:
                 self.logger.debug("ALERT LOGIC: Threshold is not exceeded, hysteresis check did not pass")
 
+    def get_control_trigger_expiry_ms(self, control_def: ControlDef) -> int:
+        """
+        When a pending trigger expires if no further exceeding reading arrives
+        :param control_def:
+        :return:
+        """
+        return self.now_ms() + int(control_def.get_threshold_duration_millis() * 1.2) + self.control_trigger_stale_ms
+
     @staticmethod
     def get_control_trigger_key(sensor_message: SensorMessageItem, control_def: ControlDef) -> str:
         """
@@ -201,6 +724,9 @@ class BangBangController(Thread):
         :param control_def:
         :return:
         """
+        if isinstance(control_def, ControlRule):
+            # one trigger per rule, whichever of its macs and types the reading is from
+            return "rule-{0}".format(control_def.get_uuid())
         return "{0}-{1}-{2}".format(sensor_message.get_mac(), sensor_message.get_type(), control_def.get_uuid())
 
     @staticmethod
@@ -241,18 +767,16 @@ class BangBangController(Thread):
         :return:
         """
         key = BangBangController.get_control_trigger_key(sensor_message, control_def)
-        control_trigger = self.control_triggers.get(key, None)
-
-        if control_def.get_control_func() == ControlFunc.ON:
-            self.relay_controller.set_channel_on(control_def.get_control_channel())
-        elif control_def.get_control_func() == ControlFunc.OFF:
-            self.relay_controller.set_channel_off(control_def.get_control_channel())
-        else:
-            self.logger.error("Invalid control function {0} for control_def:{1}"
-                              .format(control_def.get_control_func(), control_def.get_uuid()))
+        if self.hold_back_switch(sensor_message, control_def, key, control_def.get_control_func(), False) is True:
+            return
+        if self.write_relay_command(control_def, control_def.get_control_func()) is False:
+            return
 
         # mutate the control trigger
-        control_trigger.set_control_func_execution_time_ms(int(time.time() * 1000))
+        execution_time_ms = self.now_ms()
+        self.control_triggers.set_executed(key, execution_time_ms)
+        if control_def.get_max_on_millis() > 0:
+            self.schedule_max_on(key, sensor_message, control_def, execution_time_ms)
 
     def execute_back_to_normal_command(self, sensor_message: SensorMessageItem, control_def: ControlDef):
         """
@@ -262,17 +786,122 @@ class BangBangController(Thread):
         :return:
         """
         key = BangBangController.get_control_trigger_key(sensor_message, control_def)
-        control_trigger = self.control_triggers.get(key, None)
+        if self.hold_back_switch(sensor_message, control_def, key, control_def.get_back_to_normal_func(),
+                                 True) is True:
+            return
+        if self.write_relay_command(control_def, control_def.get_back_to_normal_func()) is False:
+            return
+
+        self.deadlines.cancel(("max_on", key))
+        _ = self.control_triggers.pop(key)
+
+    def write_relay_command(self, control_def: ControlDef, control_func: ControlFunc) -> bool:
+        """
+        Put the def's channel in the state of a control func
+        :param control_def:
+        :param control_func:
+        :return: False if the def's relay board is unknown
+        """
+        relay_controller = self.get_relay_controller(control_def.get_board_id())
+        if relay_controller is None:
+            self.logger.error("Unknown relay board {0} for control_def:{1}"
+                              .format(control_def.get_board_id(), control_def.get_uuid()))
+            return False
 
-        if control_def.get_back_to_normal_func() == ControlFunc.ON:
-            self.relay_controller.set_channel_on(control_def.get_control_channel())
-        elif control_def.get_back_to_normal_func() == ControlFunc.OFF:
-            self.relay_controller.set_channel_off(control_def.get_control_channel())
+        start = time.perf_counter()
+        if control_func == ControlFunc.ON:
+            relay_controller.set_channel_on(control_def.get_control_channel())
+        elif control_func == ControlFunc.OFF:
+            relay_controller.set_channel_off(control_def.get_control_channel())
         else:
             self.logger.error("Invalid control function {0} for control_def:{1}"
-                              .format(control_def.get_control_func(), control_def.get_uuid()))
+                              .format(control_func, control_def.get_uuid()))
+        metrics.RELAY_CALL_SECONDS.observe(time.perf_counter() - start)
+
+        self.note_channel_change(control_def.get_board_id(), control_def.get_control_channel())
+        self.journal_relay_state(control_def.get_board_id(), control_def.get_control_channel(), control_func)
+        if control_func in (ControlFunc.ON, ControlFunc.OFF):
+            self.relay_cycles.record(control_def.get_board_id(), control_def.get_control_channel(),
+                                     1 if control_func == ControlFunc.ON else 0, self.now_ms())
+        return True
+
+    def hold_back_switch(self, sensor_message: SensorMessageItem, control_def: ControlDef, key: str,
+                         control_func: ControlFunc, back_to_normal: bool) -> bool:
+        """
+        Hold back a switch the def's min dwell or max switches per hour don't allow yet, it is retried from the
+        deadline scheduler once they do (the latest switch asked for on a channel replaces an earlier one)
+        :param sensor_message:
+        :param control_def:
+        :param key:
+        :param control_func:
+        :param back_to_normal:
+        :return: True if the switch was held back
+        """
+        if control_func not in (ControlFunc.ON, ControlFunc.OFF):
+            return False
 
-        _ = self.control_triggers.pop(key)
+        board_channel = (control_def.get_board_id(), control_def.get_control_channel())
+        allowed_ms = self.relay_cycles.get_allowed_ms(board_channel[0], board_channel[1],
+                                                      1 if control_func == ControlFunc.ON else 0, control_def,
+                                                      self.now_ms())
+        if allowed_ms is None:
+            if self.held_back_switches.pop(board_channel, None) is not None:
+                self.deadlines.cancel(("held_back_switch", board_channel))
+            return False
+
+        if self.held_back_switches.get(board_channel, None) != (key, back_to_normal):
+            self.logger.info("Holding back switching {} of relay board {} for control_def:{} until {}".format(
+                board_channel[1], board_channel[0], control_def.get_uuid(), allowed_ms))
+        self.held_back_switches[board_channel] = (key, back_to_normal)
+        self.deadlines.schedule(("held_back_switch", board_channel), allowed_ms,
+                                lambda: self.run_held_back_switch(sensor_message, control_def, key, back_to_normal))
+        return True
+
+    def run_held_back_switch(self, sensor_message: SensorMessageItem, control_def: ControlDef, key: str,
+                             back_to_normal: bool):
+        self.held_back_switches.pop((control_def.get_board_id(), control_def.get_control_channel()), None)
+
+        # the trigger may have expired or been returned to normal in the meantime
+        control_trigger = self.control_triggers.get(key, None)
+        if control_trigger is None:
+            return
+        if back_to_normal is True:
+            self.execute_back_to_normal_command(sensor_message, control_def)
+        elif control_trigger.get_control_func_execution_time_ms() is None:
+            self.execute_control_command(sensor_message, control_def)
+
+    def cancel_held_back_switch(self, control_def: ControlDef, key: str, back_to_normal: bool):
+        board_channel = (control_def.get_board_id(), control_def.get_control_channel())
+        if self.held_back_switches.get(board_channel, None) == (key, back_to_normal):
+            del self.held_back_switches[board_channel]
+            self.deadlines.cancel(("held_back_switch", board_channel))
+
+    def schedule_max_on(self, key: str, sensor_message: SensorMessageItem, control_def: ControlDef,
+                        execution_time_ms: int):
+        self.deadlines.schedule(("max_on", key), execution_time_ms + control_def.get_max_on_millis(),
+                                lambda: self.enforce_max_on(key, sensor_message, control_def, execution_time_ms))
+
+    def enforce_max_on(self, key: str, sensor_message: SensorMessageItem, control_def: ControlDef,
+                       execution_time_ms: int):
+        control_trigger = self.control_triggers.get(key, None)
+        if (control_trigger is None) or (control_trigger.get_control_func_execution_time_ms() != execution_time_ms):
+            return
+
+        self.logger.warning("Control def {} held its control func for max_on_millis {}, returning {} to normal".format(
+            control_def.get_uuid(), control_def.get_max_on_millis(), control_def.get_control_channel()))
+        self.cancel_held_back_switch(control_def, key, back_to_normal=True)
+        self.execute_max_on_command(sensor_message, control_def)
+
+    def execute_max_on_command(self, sensor_message: SensorMessageItem, control_def: ControlDef):
+        """
+        Return the def's channel to normal once it held the control func for max_on_millis, regardless of the
+        cycle limits. The trigger stays executed, so the control func only executes again after the readings
+        have returned to normal and exceeded the threshold anew
+        :param sensor_message:
+        :param control_def:
+        :return:
+        """
+        self.write_relay_command(control_def, control_def.get_back_to_normal_func())
 
     def check_hysteresis(self, sensor_message: SensorMessageItem, control_def: ControlDef):
         """
@@ -303,8 +932,10 @@ class BangBangController(Thread):
             err = self.api_writer.send_data(batch, True)
             if err is False:
                 self.logger.error("Error sending messages, aborting rest")
+                metrics.API_SENDS_FAILED.inc()
                 return False
             else:
+                metrics.API_SENDS_SUCCEEDED.inc()
                 return True
 
         except urllib3.exceptions.ReadTimeoutError as rte:
@@ -313,57 +944,153 @@ class BangBangController(Thread):
             aborting the thread
             '''
             self.logger.error("Read timeout error from urllib3:{}".format(rte))
+            metrics.API_SENDS_FAILED.inc()
             # we break because there's no point in trying to send the rest of the messages,
             # we can wait until next interval
             return False
 
         except requests.exceptions.ReadTimeout as rt:
             self.logger.error("Read timeout error from requests:{}".format(rt))
+            metrics.API_SENDS_FAILED.inc()
             return False
 
         except requests.exceptions.ConnectTimeout as cte:
             self.logger.error("Connection timeout error sending messages to API:{}".format(cte))
+            metrics.API_SENDS_FAILED.inc()
             return False
 
         # we need to be fairly aggressive with exception handling as we are in a thread
         # doing network stuff and network things are buggy as heck
         except Exception as e:
             self.logger.error("Unknown exception trying to send messages to API:{}".format(e))
+            metrics.API_SENDS_FAILED.inc()
             return False
 
-    def update_api(self):
+    def note_channel_change(self, board_id: str, channel: WaveshareDef):
+        """
+        Remember that a control command went to the channel, so the change gets reported to the API
+        :param board_id:
+        :param channel:
+        :return:
+        """
+        if (self.api_report_changes is False) or (self.report_to_api is False):
+            return
 
-        try:
-            batch = list()
+        now = self.now_ms()
+        self.changed_channels[(board_id, channel)] = now
+        if self.change_report_due_ms is None:
+            self.change_report_due_ms = now + self.api_change_coalesce_ms
+
+    def build_channel_datums(self, channel_states: dict, timestamps: dict[WaveshareDef, int] = None,
+                             default_timestamp: int = None, api_mac: int = None) -> list[dict]:
+        """
+        Build the API datums for the relay channel states
+        :param channel_states:
+        :param timestamps: per channel timestamps, channels without one get default_timestamp
+        :param default_timestamp:
+        :param api_mac: the mac of the relay board, defaults to api_mac
+        :return:
+        """
+        batch = list()
+
+        if api_mac is None:
+            api_mac = self.api_mac
+
+        base_type = 0x12D  # 301 sensortype from API
+
+        # we only care about the relay GPIO channels (CH1-8)
+        channel_list = ["CH{}".format(i) for i in range(1, 9)]
+
+        for channel, state in channel_states.items():
+
+            # only send state information about the relay channels
+            if channel.name not in channel_list:
+                continue
+
+            if state is None:
+                # the state has not been modified by any control action yet
+                state = -1
 
-            now = int(time.time() * 1000)
-            channel_states = self.relay_controller.get_channel_states()
+            timestamp = default_timestamp
+            if (timestamps is not None) and (channel in timestamps):
+                timestamp = timestamps[channel]
 
-            base_type = 0x12D  # 301 sensortype from API
+            datum: dict = {
+                'mac': api_mac,
+                'type': base_type + (channel.get_channel_number() - 1),
+                'timestamp': timestamp,
+                'data': state
+            }
 
-            # we only care about the relay GPIO channels (CH1-8)
-            channel_list = ["CH{}".format(i) for i in range(1, 9)]
+            batch.append(datum)
 
-            for channel, state in channel_states.items():
+        return batch
 
-                # only send state information about the relay channels
-                if channel.name not in channel_list:
-                    continue
+    def submit_api_batch(self, batch: list[dict]):
+        # never wait on the network here, the sender thread takes it from the queue
+        self.api_sender.submit(batch)
+        self.logger.info("Queued batch len {} for the API, sender:{}".format(len(batch),
+                                                                             self.api_sender.get_stats()))
+        if self.api_outbox is not None:
+            self.logger.info("API outbox depth:{}".format(self.api_outbox.get_depth()))
 
-                if state is None:
-                    # the state has not been modified by any control action yet
-                    state = -1
+    def get_reported_boards(self) -> dict[str, int]:
+        """
+        The relay boards whose channel states are reported to the API
+        :return: board id -> api mac
+        """
+        reported_boards = {DEFAULT_BOARD_ID: self.api_mac}
+        for board_id, api_mac in self.relay_board_api_macs.items():
+            if board_id in self.relay_boards:
+                reported_boards[board_id] = api_mac
+        return reported_boards
+
+    def report_channel_changes(self):
+        """
+        Report the channels whose state changed since they were last reported
+        :return:
+        """
+        try:
+            batch = list()
+            reported_states = dict()
+            for board_id, api_mac in self.get_reported_boards().items():
+                channel_states = self.get_relay_controller(board_id).get_channel_states()
+                changed_states = dict()
+                timestamps = dict()
+                for (changed_board_id, channel), change_time in self.changed_channels.items():
+                    if changed_board_id != board_id:
+                        continue
+                    state = channel_states.get(channel, None)
+                    if (state is not None) and (self.last_reported_states.get((board_id, channel), None) != state):
+                        changed_states[channel] = state
+                        timestamps[channel] = change_time
+                        reported_states[(board_id, channel)] = state
+
+                batch.extend(self.build_channel_datums(changed_states, timestamps=timestamps, api_mac=api_mac))
+
+            if len(batch) > 0:
+                self.submit_api_batch(batch)
+                self.last_reported_states.update(reported_states)
 
-                datum: dict = {
-                    'mac': self.api_mac,
-                    'type': base_type + (channel.get_channel_number() - 1),
-                    'timestamp': now,
-                    'data': state
-                }
+        except Exception as e:
+            self.logger.error("Unknown exception trying to report relay state changes to API:{}".format(e))
+
+        self.changed_channels = dict()
+        self.change_report_due_ms = None
+
+    def update_api(self):
+
+        try:
+            now = self.now_ms()
+            batch = list()
+            reported_states = dict()
+            for board_id, api_mac in self.get_reported_boards().items():
+                channel_states = self.get_relay_controller(board_id).get_channel_states()
+                batch.extend(self.build_channel_datums(channel_states, default_timestamp=now, api_mac=api_mac))
+                reported_states.update({(board_id, channel): state for channel, state in channel_states.items()})
 
-                batch.append(datum)
-            self.logger.info("Sending batch len {} to API:".format(len(batch)))
-            self.send_batch_to_api(batch)
+            self.submit_api_batch(batch)
+            self.last_reported_states.update(reported_states)
 
         except Exception as e:
             self.logger.error("Unknown exception trying to send messages to API:{}".format(e))
@@ -390,24 +1117,168 @@ class BangBangController(Thread):
 
         return False
 
+    def get_next_deadline_ms(self) -> int:
+        """
+        The earliest time (epoch millis) at which the run loop has timed work to do
+        :return:
+        """
+        if self.report_to_api is True:
+            next_deadline_ms = self.last_api_update_time + self.api_update_interval
+        else:
+            next_deadline_ms = self.now_ms() + self.max_wait_ms
+
+        next_expiry_ms = self.control_triggers.get_next_expiry_ms()
+        if next_expiry_ms is not None:
+            next_deadline_ms = min(next_deadline_ms, next_expiry_ms)
+
+        next_scheduled_ms = self.deadlines.get_next_deadline_ms()
+        if next_scheduled_ms is not None:
+            next_deadline_ms = min(next_deadline_ms, next_scheduled_ms)
+
+        next_liveness_check_ms = self.sensor_liveness.get_next_check_ms()
+        if next_liveness_check_ms is not None:
+            next_deadline_ms = min(next_deadline_ms, next_liveness_check_ms)
+
+        if self.control_def_watcher is not None:
+            next_deadline_ms = min(next_deadline_ms,
+                                   self.last_control_defs_check_time + self.control_defs_reload_interval_ms)
+
+        if self.change_report_due_ms is not None:
+            next_deadline_ms = min(next_deadline_ms, self.change_report_due_ms)
+
+        return next_deadline_ms
+
+    def expire_control_triggers(self, now: int):
+        """
+        Drop the pending control triggers that have outlived their expire_millis
+        :param now:
+        :return:
+        """
+        expired_keys = self.control_triggers.expire(now)
+        if len(expired_keys) > 0:
+            self.logger.debug("Expired {} control triggers, trigger store:{}".format(
+                len(expired_keys), self.control_triggers.get_metrics()))
+
+    def run_due_deadlines(self):
+        """
+        Run the timed work that is due
+        :return:
+        """
+        now = self.now_ms()
+
+        if (self.control_def_watcher is not None) and (
+                (now - self.last_control_defs_check_time) >= self.control_defs_reload_interval_ms):
+            self.reload_control_defs()
+            self.last_control_defs_check_time = now
+
+        self.expire_control_triggers(now)
+        self.deadlines.run_due(now)
+        if self.sensor_liveness.has_timers() is True:
+            self.check_sensor_liveness(now)
+
+        if (self.change_report_due_ms is not None) and (now >= self.change_report_due_ms):
+            self.report_channel_changes()
+
+        if (self.report_to_api is True) and ((now - self.last_api_update_time) >= self.api_update_interval):
+            self.logger.info("Updating API statuses, control trigger store:{}".format(
+                self.control_triggers.get_metrics()))
+            relay_board_stats = self.get_relay_board_stats()
+            if len(relay_board_stats) > 0:
+                self.logger.info("Relay commands per board:{}".format(relay_board_stats))
+            for board_id, stats in relay_board_stats.items():
+                if stats["healthy"] is False:
+                    self.logger.error("Relay board {} is failing, {} consecutive failed writes".format(
+                        board_id, stats["consecutive_failures"]))
+            if self.sensor_liveness.get_n_stale() > 0:
+                self.logger.warning("{} sensors are stale:{}".format(
+                    self.sensor_liveness.get_n_stale(), sorted(self.sensor_liveness.get_stale_sensors().keys())))
+            self.update_api()
+            self.last_api_update_time = now
+
+    def drain_message_queue(self, timeout_s: float) -> list[SensorMessageItem]:
+        """
+        Block up to timeout_s for a message, then drain whatever else is already queued (up to max_batch_size)
+        :param timeout_s:
+        :return:
+        """
+        sensor_message_items = list()
+        try:
+            sensor_message_items.append(self.message_queue.get(timeout=timeout_s))
+        except queue.Empty:
+            return sensor_message_items
+
+        while len(sensor_message_items) < self.max_batch_size:
+            try:
+                sensor_message_items.append(self.message_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return sensor_message_items
+
+    def stop_workers(self):
+        """
+        Stop the worker threads the controller started, after they finish their pending work
+        :return:
+        """
+        for relay_dispatcher in self.get_relay_dispatchers().values():
+            relay_dispatcher.stop()
+        for relay_dispatcher in self.get_relay_dispatchers().values():
+            relay_dispatcher.join()
+
+        # the sender may be stuck in a hanging request, don't hold up the shutdown for it
+        self.api_sender.stop()
+        self.api_sender.join(timeout=self.api_sender_join_timeout_s)
+
+        if self.api_outbox_sender is not None:
+            self.api_outbox_sender.stop()
+            self.api_outbox_sender.join(timeout=self.api_sender_join_timeout_s)
+            if not (self.api_sender.is_alive() or self.api_outbox_sender.is_alive()):
+                self.api_outbox.close()
+
+        if self.control_state_journal is not None:
+            self.control_state_journal.close()
+
     def run(self):
+        for relay_dispatcher in self.get_relay_dispatchers().values():
+            relay_dispatcher.start()
+
+        self.api_sender.start()
+        if self.api_outbox_sender is not None:
+            self.api_outbox_sender.start()
+
+        if self.blocking_queue is False:
+            self.run_polling()
+            self.stop_workers()
+            return
+
+        while not self.sig_event.is_set():
+            # sleep on the queue until a message arrives or the next deadline is due
+            now = self.now_ms()
+            wait_ms = min(max(0, self.get_next_deadline_ms() - now), self.max_wait_ms)
+
+            sensor_message_items = self.drain_message_queue(wait_ms / 1000.0)
+            if len(sensor_message_items) > 0:
+                self.process_messages(sensor_message_items)
+
+            self.run_due_deadlines()
+
+        self.stop_workers()
+        print("Exiting {}".format(self.__class__.__name__))
+
+    def run_polling(self):
+        """
+        The original run loop, polls the queue and optionally sleeps cache_fetch_interval_ms between passes
+        :return:
+        """
         while True:
 
+            # process messages in the queue
+            sensor_message_items = list()
             while not self.message_queue.empty():
-                # process messages in the queue
-                sensor_message_item = self.message_queue.get()
-                self.process_message(sensor_message_item)
-
-            # expire old control triggers
-            pass
-            # refresh control_defs
-            pass
-
-            now = int(time.time() * 1000)
-            if (now - self.last_api_update_time) >= self.api_update_interval:
-                self.logger.info("Updating API statuses")
-                self.update_api()
-                self.last_api_update_time = now
+                sensor_message_items.append(self.message_queue.get())
+            self.process_messages(sensor_message_items)
+
+            self.run_due_deadlines()
 
             if self.sig_event.is_set():
                 print("Exiting {}".format(self.__class__.__name__))
@@ -0,0 +1,174 @@
+from typing import Callable
+
+import numpy as np
+
+from control_defs import AggregateFunc, ControlDef, ControlDefIndex, ThresholdType
+from sensor_message_item import SensorMessageItem, SensorMessageBatch
+from window_operators import SensorWindowStore
+
+
+class BatchEvaluation:
+    """
+    Result of evaluating a batch of readings against the loaded control defs
+
+    One entry per (reading, matching control def) pair, ordered by reading and then by def load order,
+    which is the order the per message path calls do_post_threshold_logic in
+    """
+
+    def __init__(self, message_positions: np.ndarray, control_defs: list[ControlDef],
+                 exceeded: np.ndarray, hysteresis_passed: np.ndarray):
+        self._message_positions = message_positions
+        self._control_defs = control_defs
+        self._exceeded = exceeded
+        self._hysteresis_passed = hysteresis_passed
+
+    def __len__(self):
+        return len(self._control_defs)
+
+    def __iter__(self):
+        """
+        :return: (message position in the batch, control def, exceeded, hysteresis check passed)
+        """
+        return zip(self._message_positions.tolist(), self._control_defs,
+                   self._exceeded.tolist(), self._hysteresis_passed.tolist())
+
+
+class ControlDefBatchEvaluator:
+    """
+    Compiles the control defs into NumPy arrays (threshold, hysteresis and the sign of the ThresholdType)
+    and evaluates a whole batch of readings against all their matching defs in one vectorized pass
+
+    The comparisons are the same ones exceeded_threshold and check_hysteresis make (including computing
+    threshold -/+ hysteresis first), so the results match the per message path exactly.
+    Defs with an invalid ThresholdType get sign 0 and never exceed or pass the hysteresis check.
+
+    Defs with an aggregate func are compared against their rolling window instead of the reading, the windows
+    are updated reading by reading in batch order like the per message path does. Pass the controller's
+    sensor_windows to share them with it (its owner compiles them), otherwise the evaluator keeps its own.
+    """
+
+    def __init__(self, control_defs: list[ControlDef] = None, sensor_windows: SensorWindowStore = None):
+        self._owns_sensor_windows = sensor_windows is None
+        self._sensor_windows = SensorWindowStore() if sensor_windows is None else sensor_windows
+        self._control_defs: list[ControlDef] = list()
+        self._index = ControlDefIndex()
+        self._positions: dict[int, int] = dict()
+        self._thresholds = np.zeros(0)
+        self._lower_normal = np.zeros(0)
+        self._upper_normal = np.zeros(0)
+        self._signs = np.zeros(0)
+
+        if control_defs is not None:
+            self.compile(control_defs)
+
+    def compile(self, control_defs: list[ControlDef]):
+        """
+        Compile the control defs, call this whenever the defs are reloaded
+        :param control_defs:
+        :return:
+        """
+        signs = list()
+        for control_def in control_defs:
+            if control_def.get_threshold_type() is ThresholdType.OVERSHOOT:
+                signs.append(1.0)
+            elif control_def.get_threshold_type() is ThresholdType.UNDERSHOOT:
+                signs.append(-1.0)
+            else:
+                signs.append(0.0)
+
+        self._thresholds = np.array([control_def.get_threshold_value() for control_def in control_defs],
+                                    dtype=np.float64)
+        hystereses = np.array([control_def.get_hysteresis() for control_def in control_defs], dtype=np.float64)
+        # the back to normal points for overshoot and undershoot defs
+        self._lower_normal = self._thresholds - hystereses
+        self._upper_normal = self._thresholds + hystereses
+        self._signs = np.array(signs, dtype=np.float64)
+        self._positions = {id(control_def): position for position, control_def in enumerate(control_defs)}
+        self._index.rebuild(control_defs)
+        if self._owns_sensor_windows is True:
+            self._sensor_windows.compile(control_defs)
+        self._control_defs = control_defs
+
+    def evaluate(self, sensor_messages: list[SensorMessageItem],
+                 on_reading: Callable[[int], None] = None) -> BatchEvaluation:
+        """
+        Evaluate a batch of sensor messages
+        :param sensor_messages:
+        :param on_reading: see evaluate_arrays
+        :return:
+        """
+        return self.evaluate_arrays([sensor_message.get_mac() for sensor_message in sensor_messages],
+                                    [sensor_message.get_type() for sensor_message in sensor_messages],
+                                    np.fromiter((sensor_message.get_data() for sensor_message in sensor_messages),
+                                                dtype=np.float64, count=len(sensor_messages)),
+                                    [sensor_message.get_timestamp() for sensor_message in sensor_messages], on_reading)
+
+    def evaluate_batch(self, batch: SensorMessageBatch) -> BatchEvaluation:
+        """
+        Evaluate a columnar batch of readings
+        :param batch:
+        :return:
+        """
+        return self.evaluate_arrays(batch.get_macs(), batch.get_types(),
+                                    np.frombuffer(batch.get_data(), dtype=np.float64), batch.get_timestamps())
+
+    def evaluate_arrays(self, macs, sensor_types, data: np.ndarray, timestamps=None,
+                        on_reading: Callable[[int], None] = None) -> BatchEvaluation:
+        """
+        Pair each reading with its matching defs through the dispatch index, then evaluate all the pairs at once
+        :param macs:
+        :param sensor_types:
+        :param data:
+        :param timestamps: needed when a def has an aggregate func
+        :param on_reading: called with the position of each reading once it is in the windows, before the
+        next reading is, for whatever else reads the windows in reading order (the control rules)
+        :return:
+        """
+        message_positions = list()
+        def_positions = list()
+        matched_defs = list()
+        positions = self._positions
+        # (pair position, window value) of the pairs whose def is evaluated on a rolling window
+        window_values = list()
+        sensor_windows = self._sensor_windows if self._sensor_windows.has_windows() else None
+
+        for message_position, (mac, sensor_type) in enumerate(zip(macs, sensor_types)):
+            if sensor_windows is not None:
+                sensor_windows.update(mac, sensor_type, timestamps[message_position], float(data[message_position]))
+            if on_reading is not None:
+                on_reading(message_position)
+            for control_def in self._index.get_matching_defs(mac, sensor_type):
+                if (sensor_windows is not None) and (control_def.get_aggregate_func() is not AggregateFunc.RAW):
+                    window_values.append((len(matched_defs), sensor_windows.get_value(mac, sensor_type, control_def)))
+                message_positions.append(message_position)
+                def_positions.append(positions[id(control_def)])
+                matched_defs.append(control_def)
+
+        message_positions = np.array(message_positions, dtype=np.int64)
+        def_positions = np.array(def_positions, dtype=np.int64)
+
+        values = data[message_positions]
+        if len(window_values) > 0:
+            # a window without a value yet leaves its pair out, like the per message path does
+            filled = [(position, value) for position, value in window_values if value is not None]
+            if len(filled) > 0:
+                values[[position for position, _ in filled]] = [value for _, value in filled]
+            empty = [position for position, value in window_values if value is None]
+            if len(empty) > 0:
+                keep = np.ones(len(matched_defs), dtype=bool)
+                keep[empty] = False
+                message_positions = message_positions[keep]
+                def_positions = def_positions[keep]
+                values = values[keep]
+                matched_defs = [control_def for control_def, kept in zip(matched_defs, keep.tolist()) if kept]
+
+        thresholds = self._thresholds[def_positions]
+        signs = self._signs[def_positions]
+        overshoot = signs > 0
+        undershoot = signs < 0
+
+        exceeded = (overshoot & (values > thresholds)) | (undershoot & (values < thresholds))
+        hysteresis_passed = ((overshoot & (values < self._lower_normal[def_positions])) |
+                             (undershoot & (values > self._upper_normal[def_positions])))
+
+        return BatchEvaluation(message_positions, matched_defs, exceeded, hysteresis_passed)
@@ -0,0 +1,632 @@
+"""
+Micro benchmarks for the control pipeline hot paths, separately and end to end, against a FakeRedis
+and a MockRelayController
+
+Run from the project folder:
+``python benchmark.py``
+
+Save the results as JSON, and compare a later run against them to spot regressions between commits:
+``python benchmark.py --json before.json``
+``python benchmark.py --json after.json --compare before.json``
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import platform
+import queue
+import random
+import subprocess
+import threading
+import time
+import tracemalloc
+import uuid
+from multiprocessing import Event, Queue
+from types import SimpleNamespace
+
+import jsonpickle
+
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+from bang_bang_controller import BangBangController
+from batch_evaluator import ControlDefBatchEvaluator
+from control_defs import ControlDef, ControlDefIndex, ThresholdType, ControlFunc
+from control_trigger_store import ControlTrigger, ControlTriggerStore
+from fake_redis import FakeRedis
+from mock_relay_controller import MockRelayController
+from redis_monitor import RedisMonitor
+from sensor_message_codec import SensorMessageCodec
+from sensor_message_item import SensorMessageItem, SensorMessageBatch
+
+# sensor types that the generated defs and messages pick from
+SENSOR_TYPES = [248, 531, 532, 533, 534, 535]
+
+
+def generate_control_defs(n_defs: int, n_macs: int, seed: int = 42) -> list[ControlDef]:
+    """
+    Generate a set of control defs spread over n_macs macs
+    :param n_defs:
+    :param n_macs:
+    :param seed:
+    :return:
+    """
+    rnd = random.Random(seed)
+    control_defs = list()
+    for i in range(n_defs):
+        control_defs.append(ControlDef(
+            uuid=str(uuid.UUID(int=rnd.getrandbits(128))),
+            macs={rnd.randrange(n_macs) for _ in range(2)},
+            sensor_types=rnd.sample(SENSOR_TYPES, 2),
+            threshold_value=25.0,
+            hysteresis=1.5,
+            threshold_type=ThresholdType.OVERSHOOT,
+            threshold_duration_millis=60000,
+            control_func=ControlFunc.ON,
+            control_channel=WaveshareDef.from_channel_def((i % 8) + 1),
+            back_to_normal_func=ControlFunc.OFF,
+            allow_back_to_normal=True,
+            fuzz_ms=500
+        ))
+    return control_defs
+
+
+def generate_sensor_messages(n_messages: int, n_macs: int, seed: int = 42) -> list[SensorMessageItem]:
+    """
+    Generate n_messages sensor messages for n_macs macs
+    :param n_messages:
+    :param n_macs:
+    :param seed:
+    :return:
+    """
+    rnd = random.Random(seed)
+    return [SensorMessageItem(rnd.randrange(n_macs), rnd.choice(SENSOR_TYPES), rnd.uniform(20.0, 30.0), i * 1000)
+            for i in range(n_messages)]
+
+
+def bench_dispatch(n_defs: int, n_messages: int = 20000, n_macs: int = 500) -> tuple[float, float]:
+    """
+    Compare the cost per message of the linear control def scan against the dispatch index
+    :param n_defs:
+    :param n_messages:
+    :param n_macs:
+    :return: (linear scan ns/message, index ns/message)
+    """
+    control_defs = generate_control_defs(n_defs, n_macs)
+    sensor_messages = generate_sensor_messages(n_messages, n_macs)
+    index = ControlDefIndex(control_defs)
+
+    n_linear = 0
+    start = time.perf_counter()
+    for sensor_message in sensor_messages:
+        for control_def in control_defs:
+            if (sensor_message.get_mac() in control_def.get_macs()) and (
+                    sensor_message.get_type() in control_def.get_sensor_types()):
+                n_linear += 1
+    linear_ns = (time.perf_counter() - start) * 1e9 / n_messages
+
+    n_indexed = 0
+    start = time.perf_counter()
+    for sensor_message in sensor_messages:
+        for _ in index.get_matching_defs(sensor_message.get_mac(), sensor_message.get_type()):
+            n_indexed += 1
+    index_ns = (time.perf_counter() - start) * 1e9 / n_messages
+
+    if n_linear != n_indexed:
+        raise RuntimeError("Dispatch index matched {} defs, linear scan matched {}".format(n_indexed, n_linear))
+
+    return linear_ns, index_ns
+
+
+def make_fake_redis_monitor(n_macs: int, round_trip_ms: float, encode=jsonpickle.encode) -> RedisMonitor:
+    """
+    Build a RedisMonitor against a FakeRedis that holds a cached message for every mac and sensor type
+    :param n_macs:
+    :param round_trip_ms:
+    :param encode: how the messages are serialized in the cache
+    :return:
+    """
+    fake_redis = FakeRedis(round_trip_ms=round_trip_ms)
+    for mac in range(n_macs):
+        for i, sensor_type in enumerate(SENSOR_TYPES):
+            sensor_message = SensorMessageItem(mac, sensor_type, 20.0 + i, 1700000000000)
+            fake_redis.hset(str(mac), str(sensor_type), encode(sensor_message))
+
+    control_defs = generate_control_defs(n_macs, n_macs)
+    return RedisMonitor(Queue(), Event(), redis_client=fake_redis, control_defs=control_defs)
+
+
+def bench_redis_fetch(n_macs: int, round_trip_ms: float = 0.2, chunk_size: int = 100) -> tuple[float, float]:
+    """
+    Compare the per cycle latency of the one round trip per mac fetch and the pipelined bulk fetch
+    :param n_macs:
+    :param round_trip_ms: simulated network round trip to the cache
+    :param chunk_size:
+    :return: (single fetch ms/cycle, bulk fetch ms/cycle)
+    """
+    redis_monitor = make_fake_redis_monitor(n_macs, round_trip_ms)
+
+    redis_monitor.bulk_fetch = False
+    redis_monitor.fetch_redis_messages()
+    single_ms = redis_monitor.last_fetch_latency_ms
+
+    redis_monitor.bulk_fetch = True
+    redis_monitor.bulk_fetch_chunk_size = chunk_size
+    redis_monitor.fetch_redis_messages()
+    bulk_ms = redis_monitor.last_fetch_latency_ms
+
+    return single_ms, bulk_ms
+
+
+def run_shard_throughput(shard_id: int, n_shards: int, n_macs: int, n_cycles: int) -> tuple[int, float]:
+    """
+    One shard worker: fetch its shard of the cache, deduplicate, and evaluate every message, n_cycles times
+    :param shard_id:
+    :param n_shards:
+    :param n_macs:
+    :param n_cycles:
+    :return: (messages processed, seconds)
+    """
+    fake_redis = FakeRedis()
+    for mac in range(n_macs):
+        for i, sensor_type in enumerate(SENSOR_TYPES):
+            sensor_message = SensorMessageItem(mac, sensor_type, 20.0 + i, 1700000000000)
+            fake_redis.hset(str(mac), str(sensor_type), jsonpickle.encode(sensor_message))
+
+    control_defs = generate_control_defs(n_macs * 4, n_macs)
+    message_queue = queue.Queue()
+    redis_monitor = RedisMonitor(message_queue, Event(), redis_client=fake_redis, control_defs=control_defs,
+                                 shard=(shard_id, n_shards))
+    redis_monitor.bulk_fetch = True
+    controller = BangBangController(message_queue, Event(), relay_controller=MockRelayController(),
+                                    control_defs=control_defs, report_to_api=False, control_state_file="")
+
+    n_processed = 0
+    start = time.perf_counter()
+    for _ in range(n_cycles):
+        # every reading counts as new, so each cycle does the full decode and evaluation work
+        redis_monitor.last_sensor_messages.clear()
+        redis_monitor.fetch_redis_messages()
+        redis_monitor.inject_messages()
+        sensor_messages = controller.drain_message_queue(0)
+        controller.process_messages(sensor_messages)
+        n_processed += len(sensor_messages)
+
+    return n_processed, time.perf_counter() - start
+
+
+def bench_sharding(n_shards: int, n_macs: int = 2000, n_cycles: int = 5) -> float:
+    """
+    Aggregate throughput of the sharded runtime's per shard work, with the macs split across n_shards processes
+    :param n_shards:
+    :param n_macs:
+    :param n_cycles:
+    :return: messages/sec
+    """
+    with multiprocessing.Pool(n_shards) as pool:
+        results = pool.starmap(run_shard_throughput,
+                               [(shard_id, n_shards, n_macs, n_cycles) for shard_id in range(n_shards)])
+
+    n_processed = sum(n for n, _ in results)
+    # the shards run in parallel, the slowest one sets the pace
+    return n_processed / max(seconds for _, seconds in results)
+
+
+def bench_decode(n_payloads: int = 20000) -> dict[str, float]:
+    """
+    Compare decode throughput of jsonpickle and SensorMessageCodec on a batch of cached payloads
+    :param n_payloads:
+    :return: messages per second for each decoder / wire format
+    """
+    sensor_messages = generate_sensor_messages(n_payloads, 500)
+    jsonpickle_payloads = [jsonpickle.encode(sensor_message) for sensor_message in sensor_messages]
+    compact_payloads = [SensorMessageCodec.encode_compact(sensor_message) for sensor_message in sensor_messages]
+
+    results = dict()
+    for name, decode, payloads in [("jsonpickle.decode", jsonpickle.decode, jsonpickle_payloads),
+                                   ("codec (jsonpickle format)", SensorMessageCodec.decode, jsonpickle_payloads),
+                                   ("codec (compact format)", SensorMessageCodec.decode, compact_payloads)]:
+        start = time.perf_counter()
+        for payload in payloads:
+            decode(payload)
+        results[name] = n_payloads / (time.perf_counter() - start)
+
+    return results
+
+
+def bench_fetch_decode(n_macs: int, n_cycles: int = 5) -> dict[str, float]:
+    """
+    Cost of a whole fetch_redis_messages cycle (bulk fetch, decode and deduplication) with no network
+    round trip, so the decoding dominates, for each cached message format
+    :param n_macs:
+    :param n_cycles:
+    :return: ms/cycle for each format
+    """
+    results = dict()
+    for name, encode in [("jsonpickle", jsonpickle.encode), ("compact", SensorMessageCodec.encode_compact)]:
+        redis_monitor = make_fake_redis_monitor(n_macs, 0.0, encode=encode)
+        redis_monitor.bulk_fetch = True
+
+        start = time.perf_counter()
+        for _ in range(n_cycles):
+            redis_monitor.fetch_redis_messages()
+        results[name] = (time.perf_counter() - start) * 1000.0 / n_cycles
+
+    return results
+
+
+def bench_deduplicate(n_macs: int = 500, n_cycles: int = 20) -> tuple[float, float]:
+    """
+    ns per message of deduplicate_sensor_messages, when every reading is new and when none has advanced
+    :param n_macs:
+    :param n_cycles:
+    :return: (new readings ns/msg, unchanged readings ns/msg)
+    """
+    redis_monitor = make_fake_redis_monitor(1, 0.0)
+    cycles = [[SensorMessageItem(mac, sensor_type, 25.0, 1700000000000 + cycle * 1000)
+               for mac in range(n_macs) for sensor_type in SENSOR_TYPES] for cycle in range(n_cycles)]
+    n_messages = n_cycles * n_macs * len(SENSOR_TYPES)
+
+    start = time.perf_counter()
+    for sensor_messages in cycles:
+        redis_monitor.deduplicate_sensor_messages(sensor_messages)
+    new_ns = (time.perf_counter() - start) * 1e9 / n_messages
+
+    start = time.perf_counter()
+    for _ in range(n_cycles):
+        redis_monitor.deduplicate_sensor_messages(cycles[-1])
+    unchanged_ns = (time.perf_counter() - start) * 1e9 / n_messages
+
+    return new_ns, unchanged_ns
+
+
+def bench_process_message(n_defs: int, n_messages: int = 20000, n_macs: int = 500) -> float:
+    """
+    ns per message through BangBangController.process_message: dispatch, threshold checks,
+    control triggers and relay commands on a MockRelayController
+    :param n_defs:
+    :param n_messages:
+    :param n_macs:
+    :return:
+    """
+    controller = BangBangController(queue.Queue(), threading.Event(), relay_controller=MockRelayController(),
+                                    control_defs=generate_control_defs(n_defs, n_macs), report_to_api=False,
+                                    control_state_file="")
+    sensor_messages = generate_sensor_messages(n_messages, n_macs)
+
+    start = time.perf_counter()
+    for sensor_message in sensor_messages:
+        controller.process_message(sensor_message)
+    return (time.perf_counter() - start) * 1e9 / n_messages
+
+
+def bench_trigger_store_churn(n_keys: int = 10000, n_ops: int = 200000) -> float:
+    """
+    Control trigger store operations per second under the controller's access pattern: create, refresh,
+    execute, return to normal and expire, spread over n_keys keys
+    :param n_keys:
+    :param n_ops:
+    :return: ops/s
+    """
+    rnd = random.Random(42)
+    store = ControlTriggerStore()
+    keys = ["{}-248-{}".format(i, i % 8) for i in range(n_keys)]
+    ops = [(rnd.choice(keys), rnd.random()) for _ in range(n_ops)]
+
+    start = time.perf_counter()
+    for now_ms, (key, action) in enumerate(ops):
+        control_trigger = store.get(key, None)
+        if control_trigger is None:
+            store[key] = ControlTrigger(now_ms, now_ms + 5000, 26.0)
+        elif action < 0.5:
+            if control_trigger.get_control_func_execution_time_ms() is None:
+                store.refresh_expiry(key, now_ms + 5000)
+        elif action < 0.7:
+            control_trigger.set_control_func_execution_time_ms(now_ms)
+        else:
+            store.pop(key)
+        if (now_ms % 100) == 0:
+            store.expire(now_ms)
+    return n_ops / (time.perf_counter() - start)
+
+
+def bench_queue_handoff(message_queue, n_messages: int = 50000) -> float:
+    """
+    Messages per second handed from a producer thread (inject_messages) to the controller thread
+    (drain_message_queue) through message_queue
+    :param message_queue:
+    :param n_messages:
+    :return: msg/s
+    """
+    controller = BangBangController(message_queue, threading.Event(), relay_controller=MockRelayController(),
+                                    control_defs=list(), report_to_api=False, control_state_file="")
+    sensor_messages = generate_sensor_messages(n_messages, 500)
+
+    def produce():
+        for sensor_message in sensor_messages:
+            message_queue.put(sensor_message)
+
+    producer = threading.Thread(target=produce)
+    n_received = 0
+    start = time.perf_counter()
+    producer.start()
+    while n_received < n_messages:
+        n_received += len(controller.drain_message_queue(1.0))
+    elapsed_s = time.perf_counter() - start
+    producer.join()
+
+    return n_messages / elapsed_s
+
+
+def bench_message_memory(n_messages: int = 100000) -> dict[str, float]:
+    """
+    Bytes per tracked reading held as SensorMessageItems and as a SensorMessageBatch
+    :param n_messages:
+    :return:
+    """
+    results = dict()
+
+    tracemalloc.start()
+    start_bytes = tracemalloc.get_traced_memory()[0]
+    sensor_messages = generate_sensor_messages(n_messages, 500)
+    results["SensorMessageItem"] = (tracemalloc.get_traced_memory()[0] - start_bytes) / n_messages
+
+    start_bytes = tracemalloc.get_traced_memory()[0]
+    batch = SensorMessageBatch.from_items(sensor_messages)
+    results["SensorMessageBatch"] = (tracemalloc.get_traced_memory()[0] - start_bytes) / len(batch)
+    tracemalloc.stop()
+
+    return results
+
+
+def bench_message_access(n_messages: int = 100000) -> float:
+    """
+    ns per round of the getters process_message, exceeded_threshold and check_hysteresis call
+    :param n_messages:
+    :return:
+    """
+    sensor_messages = generate_sensor_messages(n_messages, 500)
+    start = time.perf_counter()
+    for sensor_message in sensor_messages:
+        sensor_message.get_mac()
+        sensor_message.get_type()
+        sensor_message.get_data()
+        sensor_message.get_timestamp()
+    return (time.perf_counter() - start) * 1e9 / n_messages
+
+
+def bench_evaluation(n_defs: int, n_messages: int = 20000, n_macs: int = 500) -> tuple[float, float]:
+    """
+    Compare exceeded_threshold / check_hysteresis one message and one def at a time
+    against the vectorized batch evaluator
+    :param n_defs:
+    :param n_messages:
+    :param n_macs:
+    :return: (per message ns/msg, batch ns/msg)
+    """
+    control_defs = generate_control_defs(n_defs, n_macs)
+    sensor_messages = generate_sensor_messages(n_messages, n_macs)
+    index = ControlDefIndex(control_defs)
+    controller = SimpleNamespace(logger=logging.getLogger(__name__))
+
+    start = time.perf_counter()
+    for sensor_message in sensor_messages:
+        for control_def in index.get_matching_defs(sensor_message.get_mac(), sensor_message.get_type()):
+            BangBangController.exceeded_threshold(controller, sensor_message, control_def)
+            BangBangController.check_hysteresis(controller, sensor_message, control_def)
+    per_message_ns = (time.perf_counter() - start) * 1e9 / n_messages
+
+    evaluator = ControlDefBatchEvaluator(control_defs)
+    start = time.perf_counter()
+    for _ in evaluator.evaluate(sensor_messages):
+        pass
+    batch_ns = (time.perf_counter() - start) * 1e9 / n_messages
+
+    return per_message_ns, batch_ns
+
+
+class TimedBangBangController(BangBangController):
+    """
+    Records how long each message waited between being queued and being processed
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TimedBangBangController, self).__init__(*args, **kwargs)
+        self.latencies_ms: list[float] = list()
+
+    def process_messages(self, sensor_messages: list[SensorMessageItem]):
+        now = time.perf_counter()
+        for sensor_message in sensor_messages:
+            # the benchmark puts perf_counter() in the payload when queuing the message
+            self.latencies_ms.append((now - sensor_message.get_data()) * 1000.0)
+        super(TimedBangBangController, self).process_messages(sensor_messages)
+
+
+def bench_run_loop(blocking_queue: bool, thread_sleep: bool, n_messages: int = 20,
+                   interval_s: float = 0.05, idle_s: float = 1.0) -> tuple[float, float]:
+    """
+    Run the controller loop on its own thread, feed it messages at interval_s and then leave it idle
+    :param blocking_queue: the blocking, deadline driven loop or the polling loop
+    :param thread_sleep: for the polling loop, sleep cache_fetch_interval_ms between passes
+    :param n_messages:
+    :param interval_s:
+    :param idle_s:
+    :return: (mean queue to processing latency ms, process CPU % while idle)
+    """
+    message_queue = queue.Queue()
+    sig_event = threading.Event()
+    controller = TimedBangBangController(message_queue, sig_event, relay_controller=MockRelayController(),
+                                         control_defs=generate_control_defs(10, 10), api_writer=object(),
+                                         control_state_file="")
+    controller.blocking_queue = blocking_queue
+    controller.thread_sleep = thread_sleep
+    controller.cache_fetch_interval_ms = 3000
+    # no API updates during the benchmark
+    controller.last_api_update_time = int(time.time() * 1000) + 3600000
+    controller.start()
+
+    for i in range(n_messages):
+        message_queue.put(SensorMessageItem(1000 + i, 999, time.perf_counter(), i))
+        time.sleep(interval_s)
+
+    cpu_start = time.process_time()
+    time.sleep(idle_s)
+    idle_cpu = (time.process_time() - cpu_start) / idle_s * 100.0
+
+    # wait out a sleeping polling loop so the last messages get processed
+    while len(controller.latencies_ms) < n_messages:
+        time.sleep(0.05)
+    sig_event.set()
+    controller.join()
+
+    return sum(controller.latencies_ms) / len(controller.latencies_ms), idle_cpu
+
+
+def get_run_info() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except Exception:
+        commit = None
+
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": int(time.time() * 1000)
+    }
+
+
+def is_higher_better(name: str) -> bool:
+    # throughputs are per second, everything else is a time or a size
+    return name.endswith("_per_s")
+
+
+def compare_results(results: dict[str, float], baseline: dict[str, float], tolerance_pct: float):
+    """
+    Print the change of every result against a baseline run, flagging the ones worse than tolerance_pct
+    :param results:
+    :param baseline:
+    :param tolerance_pct:
+    :return: the names of the regressed results
+    """
+    regressions = list()
+    print("{:>48} {:>14} {:>14} {:>9}".format("result", "baseline", "current", "change"))
+    for name, value in results.items():
+        if name not in baseline:
+            continue
+        baseline_value = baseline[name]
+        change_pct = 0.0 if baseline_value == 0 else (value - baseline_value) / baseline_value * 100.0
+        worse_pct = -change_pct if is_higher_better(name) else change_pct
+        flag = ""
+        if worse_pct > tolerance_pct:
+            flag = " REGRESSED"
+            regressions.append(name)
+        print("{:>48} {:>14.1f} {:>14.1f} {:>+8.1f}%{}".format(name, baseline_value, value, change_pct, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Control pipeline benchmarks")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="compare against the results file of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=10.0, help="percent change flagged as a regression")
+    args = parser.parse_args()
+
+    # result name -> value, names end in their unit, *_per_s results are better higher, the rest lower
+    results: dict[str, float] = dict()
+
+    print("{:>24} {:>16} {:>16}".format("run loop", "latency ms", "idle cpu %"))
+    for name, blocking_queue, thread_sleep in [("polling, no sleep", False, False),
+                                               ("polling, sleep", False, True),
+                                               ("blocking queue", True, False)]:
+        latency_ms, idle_cpu = bench_run_loop(blocking_queue, thread_sleep)
+        print("{:>24} {:>16.2f} {:>16.1f}".format(name, latency_ms, idle_cpu))
+        key = name.replace(", ", "_").replace(" ", "_")
+        results["run_loop.{}.latency_ms".format(key)] = latency_ms
+        results["run_loop.{}.idle_cpu_pct".format(key)] = idle_cpu
+
+    print("{:>24} {:>16}".format("queue handoff", "msg/s"))
+    for name, message_queue in [("queue.Queue", queue.Queue()), ("multiprocessing.Queue", Queue())]:
+        msgs_per_sec = bench_queue_handoff(message_queue)
+        print("{:>24} {:>16.0f}".format(name, msgs_per_sec))
+        results["queue_handoff.{}.msg_per_s".format(name)] = msgs_per_sec
+
+    print("{:>8} {:>16}".format("n_defs", "process ns/msg"))
+    for n_defs in [10, 100, 10000]:
+        process_ns = bench_process_message(n_defs)
+        print("{:>8} {:>16.0f}".format(n_defs, process_ns))
+        results["process_message.{}_defs.ns".format(n_defs)] = process_ns
+
+    trigger_ops_per_sec = bench_trigger_store_churn()
+    print("{:>28} {:>12.0f} ops/s".format("trigger store churn", trigger_ops_per_sec))
+    results["trigger_store_churn.ops_per_s"] = trigger_ops_per_sec
+
+    new_ns, unchanged_ns = bench_deduplicate()
+    print("{:>28} {:>12.0f} ns/message".format("dedup, new readings", new_ns))
+    print("{:>28} {:>12.0f} ns/message".format("dedup, unchanged readings", unchanged_ns))
+    results["deduplicate.new.ns"] = new_ns
+    results["deduplicate.unchanged.ns"] = unchanged_ns
+
+    print("{:>8} {:>16} {:>16}".format("n_defs", "per msg ns/msg", "batch ns/msg"))
+    for n_defs in [10, 1000, 10000]:
+        per_message_ns, batch_ns = bench_evaluation(n_defs)
+        print("{:>8} {:>16.0f} {:>16.0f}".format(n_defs, per_message_ns, batch_ns))
+        results["evaluation.{}_defs.per_message.ns".format(n_defs)] = per_message_ns
+        results["evaluation.{}_defs.batch.ns".format(n_defs)] = batch_ns
+
+    for name, bytes_per_message in bench_message_memory().items():
+        print("{:>28} {:>12.0f} bytes/reading".format(name, bytes_per_message))
+        results["message_memory.{}.bytes".format(name)] = bytes_per_message
+    access_ns = bench_message_access()
+    print("{:>28} {:>12.0f} ns/message".format("getter access", access_ns))
+    results["message_access.ns"] = access_ns
+
+    for name, msgs_per_sec in bench_decode().items():
+        print("{:>28} {:>12.0f} msg/s".format(name, msgs_per_sec))
+        results["decode.{}.msg_per_s".format(name)] = msgs_per_sec
+
+    print("{:>8} {:>16} {:>16}".format("n_macs", "jsonpickle ms", "compact ms"))
+    for n_macs in [100, 1000]:
+        fetch_ms = bench_fetch_decode(n_macs)
+        print("{:>8} {:>16.1f} {:>16.1f}".format(n_macs, fetch_ms["jsonpickle"], fetch_ms["compact"]))
+        for name, cycle_ms in fetch_ms.items():
+            results["fetch_decode.{}_macs.{}.ms".format(n_macs, name)] = cycle_ms
+
+    print("{:>8} {:>16} {:>16}".format("n_macs", "single ms/cycle", "bulk ms/cycle"))
+    for n_macs in [10, 100, 500]:
+        single_ms, bulk_ms = bench_redis_fetch(n_macs)
+        print("{:>8} {:>16.1f} {:>16.1f}".format(n_macs, single_ms, bulk_ms))
+        results["redis_fetch.{}_macs.single.ms".format(n_macs)] = single_ms
+        results["redis_fetch.{}_macs.bulk.ms".format(n_macs)] = bulk_ms
+
+    print("{:>8} {:>16} {:>16}".format("n_defs", "scan ns/msg", "index ns/msg"))
+    for n_defs in [10, 100, 1000, 5000]:
+        # keep the total work roughly constant for the slow linear scan
+        n_messages = min(20000, max(200, 2000000 // n_defs))
+        linear_ns, index_ns = bench_dispatch(n_defs, n_messages=n_messages)
+        print("{:>8} {:>16.0f} {:>16.0f}".format(n_defs, linear_ns, index_ns))
+        results["dispatch.{}_defs.scan.ns".format(n_defs)] = linear_ns
+        results["dispatch.{}_defs.index.ns".format(n_defs)] = index_ns
+
+    print("{:>8} {:>16}".format("n_shards", "msg/s"))
+    for n_shards in [1, 2, 4, 8]:
+        if n_shards > multiprocessing.cpu_count():
+            break
+        msgs_per_sec = bench_sharding(n_shards)
+        print("{:>8} {:>16.0f}".format(n_shards, msgs_per_sec))
+        results["sharding.{}_shards.msg_per_s".format(n_shards)] = msgs_per_sec
+
+    if args.json is not None:
+        with open(args.json, "w") as results_file:
+            json.dump({"run": get_run_info(), "results": results}, results_file, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print("Compared against {}".format(baseline["run"]))
+        regressions = compare_results(results, baseline["results"], args.tolerance)
+        if len(regressions) > 0:
+            print("{} results regressed by more than {}%".format(len(regressions), args.tolerance))
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
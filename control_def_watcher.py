@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+from threading import Lock
+
+from control_defs import ControlDef, ControlDefUtils
+
+
+class ControlDefWatcher:
+    """
+    Watches the control defs file and reloads it when it changes (mtime) or when a reload is requested
+    (backend_daemon requests one on SIGHUP)
+
+    One watcher is shared by the RedisMonitor and BangBangController threads. Each reload publishes
+    the new defs together with a generation number in a single assignment, the threads compare the
+    generation with the one they last applied and swap in the new defs (and their derived observables
+    or dispatch index) on their own side.
+
+    Reloads are incremental: each def is keyed by its canonical JSON text, so only the defs that were
+    added or edited are parsed again, unchanged defs keep their ControlDef object.
+    """
+
+    def __init__(self, control_defs_file: str):
+        self.logger = logging.getLogger(__name__)
+
+        self._control_defs_file = control_defs_file
+        self._lock = Lock()
+        self._reload_requested = False
+        self._last_mtime_ns = None
+        self._parsed_defs: dict[str, ControlDef] = dict()
+
+        # (generation, control defs)
+        self._published: tuple[int, list[ControlDef]] = (0, list())
+
+        self.reload()
+
+    def get_control_defs(self) -> tuple[int, list[ControlDef]]:
+        """
+        :return: (generation, control defs)
+        """
+        return self._published
+
+    def get_generation(self) -> int:
+        return self._published[0]
+
+    def request_reload(self):
+        """
+        Ask for a reload on the next check_for_changes, safe to call from a signal handler
+        :return:
+        """
+        self._reload_requested = True
+
+    def get_mtime_ns(self) -> int | None:
+        try:
+            return os.stat(self._control_defs_file).st_mtime_ns
+        except OSError as e:
+            self.logger.error("Could not stat control defs file {}:{}".format(self._control_defs_file, e))
+            return None
+
+    def check_for_changes(self) -> bool:
+        """
+        Reload the control defs if a reload was requested or the file was modified
+        :return: True if new control defs were published
+        """
+        mtime_ns = self.get_mtime_ns()
+        if (self._reload_requested is False) and ((mtime_ns is None) or (mtime_ns == self._last_mtime_ns)):
+            return False
+
+        self._reload_requested = False
+        return self.reload()
+
+    def reload(self) -> bool:
+        """
+        Parse the control defs file, reusing the ControlDefs of unchanged defs
+        :return: True if new control defs were published
+        """
+        with self._lock:
+            self._last_mtime_ns = self.get_mtime_ns()
+
+            try:
+                with open(self._control_defs_file) as control_defs:
+                    file_contents = control_defs.read()
+                json_defs = json.loads(file_contents)
+
+                parsed_defs = dict()
+                control_defs = list()
+                n_parsed = 0
+                for json_def in json_defs:
+                    def_key = json.dumps(json_def, sort_keys=True)
+                    control_def = self._parsed_defs.get(def_key, None)
+                    if control_def is None:
+                        control_def = ControlDefUtils.parse_control_def(json_def)
+                        n_parsed += 1
+                    parsed_defs[def_key] = control_def
+                    control_defs.append(control_def)
+
+            except Exception as e:
+                # keep running on the defs we have rather than on a half edited file
+                self.logger.error("Error reloading control defs from {}, keeping the current defs:{}".format(
+                    self._control_defs_file, e))
+                return False
+
+            generation, current_defs = self._published
+            if (n_parsed == 0) and (len(control_defs) == len(current_defs)) and all(
+                    new_def is current_def for new_def, current_def in zip(control_defs, current_defs)):
+                self.logger.debug("Control defs file touched but no defs changed")
+                return False
+
+            self._parsed_defs = parsed_defs
+            self._published = (generation + 1, control_defs)
+            self.logger.info("Loaded control defs generation {}: {} defs, {} new or changed".format(
+                generation + 1, len(control_defs), n_parsed))
+            return True
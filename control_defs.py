@@ -1,7 +1,10 @@
-from enum import IntEnum
+from enum import Enum, IntEnum
 import json
 from WaveshareRelayControl.waveshare_defs import WaveshareDef
 
+# the board on RELAY_CONTROLLER.serial_port, the others are configured in [RELAY_BOARD <board_id>] sections
+DEFAULT_BOARD_ID = "default"
+
 
 class ThresholdType(IntEnum):
     OVERSHOOT = 1
@@ -31,6 +34,26 @@ class ControlFunc(IntEnum):
             return None
 
 
+class AggregateFunc(IntEnum):
+    """
+    What a control def compares against its threshold, the raw reading or a rolling window over the
+    readings of the mac and type (see window_operators)
+    """
+    RAW = 0
+    MOVING_AVERAGE = 1
+    EWMA = 2
+    MIN = 3
+    MAX = 4
+    RATE_OF_CHANGE = 5
+
+    @staticmethod
+    def from_int(aggregate_func: int):
+        try:
+            return AggregateFunc(aggregate_func)
+        except ValueError:
+            return None
+
+
 class ControlDef:
     """
     Contract for the Control Definition
@@ -46,7 +69,18 @@ class ControlDef:
     "control_channel": 1,
     "back_to_normal_func": 0,
     "allow_back_to_normal:True,
-    "fuzz_ms": 500
+    "fuzz_ms": 500,
+    "board_id": "default"  (optional, the relay board of the control channel)
+    "aggregate_func": 0  (optional, see AggregateFunc)
+    "aggregate_window_ms": 0  (optional, the window of the aggregate func)
+    "max_on_millis": 0  (optional, the longest the control func state is held, 0 for no limit)
+    "min_on_millis": 0  (optional, the shortest time in the control func state before returning to normal)
+    "min_off_millis": 0  (optional, the shortest time back to normal before executing the control func again)
+    "max_switches_per_hour": 0  (optional, relay channel switches per rolling hour, 0 for no limit)
+    "stale_timeout_millis": 0  (optional, how long a sensor may go without a reading before it is stale,
+        0 for the config's stale_sensor_timeout_ms)
+    "stale_func": 0  (optional, the failsafe control func when a sensor goes stale, without it the channel
+        returns to normal)
     """
 
     def __init__(self,
@@ -61,7 +95,16 @@ class ControlDef:
                  control_channel: WaveshareDef = None,
                  back_to_normal_func: ControlFunc = None,
                  allow_back_to_normal: bool = None,
-                 fuzz_ms: float = 0.0):
+                 fuzz_ms: float = 0.0,
+                 board_id: str = DEFAULT_BOARD_ID,
+                 aggregate_func: AggregateFunc = AggregateFunc.RAW,
+                 aggregate_window_ms: int = 0,
+                 max_on_millis: int = 0,
+                 min_on_millis: int = 0,
+                 min_off_millis: int = 0,
+                 max_switches_per_hour: int = 0,
+                 stale_timeout_millis: int = 0,
+                 stale_func: ControlFunc = None):
         self._uuid: str = uuid
 
         if macs is None:
@@ -79,6 +122,15 @@ class ControlDef:
         self._back_to_normal_func: ControlFunc = back_to_normal_func
         self._allow_back_to_normal = allow_back_to_normal
         self._fuzz_ms = fuzz_ms
+        self._board_id: str = board_id
+        self._aggregate_func: AggregateFunc = aggregate_func
+        self._aggregate_window_ms: int = aggregate_window_ms
+        self._max_on_millis: int = max_on_millis
+        self._min_on_millis: int = min_on_millis
+        self._min_off_millis: int = min_off_millis
+        self._max_switches_per_hour: int = max_switches_per_hour
+        self._stale_timeout_millis: int = stale_timeout_millis
+        self._stale_func: ControlFunc = stale_func
 
     def get_uuid(self) -> str:
         return self._uuid
@@ -152,6 +204,154 @@ class ControlDef:
     def get_fuzz_ms(self) -> float:
         return self._fuzz_ms
 
+    def set_board_id(self, board_id: str):
+        self._board_id = board_id
+
+    def get_board_id(self) -> str:
+        return self._board_id
+
+    def set_aggregate_func(self, aggregate_func: AggregateFunc):
+        self._aggregate_func = aggregate_func
+
+    def get_aggregate_func(self) -> AggregateFunc:
+        return self._aggregate_func
+
+    def set_aggregate_window_ms(self, aggregate_window_ms: int):
+        self._aggregate_window_ms = aggregate_window_ms
+
+    def get_aggregate_window_ms(self) -> int:
+        return self._aggregate_window_ms
+
+    def set_max_on_millis(self, max_on_millis: int):
+        self._max_on_millis = max_on_millis
+
+    def get_max_on_millis(self) -> int:
+        return self._max_on_millis
+
+    def set_min_on_millis(self, min_on_millis: int):
+        self._min_on_millis = min_on_millis
+
+    def get_min_on_millis(self) -> int:
+        return self._min_on_millis
+
+    def set_min_off_millis(self, min_off_millis: int):
+        self._min_off_millis = min_off_millis
+
+    def get_min_off_millis(self) -> int:
+        return self._min_off_millis
+
+    def set_max_switches_per_hour(self, max_switches_per_hour: int):
+        self._max_switches_per_hour = max_switches_per_hour
+
+    def get_max_switches_per_hour(self) -> int:
+        return self._max_switches_per_hour
+
+    def set_stale_timeout_millis(self, stale_timeout_millis: int):
+        self._stale_timeout_millis = stale_timeout_millis
+
+    def get_stale_timeout_millis(self) -> int:
+        return self._stale_timeout_millis
+
+    def set_stale_func(self, stale_func: ControlFunc):
+        self._stale_func = stale_func
+
+    def get_stale_func(self) -> ControlFunc | None:
+        return self._stale_func
+
+    def get_window_spec(self) -> tuple[AggregateFunc, int]:
+        """
+        The rolling window this def is evaluated on, defs with the same spec share the window of a mac and type
+        :return:
+        """
+        return self._aggregate_func, self._aggregate_window_ms
+
+
+class RuleOp(Enum):
+    ALL = "all"
+    ANY = "any"
+    K_OF_N = "k_of_n"
+
+    @staticmethod
+    def from_str(op: str):
+        try:
+            return RuleOp(op)
+        except ValueError:
+            return None
+
+
+class RuleCondition:
+    """
+    A node of a control rule's condition: all / any / k of n of its conditions, each either a nested
+    RuleCondition or a leaf predicate, a ControlDef of which only the mac, type, threshold and
+    aggregate fields are used
+    """
+
+    def __init__(self, op: RuleOp, conditions: list, k: int = None):
+        self._op = op
+        self._conditions: list[RuleCondition | ControlDef] = conditions
+        self._k = k
+
+    def get_op(self) -> RuleOp:
+        return self._op
+
+    def get_conditions(self) -> list:
+        return self._conditions
+
+    def get_n_required(self) -> int:
+        """
+        How many of the conditions have to hold for this one to hold
+        :return:
+        """
+        if self._op is RuleOp.ALL:
+            return len(self._conditions)
+        elif self._op is RuleOp.ANY:
+            return 1
+        return self._k
+
+    def get_leaves(self) -> list[ControlDef]:
+        leaves = list()
+        for condition in self._conditions:
+            if isinstance(condition, RuleCondition):
+                leaves.extend(condition.get_leaves())
+            else:
+                leaves.append(condition)
+        return leaves
+
+
+class ControlRule(ControlDef):
+    """
+    A control def whose threshold condition is a composite of conditions over several macs and types
+
+    "uuid": "9c1e3f4a-82ac-11ee-b962-0242ac120002",
+    "condition": {"op": "all", "conditions": [
+        {"macs": [303721692], "sensor_types": [248], "threshold_value": 25.0, "hysteresis": 0.5,
+         "threshold_type": 1},
+        {"op": "k_of_n", "k": 2, "conditions": [...]}]},
+    "threshold_duration_millis": 60000,
+    "control_func": 1,
+    "control_channel": 1,
+    "back_to_normal_func": 0,
+    "allow_back_to_normal": True,
+    "fuzz_ms": 500,
+    "board_id": "default"  (optional)
+    "max_on_millis", "min_on_millis", "min_off_millis", "max_switches_per_hour"  (optional, as for a ControlDef)
+    "stale_timeout_millis", "stale_func"  (optional, as for a ControlDef, they apply to every leaf's sensors)
+
+    Each leaf holds from a reading that exceeds its threshold until one passes its hysteresis check, the rule
+    executes its control func once the condition has held for threshold_duration_millis and its back to normal
+    func when the condition stops holding. The rule has no macs or sensor types of its own.
+    """
+
+    def __init__(self, condition: RuleCondition = None, **kwargs):
+        super(ControlRule, self).__init__(macs=set(), sensor_types=list(), **kwargs)
+        self._condition = condition
+
+    def get_condition(self) -> RuleCondition:
+        return self._condition
+
+    def get_leaves(self) -> list[ControlDef]:
+        return self._condition.get_leaves()
+
 
 class ControlDefUtils:
 
@@ -170,28 +370,150 @@ class ControlDefUtils:
 
         control_defs = json.loads(file_contents)
         for control_def in control_defs:
-
-            # force types for control def properties, so we don't end up with unintentional
-            # boolean or int comparisons with strings
-            cls_control_def = ControlDef(
-                uuid=control_def["uuid"],
-                macs=set(control_def["macs"]),
-                sensor_types=list(control_def["sensor_types"]),
-                threshold_value=float(control_def["threshold_value"]),
-                hysteresis=float(control_def["hysteresis"]),
-                threshold_type=ThresholdType.from_int((int(control_def["threshold_type"]))),
-                threshold_duration_millis=int(control_def["threshold_duration_millis"]),
-                control_func=ControlFunc.from_int(int(control_def["control_func"])),
-                control_channel=WaveshareDef.from_channel_def(int(control_def["control_channel"])),
-                back_to_normal_func=ControlFunc.from_int((int(control_def["back_to_normal_func"]))),
-                fuzz_ms=float(control_def["fuzz_ms"]),
-                allow_back_to_normal=bool(control_def["allow_back_to_normal"])
-            )
-
-            ret.append(cls_control_def)
+            ret.append(ControlDefUtils.parse_control_def(control_def))
 
         return ret
 
+    @staticmethod
+    def parse_control_def(control_def: dict) -> ControlDef:
+        """
+        Build a ControlDef from its JSON object, or a ControlRule if it has a condition
+        :param control_def:
+        :return:
+        """
+        if "condition" in control_def:
+            return ControlDefUtils.parse_control_rule(control_def)
+
+        # force types for control def properties, so we don't end up with unintentional
+        # boolean or int comparisons with strings
+        return ControlDef(
+            uuid=control_def["uuid"],
+            macs=set(control_def["macs"]),
+            sensor_types=list(control_def["sensor_types"]),
+            threshold_value=float(control_def["threshold_value"]),
+            hysteresis=float(control_def["hysteresis"]),
+            threshold_type=ThresholdType.from_int((int(control_def["threshold_type"]))),
+            threshold_duration_millis=int(control_def["threshold_duration_millis"]),
+            control_func=ControlFunc.from_int(int(control_def["control_func"])),
+            control_channel=WaveshareDef.from_channel_def(int(control_def["control_channel"])),
+            back_to_normal_func=ControlFunc.from_int((int(control_def["back_to_normal_func"]))),
+            fuzz_ms=float(control_def["fuzz_ms"]),
+            allow_back_to_normal=bool(control_def["allow_back_to_normal"]),
+            board_id=str(control_def.get("board_id", DEFAULT_BOARD_ID)),
+            aggregate_func=AggregateFunc.from_int(int(control_def.get("aggregate_func", AggregateFunc.RAW))),
+            aggregate_window_ms=int(control_def.get("aggregate_window_ms", 0)),
+            **ControlDefUtils.parse_cycle_limits(control_def),
+            **ControlDefUtils.parse_staleness(control_def)
+        )
+
+    @staticmethod
+    def parse_control_rule(control_rule: dict) -> ControlRule:
+        """
+        Build a ControlRule from its JSON object
+        :param control_rule:
+        :return:
+        """
+        condition = ControlDefUtils.parse_rule_condition(control_rule["condition"], control_rule["uuid"])
+        if not isinstance(condition, RuleCondition):
+            raise ValueError("The condition of control rule {} needs an op".format(control_rule["uuid"]))
+        return ControlRule(
+            condition=condition,
+            uuid=control_rule["uuid"],
+            threshold_duration_millis=int(control_rule["threshold_duration_millis"]),
+            control_func=ControlFunc.from_int(int(control_rule["control_func"])),
+            control_channel=WaveshareDef.from_channel_def(int(control_rule["control_channel"])),
+            back_to_normal_func=ControlFunc.from_int((int(control_rule["back_to_normal_func"]))),
+            fuzz_ms=float(control_rule["fuzz_ms"]),
+            allow_back_to_normal=bool(control_rule["allow_back_to_normal"]),
+            board_id=str(control_rule.get("board_id", DEFAULT_BOARD_ID)),
+            **ControlDefUtils.parse_cycle_limits(control_rule),
+            **ControlDefUtils.parse_staleness(control_rule)
+        )
+
+    @staticmethod
+    def parse_cycle_limits(control_def: dict) -> dict:
+        """
+        The optional relay cycle limits of a control def or rule, as ControlDef keyword arguments
+        :param control_def:
+        :return:
+        """
+        return {key: int(control_def.get(key, 0))
+                for key in ("max_on_millis", "min_on_millis", "min_off_millis", "max_switches_per_hour")}
+
+    @staticmethod
+    def parse_staleness(control_def: dict) -> dict:
+        """
+        The optional staleness timeout and failsafe control func of a control def or rule, as ControlDef
+        keyword arguments
+        :param control_def:
+        :return:
+        """
+        stale_func = None
+        if "stale_func" in control_def:
+            stale_func = ControlFunc.from_int(int(control_def["stale_func"]))
+        return {"stale_timeout_millis": int(control_def.get("stale_timeout_millis", 0)), "stale_func": stale_func}
+
+    @staticmethod
+    def parse_rule_condition(condition: dict, uuid: str) -> RuleCondition | ControlDef:
+        """
+        Build a rule condition, an object without an "op" is a leaf predicate
+        :param condition:
+        :param uuid: of the rule, the leaves carry it for logging
+        :return:
+        """
+        if "op" not in condition:
+            if len(condition["macs"]) == 0:
+                raise ValueError("The conditions of control rule {} need macs, they can't be wildcards".format(uuid))
+            return ControlDef(
+                uuid=uuid,
+                macs=set(condition["macs"]),
+                sensor_types=list(condition["sensor_types"]),
+                threshold_value=float(condition["threshold_value"]),
+                hysteresis=float(condition["hysteresis"]),
+                threshold_type=ThresholdType.from_int((int(condition["threshold_type"]))),
+                aggregate_func=AggregateFunc.from_int(int(condition.get("aggregate_func", AggregateFunc.RAW))),
+                aggregate_window_ms=int(condition.get("aggregate_window_ms", 0)))
+
+        op = RuleOp.from_str(str(condition["op"]))
+        if op is None:
+            raise ValueError("Invalid op {} in control rule {}".format(condition["op"], uuid))
+        conditions = [ControlDefUtils.parse_rule_condition(child, uuid) for child in condition["conditions"]]
+        if len(conditions) == 0:
+            raise ValueError("Empty {} condition in control rule {}".format(op.value, uuid))
+
+        k = None
+        if op is RuleOp.K_OF_N:
+            k = int(condition["k"])
+            if (k < 1) or (k > len(conditions)):
+                raise ValueError("k of {} out of range for {} conditions in control rule {}".format(
+                    k, len(conditions), uuid))
+        return RuleCondition(op, conditions, k)
+
+    @staticmethod
+    def split_control_rules(control_defs: list[ControlDef]) -> tuple[list[ControlDef], list[ControlRule]]:
+        """
+        :param control_defs:
+        :return: (the plain control defs, the control rules), each in load order
+        """
+        plain_defs = [control_def for control_def in control_defs if not isinstance(control_def, ControlRule)]
+        control_rules = [control_def for control_def in control_defs if isinstance(control_def, ControlRule)]
+        return plain_defs, control_rules
+
+    @staticmethod
+    def get_predicates(control_defs: list[ControlDef]) -> list[ControlDef]:
+        """
+        The plain control defs plus the leaf predicates of the control rules, everything that reads sensors
+        :param control_defs:
+        :return:
+        """
+        predicates = list()
+        for control_def in control_defs:
+            if isinstance(control_def, ControlRule):
+                predicates.extend(control_def.get_leaves())
+            else:
+                predicates.append(control_def)
+        return predicates
+
     @staticmethod
     def get_observables(control_defs: list[ControlDef]) -> dict[int, set]:
         """
@@ -199,10 +521,15 @@ class ControlDefUtils:
         :return:
         """
         observables_dict = dict()
+        wildcard_types = set()
 
-        for control_def in control_defs:
+        for control_def in ControlDefUtils.get_predicates(control_defs):
             macs = control_def.get_macs()
             sensor_types = control_def.get_sensor_types()
+            if len(macs) == 0:
+                # wildcard defs apply to every observed mac
+                wildcard_types.update(sensor_types)
+                continue
             for mac in macs:
                 mac_observable_set = observables_dict.get(mac)
                 if mac_observable_set is None:
@@ -211,4 +538,87 @@ class ControlDefUtils:
                 for sensor_type in sensor_types:
                     mac_observable_set.add(sensor_type)
 
+        for mac_observable_set in observables_dict.values():
+            mac_observable_set.update(wildcard_types)
+
         return observables_dict
+
+    @staticmethod
+    def get_shard_observables(observables: dict[int, set], shard_id: int, n_shards: int) -> dict[int, set]:
+        """
+        The part of the observables owned by one shard, macs are partitioned by mac % n_shards
+        :param observables:
+        :param shard_id:
+        :param n_shards:
+        :return:
+        """
+        return {mac: sensor_types for mac, sensor_types in observables.items() if (mac % n_shards) == shard_id}
+
+
+class ControlDefIndex:
+    """
+    Dispatch index for the control definitions, so that an incoming sensor message goes straight
+    to the defs that match it instead of scanning every def
+
+    Defs are keyed by (mac, sensor_type). Defs with an empty "macs" list are wildcard defs, they
+    apply to every mac reporting one of their sensor types and live in a per sensor type fallback bucket.
+    Each bucket keeps the defs in the order they were loaded, so the control logic executes in the
+    same order as a linear scan of the control defs file would.
+    """
+
+    def __init__(self, control_defs: list[ControlDef] = None):
+        # (exact buckets keyed by (mac, sensor_type), wildcard buckets keyed by sensor_type)
+        self._buckets: tuple[dict, dict] = (dict(), dict())
+        self._n_defs = 0
+
+        if control_defs is not None:
+            self.rebuild(control_defs)
+
+    def rebuild(self, control_defs: list[ControlDef]):
+        """
+        (Re)build the index from the loaded control defs, call this whenever the defs are reloaded
+        :param control_defs:
+        :return:
+        """
+        exact: dict[tuple[int, int], list[tuple[int, ControlDef]]] = dict()
+        wildcard: dict[int, list[tuple[int, ControlDef]]] = dict()
+
+        for position, control_def in enumerate(control_defs):
+            # a def may list the same type twice, only dispatch to it once per message
+            sensor_types = set(control_def.get_sensor_types())
+            macs = control_def.get_macs()
+            if len(macs) == 0:
+                for sensor_type in sensor_types:
+                    wildcard.setdefault(sensor_type, list()).append((position, control_def))
+                continue
+            for mac in macs:
+                for sensor_type in sensor_types:
+                    exact.setdefault((mac, sensor_type), list()).append((position, control_def))
+
+        # merge the wildcard defs into each exact bucket up front so a lookup is a single dict get
+        for (mac, sensor_type), bucket in exact.items():
+            bucket.extend(wildcard.get(sensor_type, list()))
+            bucket.sort(key=lambda entry: entry[0])
+
+        # swap in one go, readers only ever see a complete index
+        self._buckets = (
+            {key: tuple(control_def for _, control_def in bucket) for key, bucket in exact.items()},
+            {key: tuple(control_def for _, control_def in bucket) for key, bucket in wildcard.items()}
+        )
+        self._n_defs = len(control_defs)
+
+    def get_matching_defs(self, mac: int, sensor_type: int) -> tuple[ControlDef, ...]:
+        """
+        Return the control defs that match the mac and sensor type, in load order
+        :param mac:
+        :param sensor_type:
+        :return:
+        """
+        exact, wildcard = self._buckets
+        matching_defs = exact.get((mac, sensor_type), None)
+        if matching_defs is None:
+            return wildcard.get(sensor_type, ())
+        return matching_defs
+
+    def get_n_defs(self) -> int:
+        return self._n_defs
@@ -0,0 +1,200 @@
+"""
+Evaluates the control rules, the control defs whose condition combines several macs and types with
+all / any / k of n (see ControlRule)
+
+compile() flattens each rule's condition tree into arrays, one node per condition plus one slot per
+(leaf, mac, sensor type): the parent of every node and slot, how many of its children have to hold for a node
+to hold, and the current count and value of every node. A reading only touches the slots of its mac and type
+(found through a dependency index built at compile time), and a slot that changes walks its count change up
+the parent chain, stopping at the first node whose value doesn't change. So a reading costs the depth of the
+rules that depend on it, not the size of every rule. Rules are compiled only when the defs are reloaded,
+a rule whose ControlRule object survives the reload (its JSON didn't change) keeps its slot and node state.
+"""
+import logging
+from typing import Callable
+
+from control_defs import ControlDef, ControlRule, RuleCondition
+
+
+class CompiledRule:
+    """
+    The flat evaluation plan and the state of one control rule, node 0 is the rule's condition
+    """
+
+    __slots__ = ("rule", "node_parents", "node_required", "node_counts", "node_values", "slot_parents",
+                 "slot_values")
+
+    def __init__(self, rule: ControlRule):
+        self.rule = rule
+        self.node_parents: list[int] = list()
+        self.node_required: list[int] = list()
+        self.node_counts: list[int] = list()
+        self.node_values: list[bool] = list()
+        self.slot_parents: list[int] = list()
+        self.slot_values: list[bool] = list()
+
+    def get_value(self) -> bool:
+        return self.node_values[0]
+
+    def set_slot(self, slot: int, value: bool):
+        """
+        Set a slot and walk the change up to the rule's condition
+        :param slot:
+        :param value:
+        :return:
+        """
+        if self.slot_values[slot] == value:
+            return
+        self.slot_values[slot] = value
+
+        delta = 1 if value is True else -1
+        node = self.slot_parents[slot]
+        while node != -1:
+            self.node_counts[node] += delta
+            node_value = self.node_counts[node] >= self.node_required[node]
+            if node_value == self.node_values[node]:
+                return
+            self.node_values[node] = node_value
+            delta = 1 if node_value is True else -1
+            node = self.node_parents[node]
+
+
+class ControlRuleEngine:
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+
+        self._compiled_rules: list[CompiledRule] = list()
+        # (mac, sensor type) -> ((compiled rule, slot, leaf predicate), ...) in rule load order
+        self._dependencies: dict[tuple[int, int], tuple] = dict()
+
+    def compile(self, control_rules: list[ControlRule]):
+        """
+        (Re)compile the rules, call this whenever the defs are reloaded
+        :param control_rules:
+        :return:
+        """
+        previous = {id(compiled_rule.rule): compiled_rule for compiled_rule in self._compiled_rules}
+
+        compiled_rules = list()
+        dependencies: dict[tuple[int, int], list] = dict()
+        for control_rule in control_rules:
+            compiled_rule = previous.get(id(control_rule), None)
+            slot_leaves = list()
+            if compiled_rule is None:
+                compiled_rule = CompiledRule(control_rule)
+                self.compile_condition(compiled_rule, control_rule.get_condition(), -1, slot_leaves)
+            else:
+                # the plan is unchanged, only the dependency index is rebuilt
+                self.get_slot_leaves(control_rule.get_condition(), slot_leaves)
+            compiled_rules.append(compiled_rule)
+
+            for slot, (leaf, mac, sensor_type) in enumerate(slot_leaves):
+                dependencies.setdefault((mac, sensor_type), list()).append((compiled_rule, slot, leaf))
+
+        self._compiled_rules = compiled_rules
+        self._dependencies = {key: tuple(entries) for key, entries in dependencies.items()}
+
+    @staticmethod
+    def get_slot_leaves(condition: RuleCondition, slot_leaves: list):
+        """
+        The (leaf, mac, sensor type) of every slot of a condition, in slot order
+        :param condition:
+        :param slot_leaves:
+        :return:
+        """
+        for child in condition.get_conditions():
+            if isinstance(child, RuleCondition):
+                ControlRuleEngine.get_slot_leaves(child, slot_leaves)
+                continue
+            for mac in sorted(child.get_macs()):
+                for sensor_type in sorted(set(child.get_sensor_types())):
+                    slot_leaves.append((child, mac, sensor_type))
+
+    @staticmethod
+    def compile_condition(compiled_rule: CompiledRule, condition: RuleCondition, parent: int, slot_leaves: list):
+        """
+        Append a condition's nodes and slots to the plan, a leaf is a node that holds when any of its slots does
+        :param compiled_rule:
+        :param condition:
+        :param parent:
+        :param slot_leaves:
+        :return:
+        """
+        node = ControlRuleEngine.add_node(compiled_rule, parent, condition.get_n_required())
+        for child in condition.get_conditions():
+            if isinstance(child, RuleCondition):
+                ControlRuleEngine.compile_condition(compiled_rule, child, node, slot_leaves)
+                continue
+            leaf_node = ControlRuleEngine.add_node(compiled_rule, node, 1)
+            for mac in sorted(child.get_macs()):
+                for sensor_type in sorted(set(child.get_sensor_types())):
+                    compiled_rule.slot_parents.append(leaf_node)
+                    compiled_rule.slot_values.append(False)
+                    slot_leaves.append((child, mac, sensor_type))
+
+    @staticmethod
+    def add_node(compiled_rule: CompiledRule, parent: int, required: int) -> int:
+        compiled_rule.node_parents.append(parent)
+        compiled_rule.node_required.append(required)
+        compiled_rule.node_counts.append(0)
+        compiled_rule.node_values.append(False)
+        return len(compiled_rule.node_parents) - 1
+
+    def has_rules(self) -> bool:
+        return len(self._compiled_rules) > 0
+
+    def update(self, mac: int, sensor_type: int,
+               evaluate_leaf: Callable[[ControlDef], tuple[bool, bool] | None]) -> list[tuple[ControlRule, bool]]:
+        """
+        Apply a reading to the leaves of its mac and type
+        :param mac:
+        :param sensor_type:
+        :param evaluate_leaf: (exceeded, hysteresis check passed) of the reading against a leaf predicate,
+        None to leave the leaf as it is
+        :return: (rule, value of its condition) of every rule that depends on the reading, in load order
+        """
+        entries = self._dependencies.get((mac, sensor_type), None)
+        if entries is None:
+            return list()
+
+        updated = list()
+        for compiled_rule, slot, leaf in entries:
+            result = evaluate_leaf(leaf)
+            if result is not None:
+                exceeded, hysteresis_passed = result
+                if exceeded is True:
+                    compiled_rule.set_slot(slot, True)
+                elif hysteresis_passed is True:
+                    compiled_rule.set_slot(slot, False)
+            # a rule with several slots on the reading's mac and type is reported once
+            if (len(updated) == 0) or (updated[-1] is not compiled_rule):
+                updated.append(compiled_rule)
+
+        return [(compiled_rule.rule, compiled_rule.get_value()) for compiled_rule in updated]
+
+    def clear(self, mac: int, sensor_type: int, is_cleared: Callable[[ControlRule], bool]) -> list[ControlRule]:
+        """
+        Stop the leaves of a mac and type from holding, for a sensor that went stale
+        :param mac:
+        :param sensor_type:
+        :param is_cleared: whether a rule's leaves are cleared
+        :return: the rules whose leaves were cleared, in load order
+        """
+        cleared = list()
+        for compiled_rule, slot, _ in self._dependencies.get((mac, sensor_type), tuple()):
+            if is_cleared(compiled_rule.rule) is False:
+                continue
+            compiled_rule.set_slot(slot, False)
+            if (len(cleared) == 0) or (cleared[-1] is not compiled_rule.rule):
+                cleared.append(compiled_rule.rule)
+        return cleared
+
+    def get_value(self, control_rule: ControlRule) -> bool | None:
+        for compiled_rule in self._compiled_rules:
+            if compiled_rule.rule is control_rule:
+                return compiled_rule.get_value()
+        return None
+
+    def get_n_rules(self) -> int:
+        return len(self._compiled_rules)
@@ -0,0 +1,235 @@
+"""
+Binary journal of the controller state that has to survive a restart: the control triggers (so a duration
+timer that was running keeps its start time) and the last relay state commanded on each channel
+
+Every change is appended to the journal as one small record, length prefixed and checksummed so a record torn
+by a crash is detected and dropped along with anything after it. At startup the journal is replayed into
+the latest state and rewritten as a snapshot of only the live records, and it is rewritten the same way
+whenever the superseded records start to outweigh the live ones, so the file stays proportional to the
+number of live triggers.
+"""
+import logging
+import math
+import os
+import struct
+import zlib
+
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+from control_defs import DEFAULT_BOARD_ID
+from control_trigger_store import ControlTrigger
+
+JOURNAL_MAGIC = b"BBCS\x01"
+
+# record type, payload length, crc32 of the payload
+RECORD_HEADER = struct.Struct("<BHI")
+RECORD_TRIGGER = 1
+RECORD_TRIGGER_REMOVED = 2
+RECORD_RELAY_STATE = 3
+
+# time exceeded, expire, control func execution time, last sensor read (-1 for None), sensor data,
+# last sensor data (NaN for None), followed by the utf-8 key and control def uuid
+TRIGGER_FIELDS = struct.Struct("<qqqqdd")
+# followed by the utf-8 channel name and board id (a record without a board id is for the default board)
+RELAY_STATE_FIELDS = struct.Struct("<b")
+STRING_LENGTH = struct.Struct("<H")
+
+
+def pack_string(value: str) -> bytes:
+    encoded = value.encode("utf-8")
+    return STRING_LENGTH.pack(len(encoded)) + encoded
+
+
+def unpack_string(payload: bytes, offset: int) -> tuple[str, int]:
+    (length,) = STRING_LENGTH.unpack_from(payload, offset)
+    offset += STRING_LENGTH.size
+    return payload[offset:offset + length].decode("utf-8"), offset + length
+
+
+def none_to_sentinel(value, sentinel):
+    return sentinel if value is None else value
+
+
+def pack_trigger(key: str, trigger: ControlTrigger) -> bytes:
+    return TRIGGER_FIELDS.pack(trigger.get_time_exceeded_millis(),
+                               none_to_sentinel(trigger.get_expire_millis(), -1),
+                               none_to_sentinel(trigger.get_control_func_execution_time_ms(), -1),
+                               none_to_sentinel(trigger.get_last_sensor_read_ms(), -1),
+                               trigger.get_sensor_data(),
+                               none_to_sentinel(trigger.get_last_sensor_data(), math.nan)) + \
+        pack_string(key) + pack_string(trigger.get_control_def_uuid() or "")
+
+
+def unpack_trigger(payload: bytes) -> tuple[str, ControlTrigger]:
+    time_exceeded_millis, expire_millis, execution_time_ms, last_sensor_read_ms, sensor_data, last_sensor_data = \
+        TRIGGER_FIELDS.unpack_from(payload, 0)
+    key, offset = unpack_string(payload, TRIGGER_FIELDS.size)
+    control_def_uuid, _ = unpack_string(payload, offset)
+
+    trigger = ControlTrigger(time_exceeded_millis, None if expire_millis < 0 else expire_millis, sensor_data,
+                             control_def_uuid or None)
+    if execution_time_ms >= 0:
+        trigger.set_control_func_execution_time_ms(execution_time_ms)
+    if last_sensor_read_ms >= 0:
+        trigger.set_last_sensor_read_ms(last_sensor_read_ms)
+    if not math.isnan(last_sensor_data):
+        trigger.set_last_sensor_data(last_sensor_data)
+    return key, trigger
+
+
+def pack_relay_state(board_id: str, channel: WaveshareDef, state: int) -> bytes:
+    return RELAY_STATE_FIELDS.pack(state) + pack_string(channel.name) + pack_string(board_id)
+
+
+def unpack_relay_state(payload: bytes) -> tuple[tuple[str, WaveshareDef], int]:
+    (state,) = RELAY_STATE_FIELDS.unpack_from(payload, 0)
+    channel_name, offset = unpack_string(payload, RELAY_STATE_FIELDS.size)
+    board_id = DEFAULT_BOARD_ID
+    if offset < len(payload):
+        board_id, _ = unpack_string(payload, offset)
+    return (board_id, WaveshareDef[channel_name]), state
+
+
+def pack_record(record_type: int, payload: bytes) -> bytes:
+    return RECORD_HEADER.pack(record_type, len(payload), zlib.crc32(payload)) + payload
+
+
+class ControlStateJournal:
+    """
+    Append only journal of control trigger and relay state changes, see the module docstring
+
+    load() the previous state, then write_snapshot() the state the controller actually restored, after which
+    put_trigger / remove_trigger / set_relay_state append to the journal. With fsync False a record reaches
+    the OS on every write, which survives the process crashing but not the machine losing power.
+    """
+
+    def __init__(self, state_file: str, fsync: bool = False, compact_min_records: int = 10000):
+        self.logger = logging.getLogger(__name__)
+
+        self._state_file = state_file
+        self._fsync = fsync
+        self._compact_min_records = compact_min_records
+        self._file = None
+
+        # the live state, kept to rewrite the journal as a snapshot
+        self._triggers: dict[str, ControlTrigger] = dict()
+        self._relay_states: dict[tuple[str, WaveshareDef], int] = dict()
+        self._n_records = 0
+
+    def load(self) -> tuple[dict[str, ControlTrigger], dict[tuple[str, WaveshareDef], int]]:
+        """
+        Replay the journal, a missing file is an empty state
+        :return: (key -> control trigger, (board id, channel) -> relay state)
+        """
+        triggers: dict[str, ControlTrigger] = dict()
+        relay_states: dict[tuple[str, WaveshareDef], int] = dict()
+
+        try:
+            with open(self._state_file, "rb") as journal_file:
+                data = journal_file.read()
+        except FileNotFoundError:
+            return triggers, relay_states
+
+        if not data.startswith(JOURNAL_MAGIC):
+            self.logger.error("{} is not a control state journal, ignoring it".format(self._state_file))
+            return triggers, relay_states
+
+        offset = len(JOURNAL_MAGIC)
+        n_records = 0
+        while offset < len(data):
+            if offset + RECORD_HEADER.size > len(data):
+                break
+            record_type, length, crc = RECORD_HEADER.unpack_from(data, offset)
+            payload = data[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + length]
+            if (len(payload) != length) or (zlib.crc32(payload) != crc):
+                break
+            offset += RECORD_HEADER.size + length
+            n_records += 1
+
+            try:
+                if record_type == RECORD_TRIGGER:
+                    key, trigger = unpack_trigger(payload)
+                    triggers[key] = trigger
+                elif record_type == RECORD_TRIGGER_REMOVED:
+                    key, _ = unpack_string(payload, 0)
+                    triggers.pop(key, None)
+                elif record_type == RECORD_RELAY_STATE:
+                    board_channel, state = unpack_relay_state(payload)
+                    relay_states[board_channel] = state
+                else:
+                    self.logger.warning("Unknown control state record type {}".format(record_type))
+            except (struct.error, KeyError, UnicodeDecodeError) as e:
+                self.logger.warning("Skipping unreadable control state record:{}".format(e))
+
+        if offset < len(data):
+            # the tail was being written when the process died
+            self.logger.warning("Dropped {} bytes of torn records from the end of {}".format(
+                len(data) - offset, self._state_file))
+
+        self.logger.info("Loaded {} control triggers and {} relay states from {} records".format(
+            len(triggers), len(relay_states), n_records))
+        return triggers, relay_states
+
+    def write_snapshot(self, triggers: dict[str, ControlTrigger], relay_states: dict[tuple[str, WaveshareDef], int]):
+        """
+        Replace the journal with one record per live trigger and relay state, then keep appending to it
+        :param triggers:
+        :param relay_states:
+        :return:
+        """
+        self._triggers = dict(triggers)
+        self._relay_states = dict(relay_states)
+
+        records = [JOURNAL_MAGIC]
+        records.extend(pack_record(RECORD_TRIGGER, pack_trigger(key, trigger)) for key, trigger in triggers.items())
+        records.extend(pack_record(RECORD_RELAY_STATE, pack_relay_state(board_id, channel, state))
+                       for (board_id, channel), state in relay_states.items())
+
+        # the snapshot goes to a temporary file first, a crash part way leaves the old journal in place
+        tmp_file = self._state_file + ".tmp"
+        with open(tmp_file, "wb") as snapshot_file:
+            snapshot_file.write(b"".join(records))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+
+        if self._file is not None:
+            self._file.close()
+        os.replace(tmp_file, self._state_file)
+
+        self._file = open(self._state_file, "ab")
+        self._n_records = len(records) - 1
+
+    def append(self, record_type: int, payload: bytes):
+        if self._file is None:
+            return
+
+        self._file.write(pack_record(record_type, payload))
+        self._file.flush()
+        if self._fsync is True:
+            os.fsync(self._file.fileno())
+        self._n_records += 1
+
+        n_live = len(self._triggers) + len(self._relay_states)
+        if (self._n_records >= self._compact_min_records) and (self._n_records > 4 * n_live):
+            self.write_snapshot(self._triggers, self._relay_states)
+
+    def put_trigger(self, key: str, trigger: ControlTrigger):
+        self._triggers[key] = trigger
+        self.append(RECORD_TRIGGER, pack_trigger(key, trigger))
+
+    def remove_trigger(self, key: str):
+        if self._triggers.pop(key, None) is not None:
+            self.append(RECORD_TRIGGER_REMOVED, pack_string(key))
+
+    def set_relay_state(self, board_id: str, channel: WaveshareDef, state: int):
+        if self._relay_states.get((board_id, channel), None) == state:
+            return
+        self._relay_states[(board_id, channel)] = state
+        self.append(RECORD_RELAY_STATE, pack_relay_state(board_id, channel, state))
+
+    def get_n_records(self) -> int:
+        return self._n_records
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,244 @@
+import heapq
+import itertools
+import logging
+
+
+class ControlTrigger:
+    """
+    The control trigger will keep information about the Control Def execution in memory (or cache eventually)
+    """
+
+    def __init__(self, time_exceeded_millis: int, expire_millis: int, sensor_data: float,
+                 control_def_uuid: str = None):
+        self._time_exceeded_millis = time_exceeded_millis
+        self._sensor_data = sensor_data
+        self._expire_millis = expire_millis
+        self._control_def_uuid = control_def_uuid
+
+        # when did we last see this sensor?
+        self._last_sensor_read_ms = None
+        self._last_sensor_data = None
+
+        # when did we execute the control function
+        self._control_func_execute_time_ms = None
+
+    def get_time_exceeded_millis(self) -> int:
+        return int(self._time_exceeded_millis)
+
+    def get_sensor_data(self) -> float:
+        return float(self._sensor_data)
+
+    def get_expire_millis(self) -> int:
+        return self._expire_millis
+
+    def set_expire_millis(self, expire_millis: int):
+        # only through ControlTriggerStore.refresh_expiry, the store keeps the expiry heap in step
+        self._expire_millis = expire_millis
+
+    def get_control_def_uuid(self) -> str:
+        return self._control_def_uuid
+
+    def set_last_sensor_read_ms(self, last_sensor_read_ms: int):
+        self._last_sensor_read_ms = last_sensor_read_ms
+
+    def get_last_sensor_read_ms(self) -> int:
+        return self._last_sensor_read_ms
+
+    def set_last_sensor_data(self, last_sensor_data: float):
+        self._last_sensor_data = last_sensor_data
+
+    def get_last_sensor_data(self) -> float:
+        return self._last_sensor_data
+
+    def set_control_func_execution_time_ms(self, control_func_execution_time_ms: int):
+        self._control_func_execute_time_ms = control_func_execution_time_ms
+
+    def get_control_func_execution_time_ms(self) -> int | None:
+        return self._control_func_execute_time_ms
+
+
+class ControlTriggerStore:
+    """
+    Holds the live control triggers keyed by BangBangController.get_control_trigger_key
+
+    A trigger whose control function has not executed yet (a pending trigger) expires at its expire_millis,
+    so a value that exceeded the threshold once and then never completed the duration or came back
+    through the hysteresis point doesn't hold a trigger forever. The controller pushes the expiry back
+    with refresh_expiry every time another exceeding reading arrives. Triggers whose control function has
+    executed are holding a relay in the control state and only leave the store through the back to
+    normal logic, they are never expired or evicted.
+
+    Expiry deadlines live in a min heap with lazy deletion, insert and expire are O(log n).
+    With max_triggers > 0 the store is capped: inserting into a full store evicts the pending trigger
+    closest to expiry, and if every trigger is holding a relay the new trigger is dropped instead.
+
+    With a ControlStateJournal set, every change to the store is journaled so it can be restored after a restart.
+    """
+
+    def __init__(self, max_triggers: int = 0):
+        self.logger = logging.getLogger(__name__)
+
+        self._triggers: dict[str, ControlTrigger] = dict()
+        # (expire_millis, insert sequence, key, trigger)
+        self._expiry_heap: list[tuple[int, int, str, ControlTrigger]] = list()
+        self._sequence = itertools.count()
+        self._max_triggers = max_triggers
+
+        self._n_expired = 0
+        self._n_evicted = 0
+        self._n_dropped = 0
+
+        # ControlStateJournal
+        self._journal = None
+
+    def set_journal(self, journal):
+        self._journal = journal
+
+    def __len__(self):
+        return len(self._triggers)
+
+    def __contains__(self, key: str):
+        return key in self._triggers
+
+    def __getitem__(self, key: str) -> ControlTrigger:
+        return self._triggers[key]
+
+    def __setitem__(self, key: str, trigger: ControlTrigger):
+        self.put(key, trigger)
+
+    def get(self, key: str, default=None) -> ControlTrigger | None:
+        return self._triggers.get(key, default)
+
+    def items(self):
+        return self._triggers.items()
+
+    def put(self, key: str, trigger: ControlTrigger) -> bool:
+        """
+        Add (or replace) a trigger, evicting a pending one first if the store is full
+        :param key:
+        :param trigger:
+        :return: False if the store is full of executed triggers and the trigger was dropped
+        """
+        if (self._max_triggers > 0) and (key not in self._triggers) and (len(self._triggers) >= self._max_triggers):
+            if self.evict() is False:
+                self._n_dropped += 1
+                self.logger.warning("Control trigger store is full of executed triggers, dropping {}".format(key))
+                return False
+
+        self._triggers[key] = trigger
+        if trigger.get_expire_millis() is not None:
+            heapq.heappush(self._expiry_heap, (trigger.get_expire_millis(), next(self._sequence), key, trigger))
+        if self._journal is not None:
+            self._journal.put_trigger(key, trigger)
+        return True
+
+    def refresh_expiry(self, key: str, expire_millis: int):
+        """
+        Move the expiry of a live trigger, the heap entry for the old expiry is dropped lazily.
+        Not journaled, a restored pending trigger gets a fresh expiry instead
+        :param key:
+        :param expire_millis:
+        :return:
+        """
+        trigger = self._triggers[key]
+        trigger.set_expire_millis(expire_millis)
+        heapq.heappush(self._expiry_heap, (expire_millis, next(self._sequence), key, trigger))
+
+    def set_executed(self, key: str, execution_time_ms: int):
+        """
+        Mark a live trigger's control function as executed, which takes it out of the expiry
+        :param key:
+        :param execution_time_ms:
+        :return:
+        """
+        trigger = self._triggers[key]
+        trigger.set_control_func_execution_time_ms(execution_time_ms)
+        if self._journal is not None:
+            self._journal.put_trigger(key, trigger)
+
+    def pop(self, key: str, *default) -> ControlTrigger | None:
+        # the heap entry is dropped lazily when it reaches the top
+        trigger = self._triggers.pop(key, *default)
+        if self._journal is not None:
+            self._journal.remove_trigger(key)
+        return trigger
+
+    def is_expirable(self, expire_millis: int, key: str, trigger: ControlTrigger) -> bool:
+        """
+        A heap entry is only live if its trigger is still the one in the store, is still pending
+        and its expiry hasn't been refreshed since the entry was pushed
+        :param expire_millis:
+        :param key:
+        :param trigger:
+        :return:
+        """
+        return ((self._triggers.get(key, None) is trigger) and (trigger.get_control_func_execution_time_ms() is None)
+                and (trigger.get_expire_millis() == expire_millis))
+
+    def discard_stale_heap_entries(self):
+        while len(self._expiry_heap) > 0:
+            expire_millis, _, key, trigger = self._expiry_heap[0]
+            if self.is_expirable(expire_millis, key, trigger):
+                return
+            heapq.heappop(self._expiry_heap)
+
+    def get_next_expiry_ms(self) -> int | None:
+        """
+        The earliest expire_millis of the pending triggers, or None if there are none
+        :return:
+        """
+        self.discard_stale_heap_entries()
+        if len(self._expiry_heap) == 0:
+            return None
+        return self._expiry_heap[0][0]
+
+    def expire(self, now_ms: int) -> list[str]:
+        """
+        Remove the pending triggers whose expire_millis has passed
+        :param now_ms:
+        :return: the keys of the expired triggers
+        """
+        expired_keys = list()
+        self.discard_stale_heap_entries()
+        while (len(self._expiry_heap) > 0) and (self._expiry_heap[0][0] <= now_ms):
+            _, _, key, _ = heapq.heappop(self._expiry_heap)
+            self.pop(key)
+            expired_keys.append(key)
+            self.discard_stale_heap_entries()
+
+        self._n_expired += len(expired_keys)
+        return expired_keys
+
+    def evict(self) -> bool:
+        """
+        Make room for one trigger by evicting the pending trigger closest to expiry
+        :return: False if there is no pending trigger, an executed one holds its relay and is never evicted
+        """
+        self.discard_stale_heap_entries()
+        if len(self._expiry_heap) == 0:
+            return False
+
+        _, _, key, _ = heapq.heappop(self._expiry_heap)
+        self.pop(key)
+        self._n_evicted += 1
+        return True
+
+    def get_n_live(self) -> int:
+        return len(self._triggers)
+
+    def get_n_expired(self) -> int:
+        return self._n_expired
+
+    def get_n_evicted(self) -> int:
+        return self._n_evicted
+
+    def get_n_dropped(self) -> int:
+        return self._n_dropped
+
+    def get_metrics(self) -> dict[str, int]:
+        return {
+            "live": self.get_n_live(),
+            "expired": self.get_n_expired(),
+            "evicted": self.get_n_evicted(),
+            "dropped": self.get_n_dropped()
+        }
@@ -0,0 +1,94 @@
+import heapq
+import itertools
+import logging
+from typing import Callable, Hashable
+
+
+class DeadlineScheduler:
+    """
+    One-shot timers keyed by an arbitrary hashable, for the controller's timed work that isn't tied to a reading
+
+    Deadlines live in a min heap with lazy deletion like the control trigger expiries: scheduling a key again
+    replaces its timer and cancel() only forgets it, the stale heap entries are dropped when they reach the top.
+    Schedule and cancel are O(log n) and O(1), and the controller loop only has to look at the top of the heap to
+    know how long it can sleep, nothing is polled.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+
+        # (deadline ms, sequence, key)
+        self._heap: list[tuple[int, int, Hashable]] = list()
+        # key -> (sequence, callback) of the live timers
+        self._timers: dict[Hashable, tuple[int, Callable[[], None]]] = dict()
+        self._sequence = itertools.count()
+        self._n_fired = 0
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key: Hashable):
+        return key in self._timers
+
+    def schedule(self, key: Hashable, deadline_ms: int, callback: Callable[[], None]):
+        """
+        Call callback once deadline_ms has passed, replacing any timer already scheduled for the key
+        :param key:
+        :param deadline_ms:
+        :param callback:
+        :return:
+        """
+        sequence = next(self._sequence)
+        self._timers[key] = (sequence, callback)
+        heapq.heappush(self._heap, (deadline_ms, sequence, key))
+
+    def cancel(self, key: Hashable) -> bool:
+        """
+        :param key:
+        :return: True if a timer was scheduled for the key
+        """
+        return self._timers.pop(key, None) is not None
+
+    def discard_stale_heap_entries(self):
+        while len(self._heap) > 0:
+            _, sequence, key = self._heap[0]
+            timer = self._timers.get(key, None)
+            if (timer is not None) and (timer[0] == sequence):
+                return
+            heapq.heappop(self._heap)
+
+    def get_next_deadline_ms(self) -> int | None:
+        """
+        The earliest deadline of the live timers, or None if there are none
+        :return:
+        """
+        self.discard_stale_heap_entries()
+        if len(self._heap) == 0:
+            return None
+        return self._heap[0][0]
+
+    def run_due(self, now_ms: int) -> int:
+        """
+        Fire the timers whose deadline has passed, in deadline order. A callback may schedule new timers,
+        the ones already due fire in the same call
+        :param now_ms:
+        :return: the number of timers fired
+        """
+        n_fired = 0
+        self.discard_stale_heap_entries()
+        while (len(self._heap) > 0) and (self._heap[0][0] <= now_ms):
+            _, _, key = heapq.heappop(self._heap)
+            _, callback = self._timers.pop(key)
+            try:
+                callback()
+            except Exception as e:
+                # one failing timer must not take the controller thread down
+                self.logger.error("Deadline {} failed:{}".format(key, e))
+            n_fired += 1
+            self.discard_stale_heap_entries()
+
+        self._n_fired += n_fired
+        return n_fired
+
+    def get_n_fired(self) -> int:
+        return self._n_fired
@@ -0,0 +1,17 @@
+"""
+A stand-in for SensorDataIngest that keeps the batches in memory, so the API reporting can be tested
+without the API
+"""
+
+
+class RecordingApiWriter:
+    """
+    Records every batch sent and always succeeds
+    """
+
+    def __init__(self):
+        self.batches: list[list[dict]] = list()
+
+    def send_data(self, batch: list[dict], self_manage_token: bool) -> bool:
+        self.batches.append(batch)
+        return True
@@ -0,0 +1,203 @@
+"""
+A small in-memory stand-in for the parts of the redis client the monitor uses, so the cache fetch
+logic can be tested and benchmarked without a Redis server
+"""
+import json
+import queue
+import time
+
+from redis.exceptions import ResponseError
+
+
+class FakeRedisPipeline:
+    """
+    Buffers commands and runs them against the FakeRedis in a single simulated round trip
+    """
+
+    def __init__(self, fake_redis):
+        self._fake_redis = fake_redis
+        self._commands = list()
+
+    def hgetall(self, name: str):
+        self._commands.append((self._fake_redis.hgetall_local, (name,)))
+        return self
+
+    def hmget(self, name: str, keys: list):
+        self._commands.append((self._fake_redis.hmget_local, (name, keys)))
+        return self
+
+    def execute(self, raise_on_error: bool = True) -> list:
+        self._fake_redis.round_trip()
+        results = list()
+        for func, args in self._commands:
+            try:
+                results.append(func(*args))
+            except Exception as e:
+                if raise_on_error is True:
+                    raise
+                results.append(e)
+        self._commands = list()
+        return results
+
+
+class FakeRedisScript:
+    """
+    Runs the redis_monitor fetch script against the FakeRedis in a single simulated round trip. There is no
+    Lua interpreter here, so only that script is understood and FakeRedis(scripting=False) refuses it like
+    a server with scripting disabled.
+    """
+
+    def __init__(self, fake_redis, script: str):
+        self._fake_redis = fake_redis
+        self._script = script
+
+    def __call__(self, keys: list = None, args: list = None, client=None) -> list:
+        self._fake_redis.round_trip()
+        if self._fake_redis.scripting is False:
+            raise ResponseError("NOSCRIPT scripting is disabled")
+
+        keys = keys or list()
+        args = args or list()
+        results = list()
+        n_skipped = 0
+        bytes_skipped = 0
+        argi = 0
+        for key in keys:
+            n_known = int(args[argi])
+            known = {str(args[argi + 1 + 2 * j]): int(args[argi + 2 + 2 * j]) for j in range(n_known)}
+            argi += 1 + 2 * n_known
+
+            changed = list()
+            for field, payload in self._fake_redis.hgetall_local(key).items():
+                last_timestamp = known.get(field, None)
+                timestamp = None
+                if last_timestamp is not None:
+                    try:
+                        decoded = json.loads(payload)
+                        timestamp = int(decoded.get("_timestamp", decoded.get("timestamp")))
+                    except (ValueError, TypeError, AttributeError):
+                        timestamp = None
+                if (timestamp is not None) and (timestamp <= last_timestamp):
+                    n_skipped += 1
+                    bytes_skipped += len(payload)
+                else:
+                    changed.extend([field, payload])
+            results.append(changed)
+
+        results.append([n_skipped, bytes_skipped])
+        return results
+
+
+class FakeRedisPubSub:
+    """
+    Receives the keyspace notifications the FakeRedis publishes for the channels it subscribed to
+    """
+
+    def __init__(self, fake_redis, ignore_subscribe_messages: bool = False):
+        self._fake_redis = fake_redis
+        self._channels: set[str] = set()
+        self._messages = queue.Queue()
+
+    def subscribe(self, *channels: str):
+        self._channels.update(channels)
+        self._fake_redis.add_subscriber(self)
+
+    def unsubscribe(self, *channels: str):
+        self._channels.difference_update(channels)
+
+    def publish_local(self, channel: str, data: str):
+        if channel in self._channels:
+            self._messages.put({"type": "message", "pattern": None, "channel": channel, "data": data})
+
+    def get_message(self, timeout: float = 0.0) -> dict | None:
+        try:
+            if timeout > 0:
+                return self._messages.get(timeout=timeout)
+            return self._messages.get_nowait()
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self._fake_redis.remove_subscriber(self)
+
+
+class FakeRedis:
+    """
+    Hashes only, values are stored as strings like a decode_responses=True client returns them.
+    Every call (or pipeline execute) counts as one round trip and optionally sleeps round_trip_ms.
+    Writes publish keyspace notifications on db 0 like a server with notify-keyspace-events "Kh".
+    """
+
+    def __init__(self, round_trip_ms: float = 0.0, scripting: bool = True):
+        self._hashes: dict[str, dict[str, str]] = dict()
+        self._round_trip_ms = round_trip_ms
+        self.scripting = scripting
+        self._subscribers: list[FakeRedisPubSub] = list()
+        self.n_round_trips = 0
+
+    def round_trip(self):
+        self.n_round_trips += 1
+        if self._round_trip_ms > 0:
+            time.sleep(self._round_trip_ms / 1000.0)
+
+    def hset(self, name: str, key: str, value: str):
+        self.round_trip()
+        self._hashes.setdefault(str(name), dict())[str(key)] = str(value)
+        for subscriber in list(self._subscribers):
+            subscriber.publish_local("__keyspace@0__:{}".format(name), "hset")
+
+    def hgetall_local(self, name: str) -> dict[str, str]:
+        return dict(self._hashes.get(str(name), dict()))
+
+    def hmget_local(self, name: str, keys: list) -> list:
+        hash_dict = self._hashes.get(str(name), dict())
+        return [hash_dict.get(str(key), None) for key in keys]
+
+    def hgetall(self, name: str) -> dict[str, str]:
+        self.round_trip()
+        return self.hgetall_local(name)
+
+    def hmget(self, name: str, keys: list) -> list:
+        self.round_trip()
+        return self.hmget_local(name, keys)
+
+    def pipeline(self, transaction: bool = True) -> FakeRedisPipeline:
+        return FakeRedisPipeline(self)
+
+    def register_script(self, script: str) -> FakeRedisScript:
+        return FakeRedisScript(self, script)
+
+    def pubsub(self, ignore_subscribe_messages: bool = False) -> FakeRedisPubSub:
+        return FakeRedisPubSub(self, ignore_subscribe_messages)
+
+    def add_subscriber(self, subscriber: FakeRedisPubSub):
+        if subscriber not in self._subscribers:
+            self._subscribers.append(subscriber)
+
+    def remove_subscriber(self, subscriber: FakeRedisPubSub):
+        if subscriber in self._subscribers:
+            self._subscribers.remove(subscriber)
+
+
+class FakeAsyncRedisPipeline(FakeRedisPipeline):
+    """
+    The redis.asyncio pipeline buffers commands the same way, only execute is awaited
+    """
+
+    async def execute(self, raise_on_error: bool = True) -> list:
+        return super(FakeAsyncRedisPipeline, self).execute(raise_on_error)
+
+
+class FakeAsyncRedis:
+    """
+    redis.asyncio flavoured view of a FakeRedis, for the async runtime
+    """
+
+    def __init__(self, fake_redis: FakeRedis):
+        self.fake_redis = fake_redis
+
+    def pipeline(self, transaction: bool = True) -> FakeAsyncRedisPipeline:
+        return FakeAsyncRedisPipeline(self.fake_redis)
+
+    async def aclose(self):
+        pass
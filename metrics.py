@@ -0,0 +1,243 @@
+"""
+Runtime metrics for the control pipeline, served over HTTP in the Prometheus text format
+
+The metrics are module level, like the Prometheus client's default registry: the code that owns a hot path
+updates them in place (a counter increment or a histogram observation is a lock and an add) and the
+MetricsServer renders them when /metrics is scraped. Gauges for values that already exist elsewhere
+(queue depth, live control triggers) read them through a callback at scrape time, so they cost nothing
+on the hot path.
+
+Set metrics_port in config.cfg to serve them, 0 leaves the endpoint off.
+"""
+import bisect
+import configparser
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from typing import Callable
+
+# seconds, from a fast cache read to a slow serial round trip
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+# seconds per message
+MESSAGE_BUCKETS = (0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005)
+
+
+class Counter:
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n: int = 1):
+        with self._lock:
+            self._value += n
+
+    def get_value(self) -> int:
+        return self._value
+
+    def render(self) -> list[str]:
+        return ["# HELP {} {}".format(self.name, self.help_text),
+                "# TYPE {} counter".format(self.name),
+                "{} {}".format(self.name, self._value)]
+
+
+class Gauge:
+    """
+    Either set directly or read from a callback when the metrics are rendered
+    """
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._value = 0.0
+        self._function: Callable[[], float] | None = None
+
+    def set(self, value: float):
+        self._value = value
+
+    def set_function(self, function: Callable[[], float] | None):
+        self._function = function
+
+    def get_value(self) -> float:
+        if self._function is not None:
+            try:
+                return self._function()
+            except Exception:
+                # e.g. multiprocessing.Queue.qsize() is not implemented on every platform
+                return float("nan")
+        return self._value
+
+    def render(self) -> list[str]:
+        return ["# HELP {} {}".format(self.name, self.help_text),
+                "# TYPE {} gauge".format(self.name),
+                "{} {}".format(self.name, self.get_value())]
+
+
+class Histogram:
+
+    def __init__(self, name: str, help_text: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self._buckets = tuple(sorted(buckets))
+        # per bucket counts (not cumulative), the last one is +Inf
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def get_count(self) -> int:
+        return sum(self._counts)
+
+    def get_sum(self) -> float:
+        return self._sum
+
+    def render(self) -> list[str]:
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+
+        lines = ["# HELP {} {}".format(self.name, self.help_text),
+                 "# TYPE {} histogram".format(self.name)]
+        cumulative = 0
+        for upper_bound, count in zip(self._buckets, counts):
+            cumulative += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, upper_bound, cumulative))
+        cumulative += counts[-1]
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(self.name, cumulative))
+        lines.append("{}_sum {}".format(self.name, total))
+        lines.append("{}_count {}".format(self.name, cumulative))
+        return lines
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self._metrics: dict[str, Counter | Gauge | Histogram] = dict()
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self.register(Counter(name, help_text))
+
+    def gauge(self, name: str, help_text: str) -> Gauge:
+        return self.register(Gauge(name, help_text))
+
+    def histogram(self, name: str, help_text: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, buckets))
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError("Metric {} is already registered".format(metric.name))
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = list()
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+REDIS_FETCH_SECONDS = REGISTRY.histogram("bangbang_redis_fetch_seconds",
+                                         "Time to fetch and decode the observed hashes, per fetch cycle")
+DECODE_SECONDS = REGISTRY.histogram("bangbang_decode_seconds", "Time spent decoding cached messages, per fetch cycle")
+MESSAGES_DECODED = REGISTRY.counter("bangbang_messages_decoded_total", "Cached messages decoded")
+MESSAGES_NEW = REGISTRY.counter("bangbang_messages_new_total", "Fetched messages newer than the last reading kept")
+MESSAGES_DEDUPLICATED = REGISTRY.counter("bangbang_messages_deduplicated_total",
+                                         "Fetched messages dropped because their timestamp had not advanced")
+MESSAGES_UNCHANGED_SKIPPED = REGISTRY.counter("bangbang_messages_unchanged_skipped_total",
+                                              "Unchanged readings the incremental fetch left on the server")
+BYTES_UNCHANGED_SKIPPED = REGISTRY.counter("bangbang_bytes_unchanged_skipped_total",
+                                           "Payload bytes of the unchanged readings the incremental fetch skipped")
+MESSAGES_INJECTED = REGISTRY.counter("bangbang_messages_injected_total", "Messages handed to the controller")
+MESSAGE_QUEUE_DEPTH = REGISTRY.gauge("bangbang_message_queue_depth", "Messages waiting for the controller")
+MESSAGES_PROCESSED = REGISTRY.counter("bangbang_messages_processed_total", "Messages evaluated by the controller")
+EVALUATION_SECONDS = REGISTRY.histogram("bangbang_evaluation_seconds_per_message",
+                                        "Control logic time per message, averaged over each drained batch",
+                                        MESSAGE_BUCKETS)
+LIVE_CONTROL_TRIGGERS = REGISTRY.gauge("bangbang_live_control_triggers", "Control triggers in the trigger store")
+STALE_SENSORS = REGISTRY.gauge("bangbang_stale_sensors", "Sensors that sent no reading for their staleness timeout")
+SENSORS_WENT_STALE = REGISTRY.counter("bangbang_sensors_went_stale_total",
+                                      "Times a sensor went stale and the failsafe of its control defs ran")
+RELAY_CALL_SECONDS = REGISTRY.histogram("bangbang_relay_call_seconds",
+                                        "Time the controller thread spends handing a command to the relay controller")
+RELAY_COMMAND_LATENCY_SECONDS = REGISTRY.histogram("bangbang_relay_command_latency_seconds",
+                                                   "Submit to write complete latency of the dispatched relay commands")
+RELAY_COMMANDS_FAILED = REGISTRY.counter("bangbang_relay_commands_failed_total", "Relay writes that raised")
+API_SENDS_SUCCEEDED = REGISTRY.counter("bangbang_api_sends_succeeded_total", "Batches sent to the API")
+API_SENDS_FAILED = REGISTRY.counter("bangbang_api_sends_failed_total", "Batches the API did not accept")
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(Thread):
+    """
+    Serves GET /metrics on a daemon thread until stop() is called
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 9464, registry: MetricsRegistry = REGISTRY):
+
+        super(MetricsServer, self).__init__(daemon=True)
+
+        self.logger = logging.getLogger(__name__)
+
+        self.server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self.server.daemon_threads = True
+        self.server.registry = registry
+
+    def get_port(self) -> int:
+        return self.server.server_address[1]
+
+    def run(self):
+        self.logger.info("Serving metrics on port {}".format(self.get_port()))
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def start_metrics_server(config: configparser.ConfigParser, port_offset: int = 0) -> MetricsServer | None:
+    """
+    Start the metrics endpoint if metrics_port is set
+    :param config:
+    :param port_offset: added to metrics_port, each shard worker serves its own metrics on the next ports
+    :return: the running server, or None if the endpoint is off or could not be started
+    """
+    port = config.getint("DEFAULT", "metrics_port", fallback=0)
+    if port <= 0:
+        return None
+
+    try:
+        metrics_server = MetricsServer(config.get("DEFAULT", "metrics_host", fallback="127.0.0.1"),
+                                       port + port_offset)
+    except OSError as e:
+        logging.getLogger(__name__).error("Could not serve metrics on port {}:{}".format(port + port_offset, e))
+        return None
+
+    metrics_server.start()
+    return metrics_server
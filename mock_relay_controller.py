@@ -0,0 +1,42 @@
+"""
+A stand-in for WaveshareRelayController that needs no relay board, for tests, benchmarks and simulation
+"""
+import time
+
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+
+
+class MockRelayController:
+    """
+    Keeps the channel states in memory and records every command, optionally taking
+    command_latency_ms per command to mimic the serial round trip to the board
+    """
+
+    def __init__(self, command_latency_ms: float = 0.0):
+        self._channel_states: dict[WaveshareDef, int | None] = {channel: None for channel in WaveshareDef}
+        self._command_latency_ms = command_latency_ms
+        # (channel, state) for every command received
+        self.commands: list[tuple[WaveshareDef, int]] = list()
+        # the next n commands fail like a serial write to an unresponsive board
+        self.n_failing_commands = 0
+
+    def set_channel_on(self, channel: WaveshareDef):
+        self.set_channel_state(channel, 1)
+
+    def set_channel_off(self, channel: WaveshareDef):
+        self.set_channel_state(channel, 0)
+
+    def set_channel_state(self, channel: WaveshareDef, state: int):
+        if self._command_latency_ms > 0:
+            time.sleep(self._command_latency_ms / 1000.0)
+        if self.n_failing_commands > 0:
+            self.n_failing_commands -= 1
+            raise IOError("relay board did not respond")
+        self._channel_states[channel] = state
+        self.commands.append((channel, state))
+
+    def get_channel_states(self) -> dict[WaveshareDef, int | None]:
+        return dict(self._channel_states)
+
+    def set_default_states(self):
+        pass
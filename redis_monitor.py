@@ -4,17 +4,71 @@ import time
 from multiprocessing import Queue, Event
 from threading import Thread
 import json
-import jsonpickle
 import redis
 
+import metrics
 from WaveshareRelayControl.waveshare_defs import WaveshareDef
+from control_def_watcher import ControlDefWatcher
 from control_defs import ControlDef, ThresholdType, ControlFunc, ControlDefUtils
+from sensor_message_codec import SensorMessageCodec
 from sensor_message_item import SensorMessageItem
 
+# Server side half of the incremental fetch. KEYS are the mac hashes of a chunk, ARGV holds for each key the
+# number of fields the client already has followed by (field, timestamp) pairs. A field is returned only if
+# the client doesn't have it or the timestamp in its payload has advanced, so unchanged readings are neither
+# transferred nor decoded. The last element of the reply is {n_skipped, bytes_skipped}.
+FETCH_CHANGED_FIELDS_SCRIPT = """
+local results = {}
+local n_skipped = 0
+local bytes_skipped = 0
+local argi = 1
+for i, key in ipairs(KEYS) do
+    local known = {}
+    local n_known = tonumber(ARGV[argi])
+    argi = argi + 1
+    for j = 1, n_known do
+        known[ARGV[argi]] = tonumber(ARGV[argi + 1])
+        argi = argi + 2
+    end
+
+    local changed = {}
+    local fields = redis.call('HGETALL', key)
+    for j = 1, #fields, 2 do
+        local field = fields[j]
+        local payload = fields[j + 1]
+        local is_changed = true
+        local last_timestamp = known[field]
+        if last_timestamp ~= nil then
+            local ok, decoded = pcall(cjson.decode, payload)
+            if ok and type(decoded) == 'table' then
+                local timestamp = tonumber(decoded['_timestamp'] or decoded['timestamp'])
+                if timestamp ~= nil and timestamp <= last_timestamp then
+                    is_changed = false
+                end
+            end
+        end
+        if is_changed then
+            changed[#changed + 1] = field
+            changed[#changed + 1] = payload
+        else
+            n_skipped = n_skipped + 1
+            bytes_skipped = bytes_skipped + string.len(payload)
+        end
+    end
+    results[i] = changed
+end
+results[#KEYS + 1] = {n_skipped, bytes_skipped}
+return results
+"""
+
 
 class RedisMonitor(Thread):
 
-    def __init__(self, message_queue: Queue, sig_event: Event):
+    def __init__(self, message_queue: Queue, sig_event: Event,
+                 redis_client: redis.StrictRedis = None,
+                 control_defs: list[ControlDef] = None,
+                 control_def_watcher: ControlDefWatcher = None,
+                 shard: tuple[int, int] = None):
 
         super(RedisMonitor, self).__init__()
 
@@ -28,23 +82,108 @@ class RedisMonitor(Thread):
         redis_host = config.get("REDIS", "redis_host", fallback="localhost")
         redis_port = config.getint("REDIS", "redis_port", fallback=6379)
         redis_password = config.get("REDIS", "redis_authpw", fallback="FooBaz")
-        self.r = redis.StrictRedis(redis_host, redis_port, password=redis_password, decode_responses=True)
+        self.redis_db = config.getint("REDIS", "redis_db", fallback=0)
+        if redis_client is None:
+            self.r = redis.StrictRedis(redis_host, redis_port, db=self.redis_db, password=redis_password,
+                                       decode_responses=True)
+        else:
+            self.r = redis_client
         self.cache_fetch_interval_ms = config.getint("REDIS", "cache_fetch_interval", fallback=3000)
         self.thread_sleep = True
 
-        self.control_defs_file = config.get("DEFAULT", "control_defs_file")
+        # bulk fetch pipelines the per mac reads into chunks of bulk_fetch_chunk_size macs per round trip
+        # with bulk_fetch_hmget, only the observed sensor type fields are read (requires the hash fields
+        # to be named by sensor type)
+        self.bulk_fetch = config.getboolean("REDIS", "bulk_fetch", fallback=False)
+        self.bulk_fetch_chunk_size = max(1, config.getint("REDIS", "bulk_fetch_chunk_size", fallback=100))
+        self.bulk_fetch_hmget = config.getboolean("REDIS", "bulk_fetch_hmget", fallback=False)
+
+        # incremental fetch runs FETCH_CHANGED_FIELDS_SCRIPT per chunk of macs, so only the readings whose
+        # timestamp advanced since the last cycle are transferred and decoded. Falls back to the bulk fetch
+        # if the server won't run the script
+        self.incremental_fetch = config.getboolean("REDIS", "incremental_fetch", fallback=False)
+        self.fetch_changed_fields_script = None
+        # mac -> hash field -> timestamp of the last payload fetched from it
+        self.field_timestamps: dict[int, dict[str, int]] = dict()
+        # what the incremental fetch saved in the last cycle
+        self.last_n_skipped = 0
+        self.last_bytes_skipped = 0
+        self.last_bytes_transferred = 0
+
+        # "poll" fetches every observed hash each cache_fetch_interval, "notify" subscribes to the keyspace
+        # notifications of the observed hashes and only refetches the ones that changed, falling back
+        # to polling if the subscription fails. The server needs notify-keyspace-events to include "Kh"
+        self.ingest_mode = config.get("REDIS", "ingest_mode", fallback="poll")
+        # notifications are fire and forget, so do a full fetch every so often to catch any we missed
+        self.notify_resync_interval_ms = config.getint("REDIS", "notify_resync_interval_ms", fallback=60000)
+        # how long to block waiting for a notification before checking the shutdown event
+        self.notify_wait_timeout_ms = config.getint("REDIS", "notify_wait_timeout_ms", fallback=500)
+
+        # per cycle fetch latency
+        self.last_fetch_latency_ms = 0.0
+        self.max_fetch_latency_ms = 0.0
+        # decode time since the last record_fetch_latency
+        self.cycle_decode_s = 0.0
+
+        self.control_defs_file = config.get("DEFAULT", "control_defs_file", fallback="control_defs.json")
 
         self.message_queue = message_queue
         self.sig_event = sig_event
 
-        self.logger.info("Loading control defs")
-        self.control_defs = ControlDefUtils.fetch_control_defs(self.control_defs_file)
-        self.logger.info("Finished loading control defs")
+        # control defs passed in directly are static, otherwise they are hot reloaded from the control defs file
+        self.control_def_watcher = None
+        self.control_def_generation = 0
+        if control_defs is None:
+            self.logger.info("Loading control defs")
+            if control_def_watcher is None:
+                control_def_watcher = ControlDefWatcher(self.control_defs_file)
+            self.control_def_watcher = control_def_watcher
+            self.control_def_generation, control_defs = control_def_watcher.get_control_defs()
+            self.logger.info("Finished loading control defs")
+
+        # (shard_id, n_shards) when this monitor only fetches its shard of the observed macs
+        self.shard = shard
 
-        self.observables = ControlDefUtils.get_observables(self.control_defs)
+        self.control_defs = control_defs
+        self.observables = self.get_observables(self.control_defs)
 
         self.last_sensor_messages: dict[int, dict] = dict()
 
+    def get_observables(self, control_defs: list[ControlDef]) -> dict[int, set]:
+        observables = ControlDefUtils.get_observables(control_defs)
+        if self.shard is not None:
+            observables = ControlDefUtils.get_shard_observables(observables, *self.shard)
+        return observables
+
+    def reload_control_defs(self) -> bool:
+        """
+        Pick up a new generation of control defs from the watcher and swap in the observables derived from it
+        :return: True if the observables were swapped
+        """
+        if self.control_def_watcher is None:
+            return False
+
+        self.control_def_watcher.check_for_changes()
+        generation, control_defs = self.control_def_watcher.get_control_defs()
+        if generation == self.control_def_generation:
+            return False
+
+        observables = self.get_observables(control_defs)
+
+        # stop tracking the readings of macs and types nobody observes anymore
+        for mac in list(self.last_sensor_messages.keys()):
+            if mac not in observables:
+                self.last_sensor_messages.pop(mac)
+        for mac in list(self.field_timestamps.keys()):
+            if mac not in observables:
+                self.field_timestamps.pop(mac)
+
+        self.control_defs = control_defs
+        self.observables = observables
+        self.control_def_generation = generation
+        self.logger.info("Reloaded control defs generation {}, observing {} macs".format(generation, len(observables)))
+        return True
+
     def get_message_safe(self, sensor_message: SensorMessageItem) -> SensorMessageItem | None:
         sensor_type_dict = self.last_sensor_messages.get(sensor_message.get_mac(), None)
         if sensor_type_dict is None:
@@ -60,6 +199,7 @@ class RedisMonitor(Thread):
         :param sensor_messages:
         :return:
         """
+        n_new = 0
         for sensor_message in sensor_messages:
             # check if the message is in the last_messages dict
             # if not, then add it
@@ -71,50 +211,271 @@ class RedisMonitor(Thread):
                 sensor_type_dict = dict()
                 self.last_sensor_messages[sensor_message.get_mac()] = sensor_type_dict
                 sensor_type_dict[sensor_message.get_type()] = sensor_message
+                n_new += 1
                 continue
             else:
                 # perhaps the type does not exist
                 sensor_type_message: SensorMessageItem = sensor_type_dict.get(sensor_message.get_type(), None)
                 if sensor_type_message is None:
                     sensor_type_dict[sensor_message.get_type()] = sensor_message
+                    n_new += 1
                     continue
                 else:
                     if sensor_type_message.get_timestamp() < sensor_message.get_timestamp():
                         sensor_type_dict[sensor_message.get_type()] = sensor_message
+                        n_new += 1
                         continue
                     else:
                         pass
                         continue
 
-    def fetch_redis_messages(self) -> list[SensorMessageItem]:
+        metrics.MESSAGES_NEW.inc(n_new)
+        metrics.MESSAGES_DEDUPLICATED.inc(len(sensor_messages) - n_new)
+
+    def decode_redis_results(self, mac: int, redis_results, sensor_messages: list[SensorMessageItem]):
         """
-        Fetch the messages from the redis cache and run the deduplication logic
+        Decode the cached values for a mac and append the ones with an observed sensor type to sensor_messages
+        :param mac:
+        :param redis_results: the cached values for the mac (None entries are skipped)
+        :param sensor_messages:
+        :return:
+        """
+        start = time.perf_counter()
+        n_decoded = 0
+        for redis_result in redis_results:
+            if redis_result is None:
+                continue
+            sensor_message_item: SensorMessageItem = SensorMessageCodec.decode(redis_result)
+            n_decoded += 1
+
+            # check if the type is in the allowed observables
+            if sensor_message_item.get_type() in (self.observables[mac]):
+                self.logger.debug("Queuing cache message:{}".format(sensor_message_item))
+                sensor_messages.append(sensor_message_item)
+
+        self.cycle_decode_s += time.perf_counter() - start
+        metrics.MESSAGES_DECODED.inc(n_decoded)
+
+    def fetch_redis_messages_single(self, macs: list[int]) -> list[SensorMessageItem]:
+        """
+        Fetch the messages from the redis cache with one HGETALL round trip per mac
+        :param macs:
         :return:
         """
         sensor_messages = list()
 
-        # we only fetch MACS that are in control_defs
-        for mac in self.observables.keys():
+        for mac in macs:
             try:
                 redis_results = self.r.hgetall(str(mac))
-                for redis_result_key in redis_results.keys():
-                    redis_result = redis_results[redis_result_key]
-                    sensor_message_item: SensorMessageItem = jsonpickle.decode(redis_result)
-
-                    # check if the type is in the allowed observables
-                    if int(sensor_message_item.get_type()) in (self.observables[mac]):
-                        self.logger.debug("Queuing cache message:{}".format(sensor_message_item))
-                        sensor_messages.append(sensor_message_item)
+                self.decode_redis_results(mac, redis_results.values(), sensor_messages)
 
             # try and get more specific with this
             except Exception as e:
                 self.logger.error("Error fetching sensor messages:{}", e)
 
+        return sensor_messages
+
+    def get_fetch_chunks(self, macs: list[int]) -> list[list[int]]:
+        return [macs[chunk_start:chunk_start + self.bulk_fetch_chunk_size]
+                for chunk_start in range(0, len(macs), self.bulk_fetch_chunk_size)]
+
+    def queue_fetch_commands(self, pipe, chunk_macs: list[int]):
+        """
+        Add the HGETALL (or HMGET) command for each mac of the chunk to the pipeline
+        :param pipe:
+        :param chunk_macs:
+        :return:
+        """
+        for mac in chunk_macs:
+            if self.bulk_fetch_hmget is True:
+                pipe.hmget(str(mac), [str(sensor_type) for sensor_type in self.observables[mac]])
+            else:
+                pipe.hgetall(str(mac))
+
+    def decode_chunk_results(self, chunk_macs: list[int], chunk_results: list,
+                             sensor_messages: list[SensorMessageItem]):
+        """
+        Decode the pipeline results of a chunk, a failed command only loses its own mac
+        :param chunk_macs:
+        :param chunk_results:
+        :param sensor_messages:
+        :return:
+        """
+        for mac, redis_results in zip(chunk_macs, chunk_results):
+            try:
+                if isinstance(redis_results, Exception):
+                    raise redis_results
+                if isinstance(redis_results, dict):
+                    redis_results = redis_results.values()
+                self.decode_redis_results(mac, redis_results, sensor_messages)
+
+            except Exception as e:
+                self.logger.error("Error fetching sensor messages for mac {}:{}".format(mac, e))
+
+    def fetch_redis_messages_bulk(self, macs: list[int]) -> list[SensorMessageItem]:
+        """
+        Fetch the messages from the redis cache, pipelining the HGETALL (or HMGET) commands
+        for bulk_fetch_chunk_size macs into a single round trip
+        :param macs:
+        :return:
+        """
+        sensor_messages = list()
+
+        for chunk_macs in self.get_fetch_chunks(macs):
+            pipe = self.r.pipeline(transaction=False)
+            self.queue_fetch_commands(pipe, chunk_macs)
+
+            try:
+                chunk_results = pipe.execute(raise_on_error=False)
+            except Exception as e:
+                # a connection error loses the whole chunk, the next cycle will pick it up again
+                self.logger.error("Error fetching sensor message chunk of {} macs:{}".format(len(chunk_macs), e))
+                continue
+
+            self.decode_chunk_results(chunk_macs, chunk_results, sensor_messages)
+
+        return sensor_messages
+
+    def get_fetch_changed_fields_script(self):
+        if self.fetch_changed_fields_script is None:
+            self.fetch_changed_fields_script = self.r.register_script(FETCH_CHANGED_FIELDS_SCRIPT)
+        return self.fetch_changed_fields_script
+
+    def get_known_field_args(self, chunk_macs: list[int]) -> list:
+        """
+        The ARGV of FETCH_CHANGED_FIELDS_SCRIPT for a chunk
+        :param chunk_macs:
+        :return:
+        """
+        args = list()
+        for mac in chunk_macs:
+            field_timestamps = self.field_timestamps.get(mac, dict())
+            args.append(len(field_timestamps))
+            for field, timestamp in field_timestamps.items():
+                args.append(field)
+                args.append(timestamp)
+        return args
+
+    def decode_changed_fields(self, mac: int, fields: list, sensor_messages: list[SensorMessageItem]) -> int:
+        """
+        Decode the (field, payload, field, payload, ...) reply of a mac, remembering each field's timestamp
+        :param mac:
+        :param fields:
+        :param sensor_messages:
+        :return: the number of payload bytes transferred
+        """
+        start = time.perf_counter()
+        n_bytes = 0
+        field_timestamps = self.field_timestamps.setdefault(mac, dict())
+        for field, payload in zip(fields[0::2], fields[1::2]):
+            n_bytes += len(payload)
+            sensor_message_item: SensorMessageItem = SensorMessageCodec.decode(payload)
+            field_timestamps[field] = sensor_message_item.get_timestamp()
+
+            if sensor_message_item.get_type() in (self.observables[mac]):
+                self.logger.debug("Queuing cache message:{}".format(sensor_message_item))
+                sensor_messages.append(sensor_message_item)
+
+        self.cycle_decode_s += time.perf_counter() - start
+        metrics.MESSAGES_DECODED.inc(len(fields) // 2)
+        return n_bytes
+
+    def fetch_redis_messages_incremental(self, macs: list[int]) -> list[SensorMessageItem] | None:
+        """
+        Fetch only the readings that changed since the last cycle, one script call per chunk of macs
+        :param macs:
+        :return: the messages, or None if the server can't run the script and the caller should fall back
+        """
+        sensor_messages = list()
+        n_skipped = 0
+        bytes_skipped = 0
+        bytes_transferred = 0
+
+        for chunk_macs in self.get_fetch_chunks(macs):
+            try:
+                chunk_results = self.get_fetch_changed_fields_script()(keys=[str(mac) for mac in chunk_macs],
+                                                                        args=self.get_known_field_args(chunk_macs))
+            except redis.exceptions.ResponseError as e:
+                self.logger.error("Incremental fetch script failed, falling back to the bulk fetch:{}".format(e))
+                return None
+            except Exception as e:
+                # a connection error loses the whole chunk, the next cycle will pick it up again
+                self.logger.error("Error fetching sensor message chunk of {} macs:{}".format(len(chunk_macs), e))
+                continue
+
+            for mac, fields in zip(chunk_macs, chunk_results[:-1]):
+                try:
+                    bytes_transferred += self.decode_changed_fields(mac, fields, sensor_messages)
+                except Exception as e:
+                    self.logger.error("Error fetching sensor messages for mac {}:{}".format(mac, e))
+
+            chunk_skipped, chunk_bytes_skipped = chunk_results[-1]
+            n_skipped += int(chunk_skipped)
+            bytes_skipped += int(chunk_bytes_skipped)
+
+        self.last_n_skipped = n_skipped
+        self.last_bytes_skipped = bytes_skipped
+        self.last_bytes_transferred = bytes_transferred
+        metrics.MESSAGES_UNCHANGED_SKIPPED.inc(n_skipped)
+        metrics.BYTES_UNCHANGED_SKIPPED.inc(bytes_skipped)
+        self.logger.debug("Incremental fetch skipped {} unchanged readings ({} bytes not decoded), "
+                          "transferred {} bytes".format(n_skipped, bytes_skipped, bytes_transferred))
+        return sensor_messages
+
+    def fetch_redis_messages(self, macs: list[int] = None):
+        """
+        Fetch the messages from the redis cache and run the deduplication logic
+        :param macs: the macs to fetch, defaults to every observed mac
+        :return:
+        """
+        start = time.perf_counter()
+
+        # we only fetch MACS that are in control_defs
+        if macs is None:
+            macs = list(self.observables.keys())
+
+        sensor_messages = None
+        if self.incremental_fetch is True:
+            sensor_messages = self.fetch_redis_messages_incremental(macs)
+            if sensor_messages is None:
+                # the server can't run the script, don't try again every cycle
+                self.incremental_fetch = False
+
+        if sensor_messages is None:
+            if self.bulk_fetch is True:
+                sensor_messages = self.fetch_redis_messages_bulk(macs)
+            else:
+                sensor_messages = self.fetch_redis_messages_single(macs)
+
+        self.record_fetch_latency(start, len(sensor_messages), len(macs))
+
         # deduplicate the messages in the queue
         self.deduplicate_sensor_messages(sensor_messages)
 
-    def inject_messages(self):
-        n_injected_messages = 0
+    def record_fetch_latency(self, start: float, n_messages: int, n_macs: int):
+        """
+        :param start: perf_counter() at the start of the fetch
+        :param n_messages:
+        :param n_macs:
+        :return:
+        """
+        self.last_fetch_latency_ms = (time.perf_counter() - start) * 1000.0
+        self.max_fetch_latency_ms = max(self.max_fetch_latency_ms, self.last_fetch_latency_ms)
+        metrics.REDIS_FETCH_SECONDS.observe(self.last_fetch_latency_ms / 1000.0)
+        metrics.DECODE_SECONDS.observe(self.cycle_decode_s)
+        self.cycle_decode_s = 0.0
+        self.logger.debug("Fetched {} cache messages from {} macs in {:.1f} ms".format(
+            n_messages, n_macs, self.last_fetch_latency_ms))
+        if self.last_fetch_latency_ms > self.cache_fetch_interval_ms:
+            self.logger.warning("Cache fetch took {:.1f} ms, longer than the {} ms fetch interval".format(
+                self.last_fetch_latency_ms, self.cache_fetch_interval_ms))
+
+    def take_unsent_messages(self) -> list[SensorMessageItem]:
+        """
+        The deduplicated messages that haven't been handed to the controller yet, flagged as sent
+        :return:
+        """
+        unsent_messages = list()
         # here we decide whether to send the messages
         # in the global storage dict based on whether
         # they are flagged as sent
@@ -123,15 +484,95 @@ class RedisMonitor(Thread):
             for sensor_type in sensor_type_dict.keys():
                 sensor_message: SensorMessageItem = sensor_type_dict[sensor_type]
                 if sensor_message.get_is_sent() is False:
-                    self.message_queue.put(sensor_message)
+                    unsent_messages.append(sensor_message)
                     sensor_message.set_is_sent(True)
-                    n_injected_messages += 1
 
-        self.logger.debug("Injected {} messages".format(n_injected_messages))
+        metrics.MESSAGES_INJECTED.inc(len(unsent_messages))
+        return unsent_messages
+
+    def inject_messages(self):
+        unsent_messages = self.take_unsent_messages()
+        for sensor_message in unsent_messages:
+            self.message_queue.put(sensor_message)
+
+        self.logger.debug("Injected {} messages".format(len(unsent_messages)))
+
+    def get_keyspace_channel(self, mac: int) -> str:
+        return "__keyspace@{}__:{}".format(self.redis_db, mac)
+
+    def run_notify(self) -> bool:
+        """
+        Wait on the keyspace notifications for the observed hashes and only refetch the macs that changed
+        :return: False if the subscription failed and the caller should fall back to polling
+        """
+        channel_prefix = self.get_keyspace_channel("")
+        subscribed_macs = set(self.observables.keys())
+        try:
+            pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(*[self.get_keyspace_channel(mac) for mac in subscribed_macs])
+        except Exception as e:
+            self.logger.error("Could not subscribe to keyspace notifications, falling back to polling:{}".format(e))
+            return False
+
+        self.logger.info("Subscribed to keyspace notifications for {} macs".format(len(self.observables)))
+
+        # start off from the current cache contents
+        self.fetch_redis_messages()
+        self.inject_messages()
+        last_resync = time.monotonic()
+
+        try:
+            while not self.sig_event.is_set():
+                if self.reload_control_defs() is True:
+                    subscribed_channels = {self.get_keyspace_channel(mac) for mac in subscribed_macs}
+                    observed_channels = {self.get_keyspace_channel(mac) for mac in self.observables.keys()}
+                    if len(subscribed_channels - observed_channels) > 0:
+                        pubsub.unsubscribe(*(subscribed_channels - observed_channels))
+                    if len(observed_channels - subscribed_channels) > 0:
+                        pubsub.subscribe(*(observed_channels - subscribed_channels))
+                    subscribed_macs = set(self.observables.keys())
+                    # pick up the current readings of the newly observed macs
+                    self.fetch_redis_messages()
+                    self.inject_messages()
+
+                changed_macs = set()
+                message = pubsub.get_message(timeout=self.notify_wait_timeout_ms / 1000.0)
+                while message is not None:
+                    if message["type"] == "message" and message["channel"].startswith(channel_prefix):
+                        changed_macs.add(int(message["channel"][len(channel_prefix):]))
+                    # drain whatever else arrived so a burst of writes becomes a single fetch
+                    message = pubsub.get_message(timeout=0)
+
+                if (time.monotonic() - last_resync) * 1000.0 >= self.notify_resync_interval_ms:
+                    self.fetch_redis_messages()
+                    self.inject_messages()
+                    last_resync = time.monotonic()
+                elif len(changed_macs) > 0:
+                    self.fetch_redis_messages([mac for mac in changed_macs if mac in self.observables])
+                    self.inject_messages()
+
+        except Exception as e:
+            self.logger.error("Keyspace notification subscription failed, falling back to polling:{}".format(e))
+            return False
+
+        finally:
+            try:
+                pubsub.close()
+            except Exception as e:
+                self.logger.error("Error closing keyspace notification subscription:{}".format(e))
+
+        return True
 
     def run(self):
+        if self.ingest_mode == "notify":
+            if self.run_notify() is True:
+                print("Exiting {}".format(self.__class__.__name__))
+                return
+
         while True:
 
+            self.reload_control_defs()
+
             self.logger.debug("Fetching REDIS cache messages")
             self.fetch_redis_messages()
             self.inject_messages()
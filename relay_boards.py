@@ -0,0 +1,63 @@
+"""
+Relay boards beyond the one on RELAY_CONTROLLER.serial_port
+
+Each additional board is a [RELAY_BOARD <board_id>] section of config.cfg:
+
+    [RELAY_BOARD boiler_room]
+    serial_port = /dev/ttyUSB1
+    default_relay_states = ...
+    board_api_mac = 303721662
+
+A control def addresses a board with its board_id, every board gets its own RelayCommandDispatcher so the
+serial writes to different boards run in parallel instead of queuing behind one port. (The key is board_api_mac
+rather than api_mac because every section inherits the [DEFAULT] api_mac of the default board.)
+"""
+import configparser
+
+from WaveshareRelayControl.relaycontrolmain import WaveshareRelayController
+
+RELAY_BOARD_SECTION_PREFIX = "RELAY_BOARD "
+
+
+def get_relay_board_ids(config: configparser.ConfigParser) -> list[str]:
+    """
+    The ids of the additional relay boards, in config file order
+    :param config:
+    :return:
+    """
+    return [section[len(RELAY_BOARD_SECTION_PREFIX):].strip() for section in config.sections()
+            if section.startswith(RELAY_BOARD_SECTION_PREFIX)]
+
+
+def get_relay_board_section(board_id: str) -> str:
+    return RELAY_BOARD_SECTION_PREFIX + board_id
+
+
+def build_relay_boards(config: configparser.ConfigParser) -> dict[str, WaveshareRelayController]:
+    """
+    Open the additional relay boards
+    :param config:
+    :return: board id -> relay controller
+    """
+    relay_boards = dict()
+    for board_id in get_relay_board_ids(config):
+        section = get_relay_board_section(board_id)
+        default_states_str = config.get(section, "default_relay_states", fallback=None)
+        relay_boards[board_id] = WaveshareRelayController(
+            config.get(section, "serial_port"),
+            default_states=WaveshareRelayController.parse_default_states(default_states_str))
+    return relay_boards
+
+
+def get_relay_board_api_macs(config: configparser.ConfigParser) -> dict[str, int]:
+    """
+    The mac each additional board reports its channel states to the API under, boards without one aren't reported
+    :param config:
+    :return: board id -> api mac
+    """
+    api_macs = dict()
+    for board_id in get_relay_board_ids(config):
+        api_mac = config.getint(get_relay_board_section(board_id), "board_api_mac", fallback=-1)
+        if api_mac != -1:
+            api_macs[board_id] = api_mac
+    return api_macs
@@ -0,0 +1,312 @@
+import logging
+import time
+from threading import Thread, Condition
+
+import metrics
+from WaveshareRelayControl.relaycontrolmain import WaveshareRelayController
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+
+
+class RelayCommandStats:
+    """
+    Counters, latency (submit to write complete) and health for the relay commands to one board,
+    the board counts as unhealthy from a failed write until the next write succeeds
+    """
+
+    def __init__(self):
+        self.n_submitted = 0
+        self.n_collapsed = 0
+        self.n_skipped = 0
+        self.n_written = 0
+        self.n_failed = 0
+        self.n_consecutive_failures = 0
+        self.total_latency_ms = 0.0
+        self.max_latency_ms = 0.0
+        self.last_latency_ms = 0.0
+
+    def record_write(self, latency_ms: float):
+        self.n_written += 1
+        self.n_consecutive_failures = 0
+        self.total_latency_ms += latency_ms
+        self.max_latency_ms = max(self.max_latency_ms, latency_ms)
+        self.last_latency_ms = latency_ms
+        metrics.RELAY_COMMAND_LATENCY_SECONDS.observe(latency_ms / 1000.0)
+
+    def record_failure(self):
+        self.n_failed += 1
+        self.n_consecutive_failures += 1
+        metrics.RELAY_COMMANDS_FAILED.inc()
+
+    def is_healthy(self) -> bool:
+        return self.n_consecutive_failures == 0
+
+    def get_mean_latency_ms(self) -> float:
+        if self.n_written == 0:
+            return 0.0
+        return self.total_latency_ms / self.n_written
+
+    def as_dict(self) -> dict:
+        return {
+            "submitted": self.n_submitted,
+            "collapsed": self.n_collapsed,
+            "skipped": self.n_skipped,
+            "written": self.n_written,
+            "failed": self.n_failed,
+            "consecutive_failures": self.n_consecutive_failures,
+            "healthy": self.is_healthy(),
+            "mean_latency_ms": self.get_mean_latency_ms(),
+            "max_latency_ms": self.max_latency_ms,
+            "last_latency_ms": self.last_latency_ms
+        }
+
+
+class RelayCommandQueue:
+    """
+    The per channel command state of a relay board, shared by RelayCommandDispatcher and the asyncio
+    runtime's AsyncRelayWriter, which only differ in how they wait for commands and write them
+
+    A command replaces any command still waiting for its channel (a failed one waiting to be retried too),
+    a write is skipped when the channel is already in the target state, and a failed write is retried after
+    retry_min_ms, doubling up to retry_max_ms, until it succeeds or a newer command for the channel replaces it.
+    Not thread safe, the owner serializes the calls.
+    """
+
+    def __init__(self, channel_states: dict[WaveshareDef, int | None], retry_min_ms: int = 100,
+                 retry_max_ms: int = 10000):
+        self.logger = logging.getLogger(__name__)
+
+        self._retry_min_ms = retry_min_ms
+        self._retry_max_ms = retry_max_ms
+
+        # channel -> (state, submit time) of the commands waiting to be written
+        self._pending: dict[WaveshareDef, tuple[int, float]] = dict()
+        # channel -> (state, submit time, retry time) of the failed commands waiting to be retried
+        self._retries: dict[WaveshareDef, tuple[int, float, float]] = dict()
+        # channel -> consecutive failed writes, for the backoff
+        self._n_failures: dict[WaveshareDef, int] = dict()
+        # the last state written to each channel
+        self._channel_states: dict[WaveshareDef, int | None] = dict(channel_states)
+
+        self.stats = RelayCommandStats()
+
+    def submit(self, channel: WaveshareDef, state: int):
+        """
+        Queue a command for the channel, replacing any command still waiting for it
+        :param channel:
+        :param state:
+        :return:
+        """
+        self.stats.n_submitted += 1
+        if channel in self._pending:
+            self.stats.n_collapsed += 1
+        self._retries.pop(channel, None)
+        self._n_failures.pop(channel, None)
+        self._pending[channel] = (state, time.perf_counter())
+
+    def has_pending(self) -> bool:
+        return len(self._pending) > 0
+
+    def get_channel_states(self) -> dict[WaveshareDef, int | None]:
+        """
+        The channel states, including the commands that have been submitted but not written yet
+        :return:
+        """
+        channel_states = dict(self._channel_states)
+        for channel, (state, _, _) in self._retries.items():
+            channel_states[channel] = state
+        for channel, (state, _) in self._pending.items():
+            channel_states[channel] = state
+        return channel_states
+
+    def get_next_retry_s(self) -> float | None:
+        """
+        Seconds until the earliest retry is due, None without failed commands
+        :return:
+        """
+        if len(self._retries) == 0:
+            return None
+        return min(retry_time for _, _, retry_time in self._retries.values()) - time.perf_counter()
+
+    def take_pending(self) -> dict[WaveshareDef, tuple[int, float]]:
+        """
+        Take the commands waiting to be written, with the failed ones whose retry is due
+        :return: channel -> (state, submit time)
+        """
+        now = time.perf_counter()
+        for channel, (state, submit_time, retry_time) in list(self._retries.items()):
+            if retry_time <= now:
+                del self._retries[channel]
+                self._pending[channel] = (state, submit_time)
+
+        pending = self._pending
+        self._pending = dict()
+        return pending
+
+    def skip_write(self, channel: WaveshareDef, state: int) -> bool:
+        """
+        :param channel:
+        :param state:
+        :return: True if the channel is already in the state and the write is skipped
+        """
+        if self._channel_states.get(channel, None) == state:
+            self.stats.n_skipped += 1
+            return True
+        return False
+
+    def record_write(self, channel: WaveshareDef, state: int, submit_time: float):
+        self._channel_states[channel] = state
+        self._n_failures.pop(channel, None)
+        self.stats.record_write((time.perf_counter() - submit_time) * 1000.0)
+
+    def record_failure(self, channel: WaveshareDef, state: int, submit_time: float):
+        """
+        Retry a failed write with exponential backoff, unless a newer command for the channel arrived meanwhile.
+        The known state of the channel is left alone so the retry isn't skipped
+        :param channel:
+        :param state:
+        :param submit_time:
+        :return:
+        """
+        self.stats.record_failure()
+        if channel in self._pending:
+            return
+        n_failures = self._n_failures.get(channel, 0) + 1
+        self._n_failures[channel] = n_failures
+        retry_ms = min(self._retry_max_ms, self._retry_min_ms * (2 ** (n_failures - 1)))
+        self._retries[channel] = (state, submit_time, time.perf_counter() + retry_ms / 1000.0)
+        self.logger.warning("Retrying relay command {} to channel {} in {} ms".format(state, channel, retry_ms))
+
+    def get_failed_commands(self) -> dict[WaveshareDef, int]:
+        """
+        :return: channel -> state of the failed commands still waiting to be retried
+        """
+        return {channel: state for channel, (state, _, _) in self._retries.items()}
+
+
+class RelayCommandDispatcher(Thread):
+    """
+    Writes relay commands on its own worker thread, so a serial round trip to the relay board doesn't
+    stall the evaluation of every other sensor on the controller thread
+
+    It has the same set_channel_on / set_channel_off / get_channel_states interface as the
+    WaveshareRelayController it wraps, so the controller can use either one.
+
+    Commands for the same channel that arrive within coalesce_window_ms of each other collapse into
+    the last one, and the RelayCommandQueue skips the writes of channels already in their target state and
+    retries the failed ones. The relay controller only exposes per channel writes, the pending channel changes
+    are written back to back in one pass of the worker.
+
+    A failed write has to be retried: the controller has already marked the control as executed, so
+    nothing else would ever write the channel again.
+    """
+
+    def __init__(self, relay_controller: WaveshareRelayController, coalesce_window_ms: float = 50.0,
+                 retry_min_ms: int = 100, retry_max_ms: int = 10000):
+
+        super(RelayCommandDispatcher, self).__init__()
+
+        self.logger = logging.getLogger(__name__)
+
+        self._relay_controller = relay_controller
+        self._coalesce_window_ms = coalesce_window_ms
+        self._condition = Condition()
+        self._stopping = False
+
+        # only touched with the condition held
+        self._commands = RelayCommandQueue(relay_controller.get_channel_states(), retry_min_ms, retry_max_ms)
+
+    def set_channel_on(self, channel: WaveshareDef):
+        self.submit(channel, 1)
+
+    def set_channel_off(self, channel: WaveshareDef):
+        self.submit(channel, 0)
+
+    def set_default_states(self):
+        self._relay_controller.set_default_states()
+
+    def submit(self, channel: WaveshareDef, state: int):
+        """
+        Queue a command for the channel, replacing any command still waiting for it
+        :param channel:
+        :param state:
+        :return:
+        """
+        with self._condition:
+            self._commands.submit(channel, state)
+            self._condition.notify()
+
+    def get_channel_states(self) -> dict[WaveshareDef, int | None]:
+        """
+        The channel states, including the commands that have been submitted but not written yet
+        :return:
+        """
+        with self._condition:
+            return self._commands.get_channel_states()
+
+    def get_stats(self) -> dict:
+        with self._condition:
+            return self._commands.stats.as_dict()
+
+    def stop(self):
+        """
+        Stop the worker once the pending commands are written
+        :return:
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+
+    def take_pending(self) -> dict[WaveshareDef, tuple[int, float]]:
+        """
+        Wait for commands or a due retry, give later commands for the same channels the coalesce window
+        to arrive, then take everything that is pending
+        :return:
+        """
+        with self._condition:
+            while (self._commands.has_pending() is False) and (self._stopping is False):
+                next_retry_s = self._commands.get_next_retry_s()
+                if (next_retry_s is not None) and (next_retry_s <= 0):
+                    break
+                self._condition.wait(timeout=next_retry_s)
+
+            if (self._commands.has_pending() is True) and (self._stopping is False) and \
+                    (self._coalesce_window_ms > 0):
+                self._condition.wait_for(lambda: self._stopping, timeout=self._coalesce_window_ms / 1000.0)
+
+            return self._commands.take_pending()
+
+    def write_channel(self, channel: WaveshareDef, state: int, submit_time: float):
+        with self._condition:
+            if self._commands.skip_write(channel, state) is True:
+                return
+
+        try:
+            if state == 1:
+                self._relay_controller.set_channel_on(channel)
+            else:
+                self._relay_controller.set_channel_off(channel)
+
+        except Exception as e:
+            self.logger.error("Error writing relay command {} to channel {}:{}".format(state, channel, e))
+            with self._condition:
+                self._commands.record_failure(channel, state, submit_time)
+            return
+
+        with self._condition:
+            self._commands.record_write(channel, state, submit_time)
+
+    def run(self):
+        while True:
+            pending = self.take_pending()
+            for channel, (state, submit_time) in pending.items():
+                self.write_channel(channel, state, submit_time)
+
+            with self._condition:
+                if (self._stopping is True) and (self._commands.has_pending() is False):
+                    failed_commands = self._commands.get_failed_commands()
+                    if len(failed_commands) > 0:
+                        self.logger.error("Relay dispatcher stopping with failed commands not written:{}".format(
+                            failed_commands))
+                    break
+
+        self.logger.info("Relay command dispatcher stopped, stats:{}".format(self.get_stats()))
@@ -0,0 +1,99 @@
+"""
+Relay cycle limits, so bang-bang control doesn't wear out the contactors
+
+A control def can set a minimum dwell in each state (min_on_millis in its control func state, min_off_millis
+back to normal) and a maximum number of switches of its channel per rolling hour. RelayCycleGuard tracks the
+last commanded state of every relay channel, when it changed and when it switched in the last hour, and tells
+the controller when a switch a def asks for is allowed. The controller holds back a switch that isn't allowed
+yet and retries it from its deadline scheduler (max_on_millis is enforced there too).
+"""
+from collections import deque
+
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+from control_defs import ControlDef, ControlFunc
+
+HOUR_MS = 3600000
+
+
+class ChannelCycleState:
+
+    __slots__ = ("state", "changed_ms", "switch_times")
+
+    def __init__(self, state: int, changed_ms: int):
+        self.state = state
+        self.changed_ms = changed_ms
+        # the times of the switches in the last hour
+        self.switch_times: deque[int] = deque()
+
+
+class RelayCycleGuard:
+
+    def __init__(self):
+        self._channels: dict[tuple[str, WaveshareDef], ChannelCycleState] = dict()
+
+    @staticmethod
+    def get_active_state(control_def: ControlDef) -> int:
+        """
+        The relay state the def's control func puts its channel in
+        :param control_def:
+        :return:
+        """
+        return 1 if control_def.get_control_func() == ControlFunc.ON else 0
+
+    def get_allowed_ms(self, board_id: str, channel: WaveshareDef, state: int, control_def: ControlDef,
+                       now_ms: int) -> int | None:
+        """
+        When the def may switch the channel to a state
+        :param board_id:
+        :param channel:
+        :param state:
+        :param control_def:
+        :param now_ms:
+        :return: None if it may now (including when the channel is already in that state or was never commanded),
+        otherwise the earliest time it may
+        """
+        channel_state = self._channels.get((board_id, channel), None)
+        if (channel_state is None) or (channel_state.state == state):
+            return None
+
+        if channel_state.state == RelayCycleGuard.get_active_state(control_def):
+            allowed_ms = channel_state.changed_ms + control_def.get_min_on_millis()
+        else:
+            allowed_ms = channel_state.changed_ms + control_def.get_min_off_millis()
+
+        max_switches = control_def.get_max_switches_per_hour()
+        if max_switches > 0:
+            switch_times = channel_state.switch_times
+            while (len(switch_times) > 0) and (switch_times[0] <= now_ms - HOUR_MS):
+                switch_times.popleft()
+            if len(switch_times) >= max_switches:
+                # the switch that has to leave the hour before this one fits
+                allowed_ms = max(allowed_ms, switch_times[len(switch_times) - max_switches] + HOUR_MS)
+
+        if allowed_ms <= now_ms:
+            return None
+        return allowed_ms
+
+    def record(self, board_id: str, channel: WaveshareDef, state: int, now_ms: int):
+        """
+        Note a command written to a channel
+        :param board_id:
+        :param channel:
+        :param state:
+        :param now_ms:
+        :return:
+        """
+        channel_state = self._channels.get((board_id, channel), None)
+        if channel_state is None:
+            # the channel's state before its first command is unknown, count the command as a switch
+            channel_state = ChannelCycleState(state, now_ms)
+            self._channels[(board_id, channel)] = channel_state
+        elif channel_state.state == state:
+            return
+
+        channel_state.state = state
+        channel_state.changed_ms = now_ms
+        switch_times = channel_state.switch_times
+        switch_times.append(now_ms)
+        while switch_times[0] <= now_ms - HOUR_MS:
+            switch_times.popleft()
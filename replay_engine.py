@@ -0,0 +1,282 @@
+"""
+Deterministic replay of sensor message streams through the control logic
+
+The ReplayEngine feeds recorded or generated messages through a real BangBangController, driven by a
+VirtualClock that follows the message timestamps instead of the wall clock, with a MockRelayController in
+place of the relay board. Hours of readings replay in a fraction of a second without hardware, and the
+result is a timeline of the relay transitions each control def caused.
+
+Recorded streams are files of one cached message per line, in either format SensorMessageCodec decodes.
+"""
+import logging
+import queue
+import threading
+import time
+from typing import Iterable
+
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+from bang_bang_controller import BangBangController
+from control_defs import ControlDef, ControlFunc, ThresholdType, DEFAULT_BOARD_ID
+from mock_relay_controller import MockRelayController
+from sensor_message_codec import SensorMessageCodec
+from sensor_message_item import SensorMessageItem
+
+
+class VirtualClock:
+    """
+    A clock that only moves when it is told to, time() has the same signature as time.time()
+    """
+
+    def __init__(self, start_ms: int = 0):
+        self._time_ms = start_ms
+
+    def time(self) -> float:
+        return self._time_ms / 1000.0
+
+    def get_time_ms(self) -> int:
+        return self._time_ms
+
+    def set_time_ms(self, time_ms: int):
+        # the clock never runs backwards, an out of order message is processed at the current time
+        if time_ms > self._time_ms:
+            self._time_ms = time_ms
+
+    def advance_ms(self, delta_ms: int):
+        self._time_ms += delta_ms
+
+
+class RelayTransition:
+    """
+    A relay command issued by a control def, with the reading that caused it
+    """
+
+    def __init__(self, time_ms: int, control_def_uuid: str, mac: int, sensor_type: int,
+                 sensor_data: float, channel: WaveshareDef, state: int, back_to_normal: bool):
+        self._time_ms = time_ms
+        self._control_def_uuid = control_def_uuid
+        self._mac = mac
+        self._sensor_type = sensor_type
+        self._sensor_data = sensor_data
+        self._channel = channel
+        self._state = state
+        self._back_to_normal = back_to_normal
+
+    def get_time_ms(self) -> int:
+        return self._time_ms
+
+    def get_control_def_uuid(self) -> str:
+        return self._control_def_uuid
+
+    def get_mac(self) -> int:
+        return self._mac
+
+    def get_sensor_type(self) -> int:
+        return self._sensor_type
+
+    def get_sensor_data(self) -> float:
+        return self._sensor_data
+
+    def get_channel(self) -> WaveshareDef:
+        return self._channel
+
+    def get_state(self) -> int:
+        return self._state
+
+    def get_back_to_normal(self) -> bool:
+        return self._back_to_normal
+
+    def __str__(self):
+        return "{{ time_ms:{}, mac:{}, sensor_type:{}, data:{}, channel:{}, state:{}, back_to_normal:{} }}".format(
+            self._time_ms, self._mac, self._sensor_type, self._sensor_data, self._channel, self._state,
+            self._back_to_normal)
+
+
+class ReplayBangBangController(BangBangController):
+    """
+    Records every control and back to normal command into the timeline of the control def that issued it
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ReplayBangBangController, self).__init__(*args, **kwargs)
+        self.timeline: dict[str, list[RelayTransition]] = dict()
+
+    def record_transition(self, sensor_message: SensorMessageItem, control_def: ControlDef,
+                          control_func: ControlFunc, back_to_normal: bool):
+        state = 1 if control_func == ControlFunc.ON else 0
+        self.timeline.setdefault(control_def.get_uuid(), list()).append(
+            RelayTransition(self.now_ms(), control_def.get_uuid(), sensor_message.get_mac(), sensor_message.get_type(),
+                            sensor_message.get_data(), control_def.get_control_channel(), state, back_to_normal))
+
+    def execute_control_command(self, sensor_message: SensorMessageItem, control_def: ControlDef):
+        super(ReplayBangBangController, self).execute_control_command(sensor_message, control_def)
+        # a switch held back by the cycle limits leaves the trigger pending
+        control_trigger = self.control_triggers.get(self.get_control_trigger_key(sensor_message, control_def), None)
+        if (control_trigger is not None) and (control_trigger.get_control_func_execution_time_ms() is not None):
+            self.record_transition(sensor_message, control_def, control_def.get_control_func(), False)
+
+    def execute_back_to_normal_command(self, sensor_message: SensorMessageItem, control_def: ControlDef):
+        super(ReplayBangBangController, self).execute_back_to_normal_command(sensor_message, control_def)
+        if self.get_control_trigger_key(sensor_message, control_def) not in self.control_triggers:
+            self.record_transition(sensor_message, control_def, control_def.get_back_to_normal_func(), True)
+
+    def execute_max_on_command(self, sensor_message: SensorMessageItem, control_def: ControlDef):
+        self.record_transition(sensor_message, control_def, control_def.get_back_to_normal_func(), True)
+        super(ReplayBangBangController, self).execute_max_on_command(sensor_message, control_def)
+
+    def execute_stale_command(self, sensor_message: SensorMessageItem, control_def: ControlDef,
+                              control_func: ControlFunc):
+        self.record_transition(sensor_message, control_def, control_func,
+                               control_func == control_def.get_back_to_normal_func())
+        super(ReplayBangBangController, self).execute_stale_command(sensor_message, control_def, control_func)
+
+
+class ReplayEngine:
+    """
+    Replays message streams in timestamp order: the virtual clock is moved to each message's timestamp,
+    the control triggers due by then are expired, and the message is processed
+    """
+
+    def __init__(self, control_defs: list[ControlDef], start_ms: int = 0):
+        self.logger = logging.getLogger(__name__)
+
+        self.clock = VirtualClock(start_ms)
+        self.relay_controller = MockRelayController()
+        # a mock board for every other board the control defs address
+        self.relay_boards = {control_def.get_board_id(): MockRelayController() for control_def in control_defs
+                             if control_def.get_board_id() != DEFAULT_BOARD_ID}
+        # commands are written inline even if the config enables the dispatchers, so the timeline is deterministic
+        self.controller = ReplayBangBangController(queue.Queue(), threading.Event(),
+                                                   relay_controller=self.relay_controller,
+                                                   control_defs=control_defs,
+                                                   report_to_api=False,
+                                                   clock=self.clock.time,
+                                                   control_state_file="",
+                                                   relay_boards=self.relay_boards,
+                                                   inline_relay_commands=True)
+        self.n_messages = 0
+
+    def replay(self, sensor_messages: Iterable[SensorMessageItem]):
+        """
+        :param sensor_messages: in timestamp order
+        :return:
+        """
+        clock = self.clock
+        controller = self.controller
+        control_triggers = controller.control_triggers
+        deadlines = controller.deadlines
+        sensor_liveness = controller.sensor_liveness
+        process_message = controller.process_message
+
+        # the trigger heap is only consulted again once the store has changed size (a trigger was created or
+        # returned to normal), extending a pending trigger only moves its expiry later so the cached value
+        # stays a lower bound and at worst costs one expire() call that finds nothing
+        n_triggers = len(control_triggers)
+        next_expiry_ms = control_triggers.get_next_expiry_ms()
+        n_messages = 0
+
+        for sensor_message in sensor_messages:
+            clock.set_time_ms(sensor_message.get_timestamp())
+
+            if (next_expiry_ms is not None) and (next_expiry_ms <= clock.get_time_ms()):
+                controller.expire_control_triggers(clock.get_time_ms())
+                next_expiry_ms = control_triggers.get_next_expiry_ms()
+                n_triggers = len(control_triggers)
+            # the cycle limit timers, due at the virtual time of the reading that passes them
+            if len(deadlines) > 0:
+                deadlines.run_due(clock.get_time_ms())
+            # the sensors that went silent before the reading's virtual time
+            if sensor_liveness.has_timers() is True:
+                controller.check_sensor_liveness(clock.get_time_ms())
+
+            process_message(sensor_message)
+            n_messages += 1
+
+            if len(control_triggers) != n_triggers:
+                next_expiry_ms = control_triggers.get_next_expiry_ms()
+                n_triggers = len(control_triggers)
+
+        self.n_messages += n_messages
+
+    def get_timeline(self) -> dict[str, list[RelayTransition]]:
+        """
+        :return: control def uuid -> the relay transitions it caused, in time order
+        """
+        return self.controller.timeline
+
+    def get_channel_states(self) -> dict[WaveshareDef, int | None]:
+        return self.relay_controller.get_channel_states()
+
+
+def load_sensor_messages(messages_file: str) -> list[SensorMessageItem]:
+    """
+    Load a recorded stream, one cached message per line, sorted into timestamp order
+    :param messages_file:
+    :return:
+    """
+    sensor_messages = list()
+    with open(messages_file) as lines:
+        for line in lines:
+            line = line.strip()
+            if line != "":
+                sensor_messages.append(SensorMessageCodec.decode(line))
+
+    sensor_messages.sort(key=lambda sensor_message: sensor_message.get_timestamp())
+    return sensor_messages
+
+
+def triangle_wave_messages(mac: int, sensor_type: int, start_ms: int, duration_ms: int, interval_ms: int,
+                           min_max_range: tuple[float, float], period_ms: int) -> list[SensorMessageItem]:
+    """
+    Generate readings that ramp from min to max and back every period_ms, like the triangle wave
+    in test_bang_bang_controller
+    :param mac:
+    :param sensor_type:
+    :param start_ms:
+    :param duration_ms:
+    :param interval_ms: time between readings
+    :param min_max_range:
+    :param period_ms:
+    :return:
+    """
+    min_val, max_val = min_max_range
+    sensor_messages = list()
+    for offset_ms in range(0, duration_ms, interval_ms):
+        phase = (offset_ms % period_ms) / period_ms
+        value = min_val + (max_val - min_val) * (1.0 - abs(2.0 * phase - 1.0))
+        sensor_messages.append(SensorMessageItem(mac, sensor_type, value, start_ms + offset_ms))
+    return sensor_messages
+
+
+def main():
+    control_def = ControlDef(uuid="941a5640-82ac-11ee-b962-0242ac120002",
+                             macs={303721692},
+                             sensor_types=[248],
+                             threshold_value=28.0,
+                             hysteresis=1.5,
+                             threshold_type=ThresholdType.OVERSHOOT,
+                             threshold_duration_millis=10000,
+                             control_func=ControlFunc.ON,
+                             control_channel=WaveshareDef.CH1,
+                             back_to_normal_func=ControlFunc.OFF,
+                             allow_back_to_normal=True,
+                             fuzz_ms=500)
+
+    # 2 hours of a 20 to 30 degree triangle wave with a 2 minute period, a reading every second
+    sensor_messages = triangle_wave_messages(303721692, 248, 0, 2 * 60 * 60 * 1000, 1000, (20.0, 30.0), 120000)
+
+    replay_engine = ReplayEngine([control_def])
+    start = time.perf_counter()
+    replay_engine.replay(sensor_messages)
+    elapsed_s = time.perf_counter() - start
+
+    for control_def_uuid, transitions in replay_engine.get_timeline().items():
+        print("Control def {}: {} relay transitions".format(control_def_uuid, len(transitions)))
+        for transition in transitions[:6]:
+            print("  {}".format(transition))
+
+    print("Replayed {} readings in {:.3f} s ({:.0f} readings/s)".format(
+        replay_engine.n_messages, elapsed_s, replay_engine.n_messages / elapsed_s))
+
+
+if __name__ == "__main__":
+    main()
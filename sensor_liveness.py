@@ -0,0 +1,156 @@
+"""
+Liveness of the sensors the control defs read, so a sensor that stops reporting doesn't leave its control
+triggers and relays frozen in whatever state they had
+
+Every (mac, sensor type) a def with a staleness timeout reads has a timer in a hierarchical timing wheel
+(see timing_wheel), pushed back by each of its readings. A reading costs two dict lookups for its timeout and
+an O(1) re-schedule, however many sensors are tracked, and the controller turns the wheel from its run loop:
+the sensors whose timer fires have gone stale and the controller runs the failsafe of the defs that read them.
+A stale sensor is tracked again from its next reading.
+
+The timeout of a def is its stale_timeout_millis, or the config's stale_sensor_timeout_ms when that is 0, and a
+sensor read by several defs goes stale after the shortest of theirs. Wildcard defs track their sensors from
+the first reading, the sensors of the defs that name their macs are tracked from when the defs are loaded.
+"""
+from typing import Callable
+
+from control_defs import ControlDef, ControlRule
+from timing_wheel import HierarchicalTimingWheel
+
+
+class SensorLivenessTracker:
+
+    def __init__(self, default_timeout_ms: int = 0, tick_ms: int = 1000):
+        self._default_timeout_ms = default_timeout_ms
+        self._wheel = HierarchicalTimingWheel(tick_ms)
+        # (mac, sensor type) -> timeout ms of the defs that name their macs
+        self._timeouts: dict[tuple[int, int], int] = dict()
+        # sensor type -> timeout ms of the wildcard defs
+        self._wildcard_timeouts: dict[int, int] = dict()
+        # (mac, sensor type) -> when it went stale
+        self._stale: dict[tuple[int, int], int] = dict()
+        self._n_went_stale = 0
+
+    def get_timeout_ms(self, control_def: ControlDef) -> int:
+        """
+        :param control_def:
+        :return: the def's staleness timeout, 0 if its sensors aren't tracked
+        """
+        if control_def.get_stale_timeout_millis() > 0:
+            return control_def.get_stale_timeout_millis()
+        return max(self._default_timeout_ms, 0)
+
+    def get_sensor_timeout_ms(self, mac: int, sensor_type: int) -> int:
+        """
+        :param mac:
+        :param sensor_type:
+        :return: the shortest staleness timeout of the defs that read the sensor, 0 if it isn't tracked
+        """
+        timeout_ms = self._timeouts.get((mac, sensor_type), 0)
+        wildcard_timeout_ms = self._wildcard_timeouts.get(sensor_type, 0)
+        if (timeout_ms == 0) or ((wildcard_timeout_ms > 0) and (wildcard_timeout_ms < timeout_ms)):
+            return wildcard_timeout_ms
+        return timeout_ms
+
+    def compile(self, control_defs: list[ControlDef], now_ms: int, owns_mac: Callable[[int], bool] = None):
+        """
+        Work out the timeout of every sensor the defs read, call this whenever the defs are reloaded. The sensors
+        no def tracks any more are forgotten, the ones not yet tracked get a full timeout from now
+        :param control_defs:
+        :param now_ms:
+        :param owns_mac: the macs whose readings reach this tracker (e.g. of a shard), None for every mac
+        :return:
+        """
+        timeouts = dict()
+        wildcard_timeouts = dict()
+        for control_def in control_defs:
+            timeout_ms = self.get_timeout_ms(control_def)
+            if timeout_ms == 0:
+                continue
+            predicates = control_def.get_leaves() if isinstance(control_def, ControlRule) else [control_def]
+            for predicate in predicates:
+                macs = predicate.get_macs()
+                for sensor_type in predicate.get_sensor_types():
+                    if len(macs) == 0:
+                        wildcard_timeouts[sensor_type] = min(wildcard_timeouts.get(sensor_type, timeout_ms),
+                                                             timeout_ms)
+                        continue
+                    for mac in macs:
+                        timeouts[(mac, sensor_type)] = min(timeouts.get((mac, sensor_type), timeout_ms), timeout_ms)
+
+        self._timeouts = timeouts
+        self._wildcard_timeouts = wildcard_timeouts
+
+        for key in self._wheel.get_keys():
+            if self.get_sensor_timeout_ms(key[0], key[1]) == 0:
+                self._wheel.cancel(key)
+        for key in list(self._stale.keys()):
+            if self.get_sensor_timeout_ms(key[0], key[1]) == 0:
+                del self._stale[key]
+
+        self._wheel.start(now_ms)
+        for key in timeouts.keys():
+            if (key in self._wheel) or (key in self._stale):
+                continue
+            if (owns_mac is None) or (owns_mac(key[0]) is True):
+                self._wheel.schedule(key, now_ms + self.get_sensor_timeout_ms(key[0], key[1]))
+
+    def seen(self, mac: int, sensor_type: int, now_ms: int) -> bool:
+        """
+        Note a reading, pushing the sensor's timer back by its timeout
+        :param mac:
+        :param sensor_type:
+        :param now_ms:
+        :return: True if the sensor was stale until this reading
+        """
+        timeout_ms = self.get_sensor_timeout_ms(mac, sensor_type)
+        if timeout_ms == 0:
+            return False
+        key = (mac, sensor_type)
+        self._wheel.schedule(key, now_ms + timeout_ms)
+        return (len(self._stale) > 0) and (self._stale.pop(key, None) is not None)
+
+    def advance(self, now_ms: int) -> list[tuple[int, int]]:
+        """
+        :param now_ms:
+        :return: the (mac, sensor type) of the sensors that went stale by now
+        """
+        went_stale = self._wheel.advance(now_ms)
+        for key in went_stale:
+            self._stale[key] = now_ms
+        self._n_went_stale += len(went_stale)
+        return went_stale
+
+    def get_next_check_ms(self) -> int | None:
+        """
+        When advance() next has to run, None while no sensor is tracked
+        :return:
+        """
+        return self._wheel.get_next_tick_ms()
+
+    def is_tracking(self) -> bool:
+        """
+        :return: whether any def has a staleness timeout, the readings only have to be noted then
+        """
+        return (len(self._timeouts) > 0) or (len(self._wildcard_timeouts) > 0)
+
+    def has_timers(self) -> bool:
+        return len(self._wheel) > 0
+
+    def is_stale(self, mac: int, sensor_type: int) -> bool:
+        return (mac, sensor_type) in self._stale
+
+    def get_stale_sensors(self) -> dict[tuple[int, int], int]:
+        """
+        :return: (mac, sensor type) -> when it went stale
+        """
+        return dict(self._stale)
+
+    def get_n_stale(self) -> int:
+        return len(self._stale)
+
+    def get_n_tracked(self) -> int:
+        return len(self._wheel) + len(self._stale)
+
+    def get_n_went_stale(self) -> int:
+        return self._n_went_stale
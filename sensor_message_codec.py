@@ -0,0 +1,86 @@
+import json
+
+import jsonpickle
+
+from sensor_message_item import SensorMessageItem
+
+
+class SensorMessageCodec:
+    """
+    Decode cached sensor messages straight into typed SensorMessageItem fields
+
+    Two wire formats are accepted:
+
+    jsonpickle (what the cache producers write today):
+    {"py/object": "sensor_message_item.SensorMessageItem", "_mac": 303721692, "_type": 248,
+     "_data": 21.5, "_timestamp": 1700000000000, "_sent": false}
+
+    compact:
+    {"mac": 303721692, "type": 248, "data": 21.5, "timestamp": 1700000000000}
+
+    Anything else (for example a jsonpickle payload with a different object layout) is handed to
+    jsonpickle.decode, so the decoder never rejects a message jsonpickle would have accepted.
+    """
+
+    @staticmethod
+    def decode_jsonpickle(payload: str) -> SensorMessageItem:
+        """
+        jsonpickle sets the slots without casting them, so rebuild the item through the constructor
+        :param payload:
+        :return:
+        """
+        sensor_message = jsonpickle.decode(payload)
+        if isinstance(sensor_message, SensorMessageItem):
+            return SensorMessageItem(getattr(sensor_message, "_mac", -1),
+                                     getattr(sensor_message, "_type", -1),
+                                     getattr(sensor_message, "_data", -1.0),
+                                     getattr(sensor_message, "_timestamp", -1),
+                                     getattr(sensor_message, "_sent", False))
+        return sensor_message
+
+    @staticmethod
+    def decode(payload: str) -> SensorMessageItem:
+        """
+        Decode a cached payload, casting each field once
+        :param payload:
+        :return:
+        """
+        try:
+            fields = json.loads(payload)
+        except ValueError:
+            return SensorMessageCodec.decode_jsonpickle(payload)
+
+        if not isinstance(fields, dict):
+            return SensorMessageCodec.decode_jsonpickle(payload)
+
+        # the constructor casts the fields
+        try:
+            if "_mac" in fields:
+                return SensorMessageItem(fields["_mac"],
+                                         fields["_type"],
+                                         fields["_data"],
+                                         fields["_timestamp"],
+                                         fields.get("_sent", False))
+            if "mac" in fields:
+                return SensorMessageItem(fields["mac"],
+                                         fields["type"],
+                                         fields["data"],
+                                         fields["timestamp"])
+        except (KeyError, TypeError, ValueError):
+            pass
+
+        return SensorMessageCodec.decode_jsonpickle(payload)
+
+    @staticmethod
+    def encode_compact(sensor_message: SensorMessageItem) -> str:
+        """
+        Encode a sensor message in the compact wire format
+        :param sensor_message:
+        :return:
+        """
+        return json.dumps({
+            "mac": sensor_message.get_mac(),
+            "type": sensor_message.get_type(),
+            "data": sensor_message.get_data(),
+            "timestamp": sensor_message.get_timestamp()
+        }, separators=(",", ":"))
@@ -1,22 +1,29 @@
+from array import array
+
+
 class SensorMessageItem:
     """
     A contract for the sensor message item type
 
-    Note that all the superfluous type conversions are due
-    to jsonpickle not deserializing types correctly
+    Fields are cast once at construction (jsonpickle does not deserialize types correctly,
+    so the decoders in sensor_message_codec rebuild the item through the constructor)
+    and the item is slotted, one of these is kept per tracked (mac, type) for the life of the daemon.
+    The reading is read-only once constructed (build a new item for a new reading), only the sent flag
+    can change.
     """
 
+    __slots__ = ("_mac", "_type", "_data", "_timestamp", "_sent")
+
     def __init__(self, mac: int = -1,
                  sensor_type: int = -1,
                  payload_data: float = -1.0,
                  timestamp: int = -1,
                  sent: bool = False):
-        self._mac: int = mac
-        self._type: int = sensor_type
-        self._data: float = payload_data
-        self._timestamp: int = timestamp
-        self._sent: bool = sent
-        pass
+        self._mac: int = int(mac)
+        self._type: int = int(sensor_type)
+        self._data: float = float(payload_data)
+        self._timestamp: int = int(timestamp)
+        self._sent: bool = bool(sent)
 
     def __repr__(self):
         return ("{{ sensor_type:{}, mac:{}, timestamp:{}, data:{} sent:{} }}".format(
@@ -28,32 +35,69 @@ class SensorMessageItem:
         ))
 
     def get_type(self) -> int:
-        return int(self._type)
-
-    def set_type(self, sensor_type: int):
-        self._type = int(sensor_type)
+        return self._type
 
     def get_data(self) -> float:
-        return float(self._data)
-
-    def set_data(self, payload_data: float):
-        self._data = float(payload_data)
+        return self._data
 
     def get_timestamp(self) -> int:
-        return int(self._timestamp)
-
-    def set_timestamp(self, timestamp: int):
-        self._timestamp = int(timestamp)
+        return self._timestamp
 
     def get_mac(self) -> int:
-        return int(self._mac)
-
-    def set_mac(self, mac: int):
-        mac = int(mac)
-        self._mac = mac
+        return self._mac
 
     def get_is_sent(self) -> bool:
-        return bool(self._sent)
+        return self._sent
 
     def set_is_sent(self, is_sent: bool):
         self._sent = bool(is_sent)
+
+
+class SensorMessageBatch:
+    """
+    Columnar container holding many readings in parallel typed arrays,
+    for passing a whole poll cycle of readings around without one object per reading
+    """
+
+    __slots__ = ("_macs", "_types", "_data", "_timestamps")
+
+    def __init__(self):
+        self._macs = array("q")
+        self._types = array("q")
+        self._data = array("d")
+        self._timestamps = array("q")
+
+    @staticmethod
+    def from_items(sensor_messages: list[SensorMessageItem]):
+        batch = SensorMessageBatch()
+        for sensor_message in sensor_messages:
+            batch.append(sensor_message)
+        return batch
+
+    def __len__(self):
+        return len(self._macs)
+
+    def __getitem__(self, i: int) -> SensorMessageItem:
+        return SensorMessageItem(self._macs[i], self._types[i], self._data[i], self._timestamps[i])
+
+    def __iter__(self):
+        for i in range(len(self._macs)):
+            yield self[i]
+
+    def append(self, sensor_message: SensorMessageItem):
+        self._macs.append(sensor_message.get_mac())
+        self._types.append(sensor_message.get_type())
+        self._data.append(sensor_message.get_data())
+        self._timestamps.append(sensor_message.get_timestamp())
+
+    def get_macs(self) -> array:
+        return self._macs
+
+    def get_types(self) -> array:
+        return self._types
+
+    def get_data(self) -> array:
+        return self._data
+
+    def get_timestamps(self) -> array:
+        return self._timestamps
@@ -0,0 +1,263 @@
+"""
+Sharded runtime for large sensor fleets
+
+The observed macs are partitioned across n_shards worker processes (mac % n_shards). Each worker runs its own
+RedisMonitor and BangBangController for its shard: its own cache fetch, deduplication, dispatch index and
+control trigger state, so the evaluation scales across cores instead of sharing one interpreter.
+
+The relay boards have a single owner, the main process. The workers send their relay commands over a
+multiprocessing queue to the RelayCommandConsumer, which hands them to the RelayCommandDispatcher of the
+board, the only writer on its serial port. The main process also runs a BangBangController without control defs that
+sends the relay state snapshots to the API every api_update_interval.
+"""
+import configparser
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+from logging.handlers import RotatingFileHandler
+from threading import Thread
+
+from WaveshareRelayControl.relaycontrolmain import WaveshareRelayController
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+from bang_bang_controller import BangBangController
+from control_def_watcher import ControlDefWatcher
+from control_defs import ControlDefUtils, DEFAULT_BOARD_ID
+from metrics import start_metrics_server
+from redis_monitor import RedisMonitor
+from relay_boards import build_relay_boards, get_relay_board_ids
+from relay_command_dispatcher import RelayCommandDispatcher
+
+logger = logging.getLogger(__name__)
+
+
+class RelayCommandProxy:
+    """
+    Stands in for the relay controller in a shard worker, the commands go to the process that owns the relays
+
+    The channel states are the ones this shard last commanded, the relay owner has the actual states.
+    """
+
+    def __init__(self, command_queue: multiprocessing.Queue, shard_id: int, board_id: str = DEFAULT_BOARD_ID):
+        self._command_queue = command_queue
+        self._shard_id = shard_id
+        self._board_id = board_id
+        self._channel_states: dict[WaveshareDef, int | None] = dict()
+
+    def set_channel_on(self, channel: WaveshareDef):
+        self.submit(channel, 1)
+
+    def set_channel_off(self, channel: WaveshareDef):
+        self.submit(channel, 0)
+
+    def submit(self, channel: WaveshareDef, state: int):
+        self._channel_states[channel] = state
+        self._command_queue.put((self._shard_id, self._board_id, channel, state))
+
+    def get_channel_states(self) -> dict[WaveshareDef, int | None]:
+        return dict(self._channel_states)
+
+    def set_default_states(self):
+        # the relay owner sets the default states at boot
+        pass
+
+
+class RelayCommandConsumer(Thread):
+    """
+    Applies the relay commands the shard workers send to the relay controller of their board, in the order
+    they arrive
+    """
+
+    def __init__(self, command_queue: multiprocessing.Queue, relay_controller: RelayCommandDispatcher,
+                 sig_event: multiprocessing.Event, poll_timeout_s: float = 0.5,
+                 relay_boards: dict[str, RelayCommandDispatcher] = None):
+
+        super(RelayCommandConsumer, self).__init__()
+
+        self.logger = logging.getLogger(__name__)
+
+        self._command_queue = command_queue
+        self._relay_controller = relay_controller
+        self._relay_boards = relay_boards if relay_boards is not None else dict()
+        self._sig_event = sig_event
+        self._poll_timeout_s = poll_timeout_s
+
+        # shard id -> number of commands received from it
+        self.n_commands: dict[int, int] = dict()
+
+    def apply_command(self, shard_id: int, board_id: str, channel: WaveshareDef, state: int):
+        self.n_commands[shard_id] = self.n_commands.get(shard_id, 0) + 1
+        if board_id == DEFAULT_BOARD_ID:
+            relay_controller = self._relay_controller
+        else:
+            relay_controller = self._relay_boards.get(board_id, None)
+        if relay_controller is None:
+            self.logger.error("Shard {} sent a command for unknown relay board {}".format(shard_id, board_id))
+        elif state == 1:
+            relay_controller.set_channel_on(channel)
+        else:
+            relay_controller.set_channel_off(channel)
+
+    def run(self):
+        while True:
+            try:
+                shard_id, board_id, channel, state = self._command_queue.get(timeout=self._poll_timeout_s)
+            except queue.Empty:
+                # keep going until the queue is drained after the shutdown
+                if self._sig_event.is_set():
+                    break
+                continue
+
+            self.apply_command(shard_id, board_id, channel, state)
+
+        self.logger.info("Relay command consumer stopped, commands per shard:{}".format(self.n_commands))
+
+
+def configure_shard_logging(shard_id: int):
+    # one log file per shard, a rotating file handler can't be shared between processes
+    logging.basicConfig(level=logging.INFO,
+                        handlers=[
+                            RotatingFileHandler("RelayController.shard{}.log".format(shard_id),
+                                                maxBytes=50000000, backupCount=5)
+                        ],
+                        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+                        force=True)
+
+
+def run_shard(shard_id: int, n_shards: int, command_queue: multiprocessing.Queue, sig_event: multiprocessing.Event):
+    """
+    Worker process entry point, runs the cache monitor and controller for one shard of the observed macs
+    :param shard_id:
+    :param n_shards:
+    :param command_queue: relay commands for the relay owner
+    :param sig_event: shared shutdown event
+    :return:
+    """
+    configure_shard_logging(shard_id)
+
+    # Ctrl+C reaches the whole process group, the workers stop through the shared sig_event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    config = configparser.ConfigParser()
+    config.read('config.cfg')
+
+    # each shard watches the control defs file itself, the main process forwards SIGHUP
+    control_def_watcher = ControlDefWatcher(config.get("DEFAULT", "control_defs_file"))
+
+    def reload_signal_handler(sig, frame):
+        control_def_watcher.request_reload()
+
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, reload_signal_handler)
+
+    # each worker serves its own metrics on the ports after the main process's
+    start_metrics_server(config, port_offset=1 + shard_id)
+
+    # each shard journals its own control triggers
+    control_state_file = config.get("DEFAULT", "control_state_file", fallback="")
+    if control_state_file != "":
+        control_state_file = "{}.shard{}".format(control_state_file, shard_id)
+
+    mq_payload_queue = queue.Queue()
+
+    redis_monitor_thread = RedisMonitor(mq_payload_queue, sig_event, control_def_watcher=control_def_watcher,
+                                        shard=(shard_id, n_shards))
+    relay_boards = {board_id: RelayCommandProxy(command_queue, shard_id, board_id)
+                    for board_id in get_relay_board_ids(config)}
+    bang_bang_controller = BangBangController(mq_payload_queue, sig_event,
+                                              relay_controller=RelayCommandProxy(command_queue, shard_id),
+                                              control_def_watcher=control_def_watcher,
+                                              report_to_api=False,
+                                              control_state_file=control_state_file,
+                                              relay_boards=relay_boards,
+                                              shard=(shard_id, n_shards),
+                                              inline_relay_commands=True)
+
+    logger.info("Shard {}/{} observing {} macs".format(shard_id, n_shards, len(redis_monitor_thread.observables)))
+    # a shard only sees the readings of its own macs, so a rule with macs on other shards is evaluated here
+    # as if their leaves never held
+    for control_rule in ControlDefUtils.split_control_rules(bang_bang_controller.control_defs)[1]:
+        rule_shards = {mac % n_shards for leaf in control_rule.get_leaves() for mac in leaf.get_macs()}
+        if len(rule_shards) > 1:
+            logger.warning("Control rule {} has macs on shards {}, each shard only evaluates it on its own macs "
+                           "(run it unsharded to evaluate it as a whole)".format(control_rule.get_uuid(),
+                                                                                sorted(rule_shards)))
+    redis_monitor_thread.start()
+    bang_bang_controller.start()
+
+    redis_monitor_thread.join()
+    bang_bang_controller.join()
+
+
+def start_shard(shard_id: int, n_shards: int, command_queue: multiprocessing.Queue,
+                sig_event: multiprocessing.Event) -> multiprocessing.Process:
+    shard_process = multiprocessing.Process(target=run_shard, args=(shard_id, n_shards, command_queue, sig_event),
+                                            name="shard-{}".format(shard_id))
+    shard_process.start()
+    return shard_process
+
+
+def run_sharded(config: configparser.ConfigParser, n_shards: int, sig_event: multiprocessing.Event):
+    """
+    Run n_shards worker processes and own the relays until sig_event is set
+    :param config:
+    :param n_shards:
+    :param sig_event:
+    :return:
+    """
+    command_queue = multiprocessing.Queue()
+
+    # start the workers before any thread exists in this process
+    shard_processes = [start_shard(shard_id, n_shards, command_queue, sig_event) for shard_id in range(n_shards)]
+
+    def reload_signal_handler(sig, frame):
+        for shard_process in shard_processes:
+            if shard_process.is_alive():
+                os.kill(shard_process.pid, signal.SIGHUP)
+
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, reload_signal_handler)
+
+    serial_port = config.get("RELAY_CONTROLLER", "serial_port", fallback="/dev/ttyUSB0")
+    default_states_str = config.get("RELAY_CONTROLLER", "default_relay_states", fallback=None)
+    default_states_dict = WaveshareRelayController.parse_default_states(default_states_str)
+
+    # one dispatcher per board, so the boards are written in parallel
+    relay_dispatcher = BangBangController.make_relay_dispatcher(
+        WaveshareRelayController(serial_port, default_states=default_states_dict), config)
+    relay_board_dispatchers = {board_id: BangBangController.make_relay_dispatcher(relay_board, config)
+                               for board_id, relay_board in build_relay_boards(config).items()}
+    relay_command_consumer = RelayCommandConsumer(command_queue, relay_dispatcher, sig_event,
+                                                  relay_boards=relay_board_dispatchers)
+    # no control defs, this controller only reports the relay states to the API (the shards journal the state)
+    api_reporter = BangBangController(queue.Queue(), sig_event, relay_controller=relay_dispatcher, control_defs=list(),
+                                      control_state_file="", relay_boards=relay_board_dispatchers)
+
+    start_metrics_server(config)
+    relay_dispatcher.start()
+    for relay_board_dispatcher in relay_board_dispatchers.values():
+        relay_board_dispatcher.start()
+    relay_command_consumer.start()
+    api_reporter.start()
+    logger.info("Started {} shard workers".format(n_shards))
+
+    # restart a worker that died, its shard would otherwise go unwatched
+    shard_restart_interval_s = config.getfloat("DEFAULT", "shard_restart_interval_ms", fallback=5000) / 1000.0
+    while not sig_event.wait(shard_restart_interval_s):
+        for shard_id, shard_process in enumerate(shard_processes):
+            if not shard_process.is_alive():
+                logger.error("Shard {} worker exited with code {}, restarting it".format(
+                    shard_id, shard_process.exitcode))
+                shard_processes[shard_id] = start_shard(shard_id, n_shards, command_queue, sig_event)
+
+    for shard_process in shard_processes:
+        shard_process.join()
+
+    relay_command_consumer.join()
+    api_reporter.join()
+    relay_dispatchers = [relay_dispatcher] + list(relay_board_dispatchers.values())
+    for dispatcher in relay_dispatchers:
+        dispatcher.stop()
+    for dispatcher in relay_dispatchers:
+        dispatcher.join()
@@ -0,0 +1,60 @@
+import time
+
+from api_outbox import ApiOutbox, ApiOutboxSender
+
+
+def make_datum(i: int) -> dict:
+    return {'mac': 303721661, 'type': 0x12D, 'timestamp': i, 'data': i % 2}
+
+
+def test_outbox_survives_reopen_and_stays_bounded(tmp_path):
+    outbox_file = str(tmp_path / "api_outbox.db")
+    outbox = ApiOutbox(outbox_file, max_rows=10)
+    outbox.append([make_datum(i) for i in range(8)])
+    outbox.append([make_datum(i) for i in range(8, 16)])
+    assert outbox.get_depth() == 10
+    assert outbox.get_n_dropped() == 6
+    outbox.close()
+
+    outbox = ApiOutbox(outbox_file, max_rows=10)
+    last_id, batch = outbox.peek(4)
+    assert [datum['timestamp'] for datum in batch] == [6, 7, 8, 9]
+    outbox.remove_through(last_id)
+    assert outbox.get_depth() == 6
+    outbox.close()
+
+
+def test_sender_retries_and_coalesces_backlog(tmp_path):
+    outbox = ApiOutbox(str(tmp_path / "api_outbox.db"))
+    sent_batches = list()
+    network_up = [False]
+
+    def send_batch(batch: list[dict]) -> bool:
+        if network_up[0] is False:
+            return False
+        sent_batches.append(batch)
+        return True
+
+    sender = ApiOutboxSender(outbox, send_batch, max_batch_size=100, retry_min_ms=20, retry_max_ms=40)
+    sender.start()
+
+    # an outage builds up a backlog
+    for i in range(5):
+        outbox.append([make_datum(i * 8 + channel) for channel in range(8)])
+    time.sleep(0.1)
+    assert outbox.get_depth() == 40
+    assert sender.n_failed_sends > 0
+
+    network_up[0] = True
+    deadline = time.time() + 2.0
+    while (outbox.get_depth() > 0) and (time.time() < deadline):
+        time.sleep(0.01)
+
+    sender.stop()
+    sender.join()
+    outbox.close()
+
+    assert outbox.get_depth() == 0
+    # the backlog went out as one batch, in order
+    assert len(sent_batches) == 1
+    assert [datum['timestamp'] for datum in sent_batches[0]] == list(range(40))
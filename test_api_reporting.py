@@ -0,0 +1,53 @@
+import queue
+import threading
+import time
+
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+from bang_bang_controller import BangBangController
+from control_defs import ControlDef, ThresholdType, ControlFunc
+from fake_api_writer import RecordingApiWriter
+from mock_relay_controller import MockRelayController
+from sensor_message_item import SensorMessageItem
+
+
+def make_control_def() -> ControlDef:
+    return ControlDef(uuid="941a5640-82ac-11ee-b962-0242ac120002",
+                      macs={303721692},
+                      sensor_types=[248],
+                      threshold_value=25.0,
+                      hysteresis=1.5,
+                      threshold_type=ThresholdType.OVERSHOOT,
+                      threshold_duration_millis=0,
+                      control_func=ControlFunc.ON,
+                      control_channel=WaveshareDef.CH1,
+                      back_to_normal_func=ControlFunc.OFF,
+                      allow_back_to_normal=True,
+                      fuzz_ms=0)
+
+
+def test_state_changes_are_reported_between_heartbeats():
+    api_writer = RecordingApiWriter()
+    message_queue = queue.Queue()
+    sig_event = threading.Event()
+    controller = BangBangController(message_queue, sig_event, relay_controller=MockRelayController(),
+                                    control_defs=[make_control_def()], api_writer=api_writer)
+    controller.api_report_changes = True
+    controller.api_change_coalesce_ms = 50
+    controller.start()
+
+    # the first heartbeat goes out at startup
+    time.sleep(0.1)
+    assert len(api_writer.batches) == 1
+    assert len(api_writer.batches[0]) == 8
+
+    # on, off and on again within the coalesce window is reported once, as on
+    for i, data in enumerate([30.0, 30.0, 20.0, 30.0, 30.0]):
+        message_queue.put(SensorMessageItem(303721692, 248, data, i))
+    time.sleep(0.2)
+
+    sig_event.set()
+    controller.join(timeout=2.0)
+
+    assert len(api_writer.batches) == 2
+    assert api_writer.batches[1] == [{'mac': controller.api_mac, 'type': 0x12D,
+                                      'timestamp': api_writer.batches[1][0]['timestamp'], 'data': 1}]
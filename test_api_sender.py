@@ -0,0 +1,103 @@
+import queue
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+from bang_bang_controller import BangBangController
+from control_defs import ControlDef, ThresholdType, ControlFunc
+from mock_relay_controller import MockRelayController
+from sensor_message_item import SensorMessageItem
+
+
+class HangingHandler(BaseHTTPRequestHandler):
+    """
+    Accepts the request and never answers (until the server is released)
+    """
+
+    def do_POST(self):
+        self.server.release.wait()
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HangingApiWriter:
+    """
+    Posts the batches to the hanging stub server like SensorDataIngest posts them to the API
+    """
+
+    def __init__(self, url: str, timeout_s: float):
+        self.url = url
+        self.timeout_s = timeout_s
+        self.n_requests = 0
+
+    def send_data(self, batch: list[dict], self_manage_token: bool) -> bool:
+        self.n_requests += 1
+        request = urllib.request.Request(self.url, data=str(batch).encode(), method="POST")
+        urllib.request.urlopen(request, timeout=self.timeout_s)
+        return True
+
+
+def make_control_def() -> ControlDef:
+    return ControlDef(uuid="941a5640-82ac-11ee-b962-0242ac120002",
+                      macs={303721692},
+                      sensor_types=[248],
+                      threshold_value=25.0,
+                      hysteresis=1.5,
+                      threshold_type=ThresholdType.OVERSHOOT,
+                      threshold_duration_millis=0,
+                      control_func=ControlFunc.ON,
+                      control_channel=WaveshareDef.CH1,
+                      back_to_normal_func=ControlFunc.OFF,
+                      allow_back_to_normal=True,
+                      fuzz_ms=0)
+
+
+def test_hanging_api_does_not_delay_actuation():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), HangingHandler)
+    server.release = threading.Event()
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+
+    api_writer = HangingApiWriter("http://127.0.0.1:{}/".format(server.server_address[1]), timeout_s=5.0)
+
+    relay_controller = MockRelayController()
+    message_queue = queue.Queue()
+    sig_event = threading.Event()
+    controller = BangBangController(message_queue, sig_event, relay_controller=relay_controller,
+                                    control_defs=[make_control_def()], api_writer=api_writer)
+    # an API update every 20 ms, each one hangs for the whole request timeout
+    controller.api_update_interval = 20
+    controller.api_sender_join_timeout_s = 0.1
+    controller.start()
+
+    latencies_ms = list()
+    for i in range(10):
+        # exceed the threshold twice (trigger, then control) and come back through the hysteresis point
+        n_commands = len(relay_controller.commands)
+        start = time.perf_counter()
+        message_queue.put(SensorMessageItem(303721692, 248, 30.0, i * 1000))
+        message_queue.put(SensorMessageItem(303721692, 248, 30.0, i * 1000 + 1))
+        while len(relay_controller.commands) == n_commands:
+            time.sleep(0.001)
+        latencies_ms.append((time.perf_counter() - start) * 1000.0)
+        message_queue.put(SensorMessageItem(303721692, 248, 20.0, i * 1000 + 2))
+        time.sleep(0.05)
+
+    sig_event.set()
+    controller.join(timeout=2.0)
+
+    # the API sender is stuck in its first request the whole time
+    assert api_writer.n_requests == 1
+    assert controller.api_sender.n_dropped > 0
+
+    server.release.set()
+    server.shutdown()
+
+    assert not controller.is_alive()
+    assert max(latencies_ms) < 100.0
+    assert len(relay_controller.commands) == 20
@@ -0,0 +1,92 @@
+import asyncio
+import time
+
+import jsonpickle
+
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+from async_daemon import AsyncApiSender, AsyncDaemon, AsyncRelayWriter
+from control_defs import ControlDef, ThresholdType, ControlFunc
+from fake_api_writer import RecordingApiWriter
+from fake_redis import FakeRedis, FakeAsyncRedis
+from mock_relay_controller import MockRelayController
+from sensor_message_item import SensorMessageItem
+
+
+def make_control_def() -> ControlDef:
+    # the trigger outlives the gap between two cache fetches
+    return ControlDef(uuid="941a5640-82ac-11ee-b962-0242ac120002",
+                      macs={303721692},
+                      sensor_types=[248],
+                      threshold_value=25.0,
+                      hysteresis=1.5,
+                      threshold_type=ThresholdType.OVERSHOOT,
+                      threshold_duration_millis=200,
+                      control_func=ControlFunc.ON,
+                      control_channel=WaveshareDef.CH1,
+                      back_to_normal_func=ControlFunc.OFF,
+                      allow_back_to_normal=True,
+                      fuzz_ms=150)
+
+
+def test_async_runtime_actuates_and_stops_promptly():
+    fake_redis = FakeRedis()
+    relay_controller = MockRelayController()
+    api_writer = RecordingApiWriter()
+
+    async def run():
+        daemon = AsyncDaemon(redis_client=FakeAsyncRedis(fake_redis), relay_controller=relay_controller,
+                             control_defs=[make_control_def()], api_writer=api_writer)
+        daemon.redis_monitor.cache_fetch_interval_ms = 20
+        daemon.relay_writer._coalesce_window_ms = 0
+        daemon_task = asyncio.create_task(daemon.run())
+
+        # exceed the threshold twice (trigger, then control)
+        for _ in range(2):
+            sensor_message = SensorMessageItem(303721692, 248, 30.0, int(time.time() * 1000))
+            fake_redis.hset("303721692", "248", jsonpickle.encode(sensor_message))
+            await asyncio.sleep(0.1)
+
+        start = time.perf_counter()
+        daemon.stop()
+        await daemon_task
+        return (time.perf_counter() - start) * 1000.0
+
+    stop_ms = asyncio.run(run())
+
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1)]
+    # the startup snapshot went out through the async sender
+    assert len(api_writer.batches) == 1
+    assert stop_ms < 100.0
+
+
+def test_async_relay_writer_retries_a_failed_write():
+    relay_controller = MockRelayController()
+    relay_controller.n_failing_commands = 1
+    relay_writer = AsyncRelayWriter(relay_controller, coalesce_window_ms=0, retry_min_ms=20)
+
+    async def run():
+        writer_task = asyncio.create_task(relay_writer.run())
+        relay_writer.set_channel_on(WaveshareDef.CH2)
+        await asyncio.sleep(0.1)
+        relay_writer.stop()
+        await writer_task
+
+    asyncio.run(run())
+
+    assert relay_controller.commands == [(WaveshareDef.CH2, 1)]
+    assert relay_writer.get_stats()["failed"] == 1
+
+
+def test_async_daemon_builds_its_controller_without_dispatchers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "config.cfg").write_text("[RELAY_CONTROLLER]\nasync_relay_commands = True\n")
+    relay_board = MockRelayController()
+
+    daemon = AsyncDaemon(redis_client=FakeAsyncRedis(FakeRedis()), relay_controller=MockRelayController(),
+                         control_defs=[make_control_def()], api_writer=RecordingApiWriter(),
+                         relay_boards={"boiler_room": relay_board})
+
+    assert daemon.controller.get_relay_dispatchers() == {}
+    assert daemon.controller.relay_controller is daemon.relay_writer
+    assert daemon.controller.get_relay_controller("boiler_room") is daemon.relay_board_writers["boiler_room"]
+    assert isinstance(daemon.controller.api_sender, AsyncApiSender)
@@ -0,0 +1,91 @@
+import logging
+import random
+from types import SimpleNamespace
+
+from batch_evaluator import ControlDefBatchEvaluator
+from bang_bang_controller import BangBangController
+from control_defs import AggregateFunc, ControlDef, ControlDefIndex, ThresholdType, ControlFunc
+from sensor_message_item import SensorMessageItem, SensorMessageBatch
+from window_operators import SensorWindowStore
+
+logger = logging.getLogger(__name__)
+
+
+def make_control_defs(n_defs: int, n_macs: int, rnd: random.Random) -> list[ControlDef]:
+    control_defs = list()
+    for i in range(n_defs):
+        control_defs.append(ControlDef(uuid=str(i),
+                                       # every tenth def is a wildcard def
+                                       macs=set() if i % 10 == 0 else {rnd.randrange(n_macs)},
+                                       sensor_types=[248, 531],
+                                       threshold_value=rnd.choice([22.5, 25.0, 27.5]),
+                                       hysteresis=rnd.choice([0.0, 0.5, 1.5]),
+                                       threshold_type=rnd.choice([ThresholdType.OVERSHOOT,
+                                                                  ThresholdType.UNDERSHOOT,
+                                                                  None]),
+                                       threshold_duration_millis=60000,
+                                       control_func=ControlFunc.ON,
+                                       back_to_normal_func=ControlFunc.OFF,
+                                       allow_back_to_normal=True,
+                                       fuzz_ms=500))
+    return control_defs
+
+
+def test_batch_matches_per_message_path():
+    rnd = random.Random(7)
+    control_defs = make_control_defs(200, 50, rnd)
+    # readings land on, either side of and at the hysteresis points of the thresholds
+    sensor_messages = [SensorMessageItem(rnd.randrange(50), rnd.choice([248, 531, 999]),
+                                         rnd.choice([21.0, 22.0, 22.5, 23.0, 24.0, 25.0, 26.0, 26.5, 27.5, 29.0]), i)
+                       for i in range(2000)]
+
+    # the per message path only needs a logger from the controller
+    controller = SimpleNamespace(logger=logger)
+    index = ControlDefIndex(control_defs)
+    expected = list()
+    for message_position, sensor_message in enumerate(sensor_messages):
+        for control_def in index.get_matching_defs(sensor_message.get_mac(), sensor_message.get_type()):
+            expected.append((message_position, control_def,
+                             BangBangController.exceeded_threshold(controller, sensor_message, control_def),
+                             BangBangController.check_hysteresis(controller, sensor_message, control_def) is True))
+
+    evaluator = ControlDefBatchEvaluator(control_defs)
+    assert list(evaluator.evaluate(sensor_messages)) == expected
+    assert list(evaluator.evaluate_batch(SensorMessageBatch.from_items(sensor_messages))) == expected
+
+
+def test_empty_batch():
+    evaluator = ControlDefBatchEvaluator(make_control_defs(10, 5, random.Random(1)))
+    assert len(evaluator.evaluate([])) == 0
+
+
+def test_windowed_defs_match_per_message_path():
+    rnd = random.Random(11)
+    control_defs = make_control_defs(100, 20, rnd)
+    for control_def in control_defs:
+        control_def.set_aggregate_func(rnd.choice(list(AggregateFunc)))
+        control_def.set_aggregate_window_ms(rnd.choice([0, 20, 100]))
+    sensor_messages = [SensorMessageItem(rnd.randrange(20), rnd.choice([248, 531]), rnd.uniform(20.0, 30.0), i)
+                       for i in range(1000)]
+
+    # the windowed part of BangBangController.process_message
+    controller = SimpleNamespace(logger=logger, sensor_windows=SensorWindowStore())
+    controller.sensor_windows.compile(control_defs)
+    index = ControlDefIndex(control_defs)
+    expected = list()
+    for message_position, sensor_message in enumerate(sensor_messages):
+        controller.sensor_windows.update(sensor_message.get_mac(), sensor_message.get_type(),
+                                         sensor_message.get_timestamp(), sensor_message.get_data())
+        for control_def in index.get_matching_defs(sensor_message.get_mac(), sensor_message.get_type()):
+            evaluated_message = sensor_message
+            if control_def.get_aggregate_func() is not AggregateFunc.RAW:
+                evaluated_message = BangBangController.get_window_message(controller, sensor_message, control_def)
+                if evaluated_message is None:
+                    continue
+            expected.append((message_position, control_def,
+                             BangBangController.exceeded_threshold(controller, evaluated_message, control_def),
+                             BangBangController.check_hysteresis(controller, evaluated_message, control_def) is True))
+
+    assert list(ControlDefBatchEvaluator(control_defs).evaluate(sensor_messages)) == expected
+    assert list(ControlDefBatchEvaluator(control_defs).evaluate_batch(
+        SensorMessageBatch.from_items(sensor_messages))) == expected
@@ -0,0 +1,89 @@
+import json
+import os
+import queue
+import threading
+
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+from bang_bang_controller import BangBangController
+from control_def_watcher import ControlDefWatcher
+from mock_relay_controller import MockRelayController
+from sensor_message_item import SensorMessageItem
+
+
+def make_json_def(uuid: str, threshold_value: float) -> dict:
+    return {
+        "uuid": uuid,
+        "macs": [303721692],
+        "sensor_types": [248],
+        "threshold_value": threshold_value,
+        "hysteresis": 1.5,
+        "threshold_type": -1,
+        "threshold_duration_millis": 60000,
+        "control_func": 1,
+        "control_channel": 1,
+        "back_to_normal_func": 0,
+        "allow_back_to_normal": True,
+        "fuzz_ms": 500
+    }
+
+
+def write_defs(path, json_defs: list[dict], mtime_ns: int):
+    with open(path, "w") as control_defs_file:
+        json.dump(json_defs, control_defs_file)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_reload_only_reparses_changed_defs(tmp_path):
+    path = tmp_path / "control_defs.json"
+    write_defs(path, [make_json_def("a", 25.0), make_json_def("b", 25.0)], 1000000000)
+    watcher = ControlDefWatcher(str(path))
+    generation, control_defs = watcher.get_control_defs()
+    assert generation == 1
+
+    # unchanged file, nothing happens
+    assert watcher.check_for_changes() is False
+
+    write_defs(path, [make_json_def("a", 25.0), make_json_def("b", 30.0), make_json_def("c", 25.0)], 2000000000)
+    assert watcher.check_for_changes() is True
+    new_generation, new_control_defs = watcher.get_control_defs()
+    assert new_generation == 2
+    # "a" was not reparsed
+    assert new_control_defs[0] is control_defs[0]
+    assert new_control_defs[1].get_threshold_value() == 30.0
+    assert [control_def.get_uuid() for control_def in new_control_defs] == ["a", "b", "c"]
+
+
+def test_broken_file_keeps_current_defs(tmp_path):
+    path = tmp_path / "control_defs.json"
+    write_defs(path, [make_json_def("a", 25.0)], 1000000000)
+    watcher = ControlDefWatcher(str(path))
+
+    with open(path, "w") as control_defs_file:
+        control_defs_file.write("[{")
+    watcher.request_reload()
+    assert watcher.check_for_changes() is False
+    assert watcher.get_generation() == 1
+    assert len(watcher.get_control_defs()[1]) == 1
+
+
+def test_reload_releases_the_channel_of_a_removed_or_moved_def(tmp_path):
+    path = tmp_path / "control_defs.json"
+    moved = dict(make_json_def("moved", 25.0), threshold_type=1, threshold_duration_millis=0)
+    removed = dict(make_json_def("removed", 25.0), threshold_type=1, threshold_duration_millis=0,
+                   macs=[303721693], control_channel=2)
+    kept = dict(make_json_def("kept", 25.0), threshold_type=1, threshold_duration_millis=0, macs=[303721694],
+                control_channel=3)
+    write_defs(path, [moved, removed, kept], 1000000000)
+    relay_controller = MockRelayController()
+    controller = BangBangController(queue.Queue(), threading.Event(), relay_controller=relay_controller,
+                                    control_def_watcher=ControlDefWatcher(str(path)), report_to_api=False,
+                                    control_state_file="")
+    for mac in (303721692, 303721693, 303721694):
+        controller.process_message(SensorMessageItem(mac, 248, 30.0, 0))
+        controller.process_message(SensorMessageItem(mac, 248, 30.0, 1000))
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1), (WaveshareDef.CH2, 1), (WaveshareDef.CH3, 1)]
+
+    write_defs(path, [dict(moved, control_channel=4), kept], 2000000000)
+    controller.reload_control_defs()
+    assert relay_controller.commands[3:] == [(WaveshareDef.CH1, 0), (WaveshareDef.CH2, 0)]
+    assert list(key for key, _ in controller.control_triggers.items()) == ["303721694-248-kept"]
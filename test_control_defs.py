@@ -0,0 +1,68 @@
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+from control_defs import ControlDef, ControlDefIndex, ControlFunc, ThresholdType
+
+
+def make_control_def(uuid: str, macs: set[int], sensor_types: list[int]) -> ControlDef:
+    return ControlDef(uuid=uuid,
+                      macs=macs,
+                      sensor_types=sensor_types,
+                      threshold_value=25.0,
+                      hysteresis=1.0,
+                      threshold_type=ThresholdType.OVERSHOOT,
+                      threshold_duration_millis=0,
+                      control_func=ControlFunc.ON,
+                      control_channel=WaveshareDef.CH1,
+                      back_to_normal_func=ControlFunc.OFF,
+                      allow_back_to_normal=True,
+                      fuzz_ms=0)
+
+
+def get_uuids(control_defs: tuple[ControlDef, ...]) -> list[str]:
+    return [control_def.get_uuid() for control_def in control_defs]
+
+
+def test_exact_defs_match_only_their_macs_and_types():
+    index = ControlDefIndex([make_control_def("a", {1001, 1002}, [248]),
+                             make_control_def("b", {1001}, [248, 249, 249])])
+
+    assert get_uuids(index.get_matching_defs(1001, 248)) == ["a", "b"]
+    assert get_uuids(index.get_matching_defs(1002, 248)) == ["a"]
+    # a type listed twice still dispatches once
+    assert get_uuids(index.get_matching_defs(1001, 249)) == ["b"]
+    assert index.get_matching_defs(1002, 249) == ()
+    assert index.get_matching_defs(1003, 248) == ()
+    assert index.get_n_defs() == 2
+
+
+def test_wildcard_defs_match_every_mac_of_their_types():
+    index = ControlDefIndex([make_control_def("a", set(), [248])])
+
+    assert get_uuids(index.get_matching_defs(1001, 248)) == ["a"]
+    assert get_uuids(index.get_matching_defs(1999, 248)) == ["a"]
+    assert index.get_matching_defs(1001, 249) == ()
+
+
+def test_exact_and_wildcard_defs_match_in_load_order():
+    index = ControlDefIndex([make_control_def("wildcard-first", set(), [248]),
+                             make_control_def("exact", {1001}, [248]),
+                             make_control_def("wildcard-last", set(), [248]),
+                             make_control_def("other-type", {1001}, [249])])
+
+    assert get_uuids(index.get_matching_defs(1001, 248)) == ["wildcard-first", "exact", "wildcard-last"]
+    # a mac without exact defs falls back to the wildcard defs
+    assert get_uuids(index.get_matching_defs(1002, 248)) == ["wildcard-first", "wildcard-last"]
+    assert get_uuids(index.get_matching_defs(1001, 249)) == ["other-type"]
+
+
+def test_rebuild_replaces_the_index():
+    index = ControlDefIndex()
+    assert index.get_matching_defs(1001, 248) == ()
+    assert index.get_n_defs() == 0
+
+    index.rebuild([make_control_def("a", {1001}, [248])])
+    assert get_uuids(index.get_matching_defs(1001, 248)) == ["a"]
+
+    index.rebuild([make_control_def("b", set(), [248])])
+    assert get_uuids(index.get_matching_defs(1001, 248)) == ["b"]
+    assert get_uuids(index.get_matching_defs(1002, 248)) == ["b"]
+    assert index.get_n_defs() == 1
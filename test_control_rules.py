@@ -0,0 +1,144 @@
+import queue
+import random
+import threading
+
+import pytest
+
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+from bang_bang_controller import BangBangController
+from control_defs import ControlDefUtils, ControlRule
+from control_rules import ControlRuleEngine
+from mock_relay_controller import MockRelayController
+from sensor_message_item import SensorMessageItem
+
+
+def make_leaf(mac: int, sensor_type: int, threshold_value: float, threshold_type: int, **kwargs) -> dict:
+    leaf = {"macs": [mac], "sensor_types": [sensor_type], "threshold_value": threshold_value, "hysteresis": 1.0,
+            "threshold_type": threshold_type}
+    leaf.update(kwargs)
+    return leaf
+
+
+def make_rule(uuid: str, condition: dict, threshold_duration_millis: int = 0, channel: int = 1) -> ControlRule:
+    return ControlDefUtils.parse_control_def({"uuid": uuid, "condition": condition,
+                                              "threshold_duration_millis": threshold_duration_millis,
+                                              "control_func": 1, "control_channel": channel,
+                                              "back_to_normal_func": 0, "allow_back_to_normal": True,
+                                              "fuzz_ms": 0})
+
+
+def make_controller(control_rules: list[ControlRule]) -> tuple[BangBangController, MockRelayController]:
+    relay_controller = MockRelayController()
+    controller = BangBangController(queue.Queue(), threading.Event(), relay_controller=relay_controller,
+                                    control_defs=control_rules, report_to_api=False, control_state_file="")
+    return controller, relay_controller
+
+
+def test_rules_are_parsed_and_validated():
+    control_rule = make_rule("any-fan", {"op": "any", "conditions": [make_leaf(1001, 248, 25.0, 1),
+                                                                     make_leaf(1002, 248, 25.0, 1)]})
+    assert isinstance(control_rule, ControlRule)
+    assert [leaf.get_macs() for leaf in control_rule.get_leaves()] == [{1001}, {1002}]
+    assert ControlDefUtils.get_observables([control_rule]) == {1001: {248}, 1002: {248}}
+
+    with pytest.raises(ValueError):
+        make_rule("k", {"op": "k_of_n", "k": 3, "conditions": [make_leaf(1001, 248, 25.0, 1)]})
+    with pytest.raises(ValueError):
+        make_rule("wildcard", {"op": "any", "conditions": [dict(make_leaf(1001, 248, 25.0, 1), macs=[])]})
+    with pytest.raises(ValueError):
+        make_rule("op", {"op": "most", "conditions": [make_leaf(1001, 248, 25.0, 1)]})
+
+
+def test_any_of_three_sensors_for_a_duration():
+    control_rule = make_rule("any-fan", {"op": "any", "conditions": [make_leaf(mac, 248, 25.0, 1)
+                                                                     for mac in (1001, 1002, 1003)]},
+                             threshold_duration_millis=60000)
+    controller, relay_controller = make_controller([control_rule])
+
+    controller.process_message(SensorMessageItem(1002, 248, 26.0, 0))
+    # another sensor keeps the condition holding, the duration runs from the first one
+    controller.process_message(SensorMessageItem(1002, 248, 24.5, 30000))
+    controller.process_message(SensorMessageItem(1003, 248, 27.0, 60000))
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1)]
+
+    # back to normal once every sensor passed its hysteresis check
+    controller.process_message(SensorMessageItem(1002, 248, 23.0, 90000))
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1)]
+    controller.process_message(SensorMessageItem(1003, 248, 23.0, 120000))
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1), (WaveshareDef.CH1, 0)]
+    assert len(controller.control_triggers) == 0
+
+
+def test_humidity_high_and_temperature_low():
+    control_rule = make_rule("dehumidify", {"op": "all", "conditions": [make_leaf(1001, 1, 70.0, 1),
+                                                                        make_leaf(1001, 248, 18.0, -1)]})
+    controller, relay_controller = make_controller([control_rule])
+
+    controller.process_message(SensorMessageItem(1001, 1, 75.0, 0))
+    controller.process_message(SensorMessageItem(1001, 1, 75.0, 1))
+    assert relay_controller.commands == []
+    controller.process_message(SensorMessageItem(1001, 248, 17.0, 2))
+    controller.process_message(SensorMessageItem(1001, 248, 17.0, 3))
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1)]
+    # the temperature coming back up clears the rule
+    controller.process_message(SensorMessageItem(1001, 248, 19.5, 4))
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1), (WaveshareDef.CH1, 0)]
+
+
+def test_only_dependent_rules_are_updated_and_state_survives_a_reload():
+    two_of_three = make_rule("two", {"op": "k_of_n", "k": 2, "conditions": [make_leaf(mac, 248, 25.0, 1)
+                                                                            for mac in (1001, 1002, 1003)]})
+    nested = make_rule("nested", {"op": "all", "conditions": [
+        make_leaf(1004, 248, 25.0, 1),
+        {"op": "any", "conditions": [make_leaf(1001, 248, 25.0, 1), make_leaf(1005, 248, 25.0, 1)]}]})
+    engine = ControlRuleEngine()
+    engine.compile([two_of_three, nested])
+
+    def exceeded(leaf):
+        return True, False
+
+    assert engine.update(1002, 248, exceeded) == [(two_of_three, False)]
+    assert engine.update(1004, 248, exceeded) == [(nested, False)]
+    assert engine.update(1001, 248, exceeded) == [(two_of_three, True), (nested, True)]
+    assert engine.update(9999, 248, exceeded) == []
+
+    # the unchanged rule keeps its state, the new one starts over
+    changed = make_rule("nested", {"op": "any", "conditions": [make_leaf(1004, 248, 25.0, 1)]})
+    engine.compile([two_of_three, changed])
+    assert engine.get_value(two_of_three) is True
+    assert engine.get_value(changed) is False
+    assert engine.update(1001, 248, lambda leaf: (False, True)) == [(two_of_three, False)]
+
+
+def test_batch_path_matches_per_message_path(tmp_path, monkeypatch):
+    def make_rules():
+        return [make_rule("two", {"op": "k_of_n", "k": 2, "conditions": [
+                    make_leaf(mac, 248, 25.0, 1, aggregate_func=1, aggregate_window_ms=20) for mac in range(4)]},
+                    threshold_duration_millis=10),
+                make_rule("and", {"op": "all", "conditions": [make_leaf(0, 1, 60.0, 1), make_leaf(1, 248, 24.0, -1)]},
+                          channel=2),
+                # a plain def on the same channel, its commands interleave with the rule's
+                ControlDefUtils.parse_control_def(dict(make_leaf(2, 248, 28.0, 1), uuid="plain",
+                                                       threshold_duration_millis=0, control_func=0,
+                                                       control_channel=2, back_to_normal_func=1,
+                                                       allow_back_to_normal=True, fuzz_ms=0))]
+
+    rnd = random.Random(5)
+    sensor_messages = list()
+    for i in range(500):
+        sensor_type = rnd.choice([1, 248])
+        value = rnd.uniform(50.0, 70.0) if sensor_type == 1 else rnd.uniform(19.0, 31.0)
+        sensor_messages.append(SensorMessageItem(rnd.randrange(4), sensor_type, value, i))
+
+    controller, expected = make_controller(make_rules())
+    controller.process_messages(sensor_messages)
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "config.cfg").write_text("[DEFAULT]\nbatch_evaluation = True\n")
+    controller, relay_controller = make_controller(make_rules())
+    assert controller.batch_evaluator is not None
+    for i in range(0, len(sensor_messages), 50):
+        controller.process_messages(sensor_messages[i:i + 50])
+
+    assert len(expected.commands) > 10
+    assert relay_controller.commands == expected.commands
@@ -0,0 +1,124 @@
+import queue
+import threading
+
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+from bang_bang_controller import BangBangController
+from control_defs import ControlDef, ControlFunc, ThresholdType
+from control_state_journal import ControlStateJournal
+from control_trigger_store import ControlTrigger, ControlTriggerStore
+from mock_relay_controller import MockRelayController
+from sensor_message_item import SensorMessageItem
+
+
+def make_control_def() -> ControlDef:
+    return ControlDef(uuid="941a5640-82ac-11ee-b962-0242ac120002",
+                      macs={303721692},
+                      sensor_types=[248],
+                      threshold_value=28.0,
+                      hysteresis=1.5,
+                      threshold_type=ThresholdType.OVERSHOOT,
+                      threshold_duration_millis=60000,
+                      control_func=ControlFunc.ON,
+                      control_channel=WaveshareDef.CH1,
+                      back_to_normal_func=ControlFunc.OFF,
+                      allow_back_to_normal=True,
+                      fuzz_ms=500)
+
+
+def make_journaled_store(state_file: str) -> tuple[ControlStateJournal, ControlTriggerStore]:
+    journal = ControlStateJournal(state_file, compact_min_records=50)
+    store = ControlTriggerStore()
+    triggers, relay_states = journal.load()
+    for key, trigger in triggers.items():
+        store.put(key, trigger)
+    journal.write_snapshot(dict(store.items()), relay_states)
+    store.set_journal(journal)
+    return journal, store
+
+
+def test_store_changes_survive_a_restart(tmp_path):
+    state_file = str(tmp_path / "control_state.journal")
+    journal, store = make_journaled_store(state_file)
+
+    store["pending"] = ControlTrigger(1000, 5000, 29.0, "uuid-a")
+    # only trigger creation, execution and removal are journaled
+    n_records = journal.get_n_records()
+    store.refresh_expiry("pending", 9000)
+    assert journal.get_n_records() == n_records
+    store["executed"] = ControlTrigger(2000, 6000, 30.5, "uuid-b")
+    store.set_executed("executed", 4000)
+    store["removed"] = ControlTrigger(3000, 7000, 29.5, "uuid-a")
+    store.pop("removed")
+    store["expired"] = ControlTrigger(3000, 3500, 29.5, "uuid-a")
+    store.expire(4000)
+    journal.set_relay_state("default", WaveshareDef.CH3, 1)
+    journal.set_relay_state("boiler_room", WaveshareDef.CH3, 0)
+    journal.close()
+
+    triggers, relay_states = ControlStateJournal(state_file).load()
+    assert sorted(triggers.keys()) == ["executed", "pending"]
+    assert triggers["pending"].get_expire_millis() == 5000
+    assert triggers["pending"].get_control_func_execution_time_ms() is None
+    assert triggers["executed"].get_time_exceeded_millis() == 2000
+    assert triggers["executed"].get_control_func_execution_time_ms() == 4000
+    assert triggers["executed"].get_sensor_data() == 30.5
+    assert triggers["executed"].get_control_def_uuid() == "uuid-b"
+    assert relay_states == {("default", WaveshareDef.CH3): 1, ("boiler_room", WaveshareDef.CH3): 0}
+
+
+def test_torn_tail_is_dropped_and_journal_is_compacted(tmp_path):
+    state_file = str(tmp_path / "control_state.journal")
+    journal, store = make_journaled_store(state_file)
+
+    for expire_millis in range(5000, 5200):
+        store["a"] = ControlTrigger(1000, expire_millis, 29.0, "uuid-a")
+    # compacted down to the one live trigger every time the superseded records pile up
+    assert journal.get_n_records() < 50
+    journal.close()
+
+    with open(state_file, "ab") as journal_file:
+        journal_file.write(b"\x01\x40\x00\x00")
+
+    triggers, _ = ControlStateJournal(state_file).load()
+    assert triggers["a"].get_expire_millis() == 5199
+
+
+def test_controller_restart_keeps_the_duration_timer_and_relay_state(tmp_path):
+    state_file = str(tmp_path / "control_state.journal")
+    control_def = make_control_def()
+
+    controller = BangBangController(queue.Queue(), threading.Event(), relay_controller=MockRelayController(),
+                                    control_defs=[control_def], report_to_api=False, control_state_file=state_file)
+    controller.process_message(SensorMessageItem(303721692, 248, 29.0, 1700000000000))
+    controller.control_state_journal.close()
+
+    # the timer started before the restart, so 60 s after the first reading the control executes
+    relay_controller = MockRelayController()
+    controller = BangBangController(queue.Queue(), threading.Event(), relay_controller=relay_controller,
+                                    control_defs=[control_def], report_to_api=False, control_state_file=state_file)
+    assert len(controller.control_triggers) == 1
+    # the restored pending trigger expires a full duration after the restart
+    key = BangBangController.get_control_trigger_key(SensorMessageItem(303721692, 248, 29.0, 0), control_def)
+    assert controller.control_triggers[key].get_expire_millis() > controller.now_ms() + 60000
+    controller.process_message(SensorMessageItem(303721692, 248, 29.0, 1700000060000))
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1)]
+    controller.control_state_journal.close()
+
+    # a fresh relay controller is put back in the journaled state
+    relay_controller = MockRelayController()
+    controller = BangBangController(queue.Queue(), threading.Event(), relay_controller=relay_controller,
+                                    control_defs=[control_def], report_to_api=False, control_state_file=state_file)
+    assert relay_controller.get_channel_states()[WaveshareDef.CH1] == 1
+    assert controller.control_triggers[key].get_control_func_execution_time_ms() is not None
+
+    controller.process_message(SensorMessageItem(303721692, 248, 25.0, 1700000120000))
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1), (WaveshareDef.CH1, 0)]
+    controller.process_message(SensorMessageItem(303721692, 248, 29.0, 1700000180000))
+    assert len(controller.control_triggers) == 1
+    controller.control_state_journal.close()
+
+    # a control def that went away doesn't get its triggers back
+    controller = BangBangController(queue.Queue(), threading.Event(), relay_controller=MockRelayController(),
+                                    control_defs=list(), report_to_api=False, control_state_file=state_file)
+    assert len(controller.control_triggers) == 0
+    controller.control_state_journal.close()
@@ -0,0 +1,68 @@
+from control_trigger_store import ControlTrigger, ControlTriggerStore
+
+
+def test_pending_triggers_expire_in_deadline_order():
+    store = ControlTriggerStore()
+    store["a"] = ControlTrigger(0, 3000, 26.0)
+    store["b"] = ControlTrigger(0, 1000, 26.0)
+    store["c"] = ControlTrigger(0, 2000, 26.0)
+
+    assert store.get_next_expiry_ms() == 1000
+    assert store.expire(999) == []
+    assert store.expire(2000) == ["b", "c"]
+    assert store.get_metrics() == {"live": 1, "expired": 2, "evicted": 0, "dropped": 0}
+    assert store.get_next_expiry_ms() == 3000
+
+
+def test_executed_and_removed_triggers_do_not_expire():
+    store = ControlTriggerStore()
+    store["executed"] = ControlTrigger(0, 1000, 26.0)
+    store["executed"].set_control_func_execution_time_ms(500)
+    store["removed"] = ControlTrigger(0, 1000, 26.0)
+    store.pop("removed")
+    # replacing a trigger drops the old expiry
+    store["replaced"] = ControlTrigger(0, 1000, 26.0)
+    store["replaced"] = ControlTrigger(0, 5000, 26.0)
+
+    assert store.get_next_expiry_ms() == 5000
+    assert store.expire(2000) == []
+    assert "executed" in store
+    assert len(store) == 2
+
+
+def test_refreshed_trigger_expires_at_its_new_deadline():
+    store = ControlTriggerStore()
+    store["a"] = ControlTrigger(0, 1000, 26.0)
+    store["b"] = ControlTrigger(0, 2000, 26.0)
+    store.refresh_expiry("a", 3000)
+
+    assert store.get_next_expiry_ms() == 2000
+    assert store.expire(2500) == ["b"]
+    assert store.expire(3000) == ["a"]
+    assert len(store) == 0
+
+
+def test_full_store_evicts_pending_trigger_closest_to_expiry():
+    store = ControlTriggerStore(max_triggers=2)
+    store["executed"] = ControlTrigger(0, 1000, 26.0)
+    store["executed"].set_control_func_execution_time_ms(500)
+    store["pending"] = ControlTrigger(0, 2000, 26.0)
+    store["new"] = ControlTrigger(0, 3000, 26.0)
+
+    assert "pending" not in store
+    assert "executed" in store
+    assert store.get_n_evicted() == 1
+
+
+def test_full_store_of_executed_triggers_drops_the_new_trigger():
+    store = ControlTriggerStore(max_triggers=2)
+    for key in ("a", "b"):
+        store[key] = ControlTrigger(0, 1000, 26.0)
+        store.set_executed(key, 500)
+
+    assert store.put("new", ControlTrigger(0, 3000, 26.0)) is False
+    assert "new" not in store
+    assert ("a" in store) and ("b" in store)
+    assert store.get_metrics() == {"live": 2, "expired": 0, "evicted": 0, "dropped": 1}
+    # replacing a live trigger needs no room
+    assert store.put("a", ControlTrigger(0, 3000, 26.0)) is True
@@ -0,0 +1,43 @@
+import urllib.request
+
+from metrics import MetricsRegistry, MetricsServer
+
+
+def test_metrics_render_in_prometheus_text_format():
+    registry = MetricsRegistry()
+    counter = registry.counter("test_messages_total", "Messages")
+    gauge = registry.gauge("test_queue_depth", "Queue depth")
+    histogram = registry.histogram("test_fetch_seconds", "Fetch time", buckets=(0.01, 0.1))
+
+    counter.inc()
+    counter.inc(2)
+    gauge.set_function(lambda: 7)
+    for value in [0.005, 0.05, 0.5]:
+        histogram.observe(value)
+
+    lines = registry.render().splitlines()
+
+    assert "# TYPE test_messages_total counter" in lines
+    assert "test_messages_total 3" in lines
+    assert "test_queue_depth 7" in lines
+    assert 'test_fetch_seconds_bucket{le="0.01"} 1' in lines
+    assert 'test_fetch_seconds_bucket{le="0.1"} 2' in lines
+    assert 'test_fetch_seconds_bucket{le="+Inf"} 3' in lines
+    assert "test_fetch_seconds_count 3" in lines
+
+
+def test_metrics_server_serves_the_registry():
+    registry = MetricsRegistry()
+    registry.counter("test_requests_total", "Requests").inc()
+    metrics_server = MetricsServer(port=0, registry=registry)
+    metrics_server.start()
+
+    try:
+        with urllib.request.urlopen("http://127.0.0.1:{}/metrics".format(metrics_server.get_port()),
+                                    timeout=5.0) as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            body = response.read().decode("utf-8")
+    finally:
+        metrics_server.stop()
+
+    assert "test_requests_total 1" in body.splitlines()
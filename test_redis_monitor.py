@@ -1,7 +1,15 @@
 import logging
+import time
 from multiprocessing import Event, Queue
 
+import jsonpickle
+
+import metrics
+from control_defs import ControlDef, ThresholdType, ControlFunc
+from fake_redis import FakeRedis
 from redis_monitor import RedisMonitor
+from sensor_message_codec import SensorMessageCodec
+from sensor_message_item import SensorMessageItem
 
 # An example of using logging.basicConfig rather than logging.fileHandler()
 logging.basicConfig(level=logging.DEBUG,
@@ -10,6 +18,147 @@ logging.basicConfig(level=logging.DEBUG,
 logger = logging.getLogger(__name__)
 
 
+def make_fake_monitor(n_macs: int, sensor_types: list[int], round_trip_ms: float = 0.0) -> RedisMonitor:
+    """
+    Build a RedisMonitor against a FakeRedis holding one message per mac and sensor type,
+    plus an unobserved sensor type per mac that should be filtered out
+    :param n_macs:
+    :param sensor_types:
+    :param round_trip_ms:
+    :return:
+    """
+    fake_redis = FakeRedis(round_trip_ms=round_trip_ms)
+    macs = set(range(1000, 1000 + n_macs))
+    for mac in macs:
+        for sensor_type in sensor_types + [999]:
+            sensor_message = SensorMessageItem(mac, sensor_type, 21.5, 1700000000000)
+            fake_redis.hset(str(mac), str(sensor_type), jsonpickle.encode(sensor_message))
+
+    control_def = ControlDef(uuid="941a5640-82ac-11ee-b962-0242ac120002",
+                             macs=macs,
+                             sensor_types=sensor_types,
+                             threshold_value=25.0,
+                             hysteresis=1.5,
+                             threshold_type=ThresholdType.UNDERSHOOT,
+                             threshold_duration_millis=60000,
+                             control_func=ControlFunc.ON,
+                             back_to_normal_func=ControlFunc.OFF,
+                             allow_back_to_normal=True,
+                             fuzz_ms=500)
+
+    redis_monitor = RedisMonitor(Queue(), Event(), redis_client=fake_redis, control_defs=[control_def])
+    fake_redis.n_round_trips = 0
+    return redis_monitor
+
+
+def count_tracked_messages(redis_monitor: RedisMonitor) -> int:
+    return sum(len(sensor_type_dict) for sensor_type_dict in redis_monitor.last_sensor_messages.values())
+
+
+def test_bulk_fetch_matches_single_fetch():
+    single_monitor = make_fake_monitor(250, [248, 531])
+    single_monitor.bulk_fetch = False
+    single_monitor.fetch_redis_messages()
+
+    bulk_monitor = make_fake_monitor(250, [248, 531])
+    bulk_monitor.bulk_fetch = True
+    bulk_monitor.bulk_fetch_chunk_size = 100
+    bulk_monitor.fetch_redis_messages()
+
+    assert count_tracked_messages(single_monitor) == 500
+    assert count_tracked_messages(bulk_monitor) == 500
+    assert single_monitor.r.n_round_trips == 250
+    # 250 macs in chunks of 100
+    assert bulk_monitor.r.n_round_trips == 3
+
+
+def test_bulk_fetch_hmget():
+    redis_monitor = make_fake_monitor(10, [248, 531])
+    redis_monitor.bulk_fetch = True
+    redis_monitor.bulk_fetch_hmget = True
+    redis_monitor.fetch_redis_messages()
+
+    assert count_tracked_messages(redis_monitor) == 20
+    assert redis_monitor.r.n_round_trips == 1
+
+
+def test_decode_both_wire_formats():
+    sensor_message = SensorMessageItem(303721692, 248, 21.5, 1700000000000)
+    for payload in [jsonpickle.encode(sensor_message), SensorMessageCodec.encode_compact(sensor_message)]:
+        decoded = SensorMessageCodec.decode(payload)
+        assert decoded.get_mac() == 303721692
+        assert decoded.get_type() == 248
+        assert decoded.get_data() == 21.5
+        assert decoded.get_timestamp() == 1700000000000
+        assert decoded.get_is_sent() is False
+
+
+def test_incremental_fetch_only_transfers_changed_readings():
+    redis_monitor = make_fake_monitor(20, [248, 531])
+    redis_monitor.incremental_fetch = True
+    redis_monitor.bulk_fetch_chunk_size = 10
+    redis_monitor.fetch_redis_messages()
+
+    # the first cycle knows no timestamps, everything (unobserved types included) is transferred
+    assert count_tracked_messages(redis_monitor) == 40
+    assert redis_monitor.last_n_skipped == 0
+    assert redis_monitor.r.n_round_trips == 2
+    redis_monitor.take_unsent_messages()
+
+    sensor_message = SensorMessageItem(1007, 248, 19.0, 1700000060000)
+    redis_monitor.r.hset("1007", "248", jsonpickle.encode(sensor_message))
+    redis_monitor.r.n_round_trips = 0
+    n_decoded = metrics.MESSAGES_DECODED.get_value()
+    redis_monitor.fetch_redis_messages()
+
+    assert metrics.MESSAGES_DECODED.get_value() - n_decoded == 1
+    assert redis_monitor.last_n_skipped == 59
+    assert redis_monitor.last_bytes_skipped > 0
+    assert redis_monitor.last_bytes_transferred == len(jsonpickle.encode(sensor_message))
+    assert redis_monitor.r.n_round_trips == 2
+    unsent_messages = redis_monitor.take_unsent_messages()
+    assert [(m.get_mac(), m.get_type(), m.get_timestamp()) for m in unsent_messages] == [(1007, 248, 1700000060000)]
+
+
+def test_incremental_fetch_falls_back_without_scripting():
+    redis_monitor = make_fake_monitor(20, [248, 531])
+    redis_monitor.r.scripting = False
+    redis_monitor.incremental_fetch = True
+    redis_monitor.bulk_fetch = True
+    redis_monitor.fetch_redis_messages()
+
+    assert redis_monitor.incremental_fetch is False
+    assert count_tracked_messages(redis_monitor) == 40
+
+
+def test_notify_ingest_latency():
+    redis_monitor = make_fake_monitor(50, [248])
+    redis_monitor.ingest_mode = "notify"
+    redis_monitor.notify_wait_timeout_ms = 50
+    redis_monitor.start()
+
+    # the initial fetch queues the cached state
+    for _ in range(50):
+        redis_monitor.message_queue.get(timeout=2.0)
+
+    n_round_trips = redis_monitor.r.n_round_trips
+    start = time.perf_counter()
+    sensor_message = SensorMessageItem(1007, 248, 19.0, 1700000060000)
+    redis_monitor.r.hset("1007", "248", jsonpickle.encode(sensor_message))
+    queued_message = redis_monitor.message_queue.get(timeout=1.0)
+    latency_ms = (time.perf_counter() - start) * 1000.0
+
+    redis_monitor.sig_event.set()
+    redis_monitor.join(timeout=2.0)
+
+    assert queued_message.get_mac() == 1007
+    assert queued_message.get_timestamp() == 1700000060000
+    assert latency_ms < 100.0
+    # only the changed mac was refetched (plus the hset itself)
+    assert redis_monitor.r.n_round_trips - n_round_trips == 2
+    assert not redis_monitor.is_alive()
+
+
 def main():
     sig_event = Event()
     msg_queue = Queue()
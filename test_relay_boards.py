@@ -0,0 +1,124 @@
+import queue
+import threading
+import time
+
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+from bang_bang_controller import BangBangController
+from control_defs import ControlDef, ControlDefUtils, ControlFunc, ThresholdType
+from fake_api_writer import RecordingApiWriter
+from mock_relay_controller import MockRelayController
+from sensor_message_item import SensorMessageItem
+
+
+def make_control_def(uuid: str, mac: int, board_id: str) -> ControlDef:
+    return ControlDef(uuid=uuid,
+                      macs={mac},
+                      sensor_types=[248],
+                      threshold_value=25.0,
+                      hysteresis=1.5,
+                      threshold_type=ThresholdType.OVERSHOOT,
+                      threshold_duration_millis=0,
+                      control_func=ControlFunc.ON,
+                      control_channel=WaveshareDef.CH1,
+                      back_to_normal_func=ControlFunc.OFF,
+                      allow_back_to_normal=True,
+                      fuzz_ms=0,
+                      board_id=board_id)
+
+
+def make_controller(relay_controller: MockRelayController, relay_board: MockRelayController,
+                    api_writer: RecordingApiWriter = None) -> BangBangController:
+    control_defs = [make_control_def("941a5640-82ac-11ee-b962-0242ac120002", 1001, "default"),
+                    make_control_def("941a5640-82ac-11ee-b962-0242ac120003", 1002, "boiler_room")]
+    return BangBangController(queue.Queue(), threading.Event(), relay_controller=relay_controller,
+                              control_defs=control_defs, report_to_api=api_writer is not None, api_writer=api_writer,
+                              relay_boards={"boiler_room": relay_board})
+
+
+def switch_both_boards_on(controller: BangBangController):
+    # a 0 duration def executes on the second exceeding reading
+    for timestamp in (0, 1):
+        controller.process_message(SensorMessageItem(1001, 248, 30.0, timestamp))
+        controller.process_message(SensorMessageItem(1002, 248, 30.0, timestamp))
+
+
+def stop_relay_dispatchers(controller: BangBangController):
+    for relay_dispatcher in controller.get_relay_dispatchers().values():
+        relay_dispatcher.stop()
+        relay_dispatcher.join()
+
+
+def wait_for_board_stat(controller: BangBangController, board_id: str, stat: str, value):
+    deadline = time.perf_counter() + 2.0
+    while (controller.get_relay_board_stats()[board_id][stat] != value) and (time.perf_counter() < deadline):
+        time.sleep(0.005)
+
+
+def test_board_id_is_parsed_and_defaults_to_the_default_board():
+    control_def = {"uuid": "941a5640-82ac-11ee-b962-0242ac120002", "macs": [1001], "sensor_types": [248],
+                   "threshold_value": 25.0, "hysteresis": 1.5, "threshold_type": 1, "threshold_duration_millis": 0,
+                   "control_func": 1, "control_channel": 1, "back_to_normal_func": 0,
+                   "allow_back_to_normal": True, "fuzz_ms": 0}
+    assert ControlDefUtils.parse_control_def(control_def).get_board_id() == "default"
+    control_def["board_id"] = "boiler_room"
+    assert ControlDefUtils.parse_control_def(control_def).get_board_id() == "boiler_room"
+
+
+def test_boards_are_written_in_parallel():
+    relay_controller = MockRelayController(command_latency_ms=150)
+    relay_board = MockRelayController(command_latency_ms=150)
+    controller = make_controller(relay_controller, relay_board)
+    assert sorted(controller.get_relay_dispatchers().keys()) == ["boiler_room", "default"]
+    for relay_dispatcher in controller.get_relay_dispatchers().values():
+        relay_dispatcher.start()
+
+    start = time.perf_counter()
+    switch_both_boards_on(controller)
+    stop_relay_dispatchers(controller)
+    elapsed_s = time.perf_counter() - start
+
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1)]
+    assert relay_board.commands == [(WaveshareDef.CH1, 1)]
+    # the coalesce window plus one serial write, not two writes back to back
+    assert elapsed_s < 0.29
+    assert controller.get_relay_board_stats()["boiler_room"]["written"] == 1
+
+
+def test_board_health_is_tracked_per_board():
+    relay_board = MockRelayController()
+    relay_board.n_failing_commands = 1
+    controller = make_controller(MockRelayController(), relay_board)
+    for relay_dispatcher in controller.get_relay_dispatchers().values():
+        relay_dispatcher.start()
+
+    switch_both_boards_on(controller)
+    wait_for_board_stat(controller, "boiler_room", "failed", 1)
+    stats = controller.get_relay_board_stats()
+    assert stats["boiler_room"]["healthy"] is False
+    assert stats["default"]["healthy"] is True
+
+    # the retry succeeds
+    wait_for_board_stat(controller, "boiler_room", "written", 1)
+    stop_relay_dispatchers(controller)
+    stats = controller.get_relay_board_stats()
+    assert stats["boiler_room"]["healthy"] is True
+    assert relay_board.commands == [(WaveshareDef.CH1, 1)]
+
+
+def test_board_states_are_reported_under_the_board_api_mac(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "config.cfg").write_text("[DEFAULT]\napi_mac = 41\n"
+                                         "[RELAY_BOARD boiler_room]\nserial_port = /dev/null\nboard_api_mac = 42\n")
+    api_writer = RecordingApiWriter()
+    controller = make_controller(MockRelayController(), MockRelayController(), api_writer)
+    for relay_dispatcher in controller.get_relay_dispatchers().values():
+        relay_dispatcher.start()
+    controller.api_sender.start()
+
+    switch_both_boards_on(controller)
+    controller.update_api()
+    controller.stop_workers()
+
+    batch = api_writer.batches[0]
+    assert len(batch) == 16
+    assert {(datum["mac"], datum["data"]) for datum in batch if datum["type"] == 0x12D} == {(41, 1), (42, 1)}
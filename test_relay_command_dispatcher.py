@@ -0,0 +1,68 @@
+import time
+
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+from mock_relay_controller import MockRelayController
+from relay_command_dispatcher import RelayCommandDispatcher
+
+
+def test_submit_does_not_wait_for_the_board():
+    relay_controller = MockRelayController(command_latency_ms=50)
+    dispatcher = RelayCommandDispatcher(relay_controller, coalesce_window_ms=0)
+    dispatcher.start()
+
+    start = time.perf_counter()
+    dispatcher.set_channel_on(WaveshareDef.CH1)
+    dispatcher.set_channel_on(WaveshareDef.CH2)
+    submit_ms = (time.perf_counter() - start) * 1000.0
+
+    dispatcher.stop()
+    dispatcher.join()
+
+    assert submit_ms < 10.0
+    assert relay_controller.get_channel_states()[WaveshareDef.CH1] == 1
+    assert relay_controller.get_channel_states()[WaveshareDef.CH2] == 1
+    assert dispatcher.get_stats()["written"] == 2
+    assert dispatcher.get_stats()["max_latency_ms"] >= 50.0
+
+
+def test_redundant_commands_collapse_and_skip():
+    relay_controller = MockRelayController()
+    dispatcher = RelayCommandDispatcher(relay_controller, coalesce_window_ms=100)
+    dispatcher.start()
+
+    # flapping within the window collapses into the last command
+    dispatcher.set_channel_on(WaveshareDef.CH3)
+    dispatcher.set_channel_off(WaveshareDef.CH3)
+    dispatcher.set_channel_on(WaveshareDef.CH3)
+    assert dispatcher.get_channel_states()[WaveshareDef.CH3] == 1
+    time.sleep(0.3)
+
+    # already on, no write
+    dispatcher.set_channel_on(WaveshareDef.CH3)
+    dispatcher.stop()
+    dispatcher.join()
+
+    assert relay_controller.commands == [(WaveshareDef.CH3, 1)]
+    stats = dispatcher.get_stats()
+    assert stats["submitted"] == 4
+    assert stats["collapsed"] == 2
+    assert stats["skipped"] == 1
+    assert stats["written"] == 1
+
+
+def test_failed_write_is_retried_until_it_succeeds():
+    relay_controller = MockRelayController()
+    relay_controller.n_failing_commands = 2
+    dispatcher = RelayCommandDispatcher(relay_controller, coalesce_window_ms=0, retry_min_ms=20, retry_max_ms=40)
+    dispatcher.start()
+
+    dispatcher.set_channel_on(WaveshareDef.CH1)
+    assert dispatcher.get_channel_states()[WaveshareDef.CH1] == 1
+    time.sleep(0.3)
+
+    dispatcher.stop()
+    dispatcher.join()
+
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1)]
+    assert dispatcher.get_stats()["failed"] == 2
+    assert dispatcher.get_stats()["written"] == 1
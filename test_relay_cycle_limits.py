@@ -0,0 +1,171 @@
+import queue
+import threading
+
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+from bang_bang_controller import BangBangController
+from control_defs import ControlDef, ControlDefUtils, ControlFunc, ThresholdType
+from deadline_scheduler import DeadlineScheduler
+from mock_relay_controller import MockRelayController
+from sensor_message_item import SensorMessageItem
+
+
+class ManualClock:
+
+    def __init__(self):
+        self.time_ms = 0
+
+    def __call__(self) -> float:
+        return self.time_ms / 1000.0
+
+
+def make_control_def(**cycle_limits) -> ControlDef:
+    return ControlDef(uuid="941a5640-82ac-11ee-b962-0242ac120002",
+                      macs={1001},
+                      sensor_types=[248],
+                      threshold_value=25.0,
+                      hysteresis=1.0,
+                      threshold_type=ThresholdType.OVERSHOOT,
+                      threshold_duration_millis=0,
+                      control_func=ControlFunc.ON,
+                      control_channel=WaveshareDef.CH1,
+                      back_to_normal_func=ControlFunc.OFF,
+                      allow_back_to_normal=True,
+                      fuzz_ms=0,
+                      **cycle_limits)
+
+
+def make_controller(control_def: ControlDef) -> tuple[BangBangController, MockRelayController, ManualClock]:
+    clock = ManualClock()
+    relay_controller = MockRelayController()
+    controller = BangBangController(queue.Queue(), threading.Event(), relay_controller=relay_controller,
+                                    control_defs=[control_def], report_to_api=False, clock=clock,
+                                    control_state_file="")
+    return controller, relay_controller, clock
+
+
+def send(controller: BangBangController, clock: ManualClock, time_ms: int, value: float):
+    # the run loop: the deadlines due by now, then the reading
+    clock.time_ms = time_ms
+    controller.run_due_deadlines()
+    controller.process_message(SensorMessageItem(1001, 248, value, time_ms))
+
+
+def test_scheduler_fires_in_deadline_order_and_replaces_timers():
+    scheduler = DeadlineScheduler()
+    fired = list()
+    scheduler.schedule("a", 300, lambda: fired.append("a"))
+    scheduler.schedule("b", 100, lambda: fired.append("b"))
+    scheduler.schedule("c", 200, lambda: fired.append("c"))
+    # rescheduling replaces the timer, cancelling forgets it
+    scheduler.schedule("b", 250, lambda: fired.append("b again"))
+    scheduler.cancel("c")
+
+    assert scheduler.get_next_deadline_ms() == 250
+    assert scheduler.run_due(249) == 0
+    assert scheduler.run_due(1000) == 2
+    assert fired == ["b again", "a"]
+    assert scheduler.get_next_deadline_ms() is None
+
+
+def test_cycle_limits_are_parsed():
+    control_def = ControlDefUtils.parse_control_def({
+        "uuid": "941a5640-82ac-11ee-b962-0242ac120002", "macs": [1001], "sensor_types": [248],
+        "threshold_value": 25.0, "hysteresis": 1.5, "threshold_type": 1, "threshold_duration_millis": 0,
+        "control_func": 1, "control_channel": 1, "back_to_normal_func": 0, "allow_back_to_normal": True,
+        "fuzz_ms": 0, "max_on_millis": 600000, "min_off_millis": 60000})
+    assert control_def.get_max_on_millis() == 600000
+    assert control_def.get_min_on_millis() == 0
+    assert control_def.get_min_off_millis() == 60000
+    assert control_def.get_max_switches_per_hour() == 0
+
+
+def test_max_on_returns_the_channel_to_normal():
+    controller, relay_controller, clock = make_controller(make_control_def(max_on_millis=600000))
+    send(controller, clock, 0, 30.0)
+    send(controller, clock, 10000, 30.0)
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1)]
+    # the loop sleeps until the max on deadline, not the next reading
+    assert controller.get_next_deadline_ms() <= 610000
+
+    clock.time_ms = 610000
+    controller.run_due_deadlines()
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1), (WaveshareDef.CH1, 0)]
+
+    # still exceeding, the control stays off until the readings return to normal and exceed again
+    send(controller, clock, 620000, 30.0)
+    send(controller, clock, 630000, 20.0)
+    send(controller, clock, 640000, 30.0)
+    send(controller, clock, 650000, 30.0)
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1), (WaveshareDef.CH1, 0), (WaveshareDef.CH1, 0),
+                                         (WaveshareDef.CH1, 1)]
+
+
+def test_min_on_holds_back_the_return_to_normal():
+    controller, relay_controller, clock = make_controller(make_control_def(min_on_millis=300000))
+    send(controller, clock, 0, 30.0)
+    send(controller, clock, 10000, 30.0)
+    send(controller, clock, 20000, 20.0)
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1)]
+
+    clock.time_ms = 310000
+    controller.run_due_deadlines()
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1), (WaveshareDef.CH1, 0)]
+    assert len(controller.control_triggers) == 0
+
+
+def test_exceeding_again_cancels_a_held_back_return_to_normal():
+    controller, relay_controller, clock = make_controller(make_control_def(min_on_millis=300000))
+    send(controller, clock, 0, 30.0)
+    send(controller, clock, 10000, 30.0)
+    send(controller, clock, 20000, 20.0)
+    send(controller, clock, 30000, 30.0)
+
+    clock.time_ms = 310000
+    controller.run_due_deadlines()
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1)]
+
+
+def test_min_off_and_max_switches_per_hour():
+    controller, relay_controller, clock = make_controller(make_control_def(min_off_millis=120000,
+                                                                           max_switches_per_hour=3))
+    send(controller, clock, 0, 30.0)
+    send(controller, clock, 10000, 30.0)
+    send(controller, clock, 20000, 20.0)
+    assert len(relay_controller.commands) == 2
+
+    # off for less than min_off_millis
+    send(controller, clock, 30000, 30.0)
+    send(controller, clock, 40000, 30.0)
+    assert len(relay_controller.commands) == 2
+    clock.time_ms = 140000
+    controller.run_due_deadlines()
+    assert relay_controller.commands[-1] == (WaveshareDef.CH1, 1)
+
+    # the fourth switch within the hour waits for the first one to leave the hour
+    send(controller, clock, 150000, 20.0)
+    assert len(relay_controller.commands) == 3
+    assert controller.get_next_deadline_ms() <= 10000 + 3600000
+    clock.time_ms = 10000 + 3600000
+    controller.run_due_deadlines()
+    assert relay_controller.commands[-1] == (WaveshareDef.CH1, 0)
+    assert len(relay_controller.commands) == 4
+
+
+def test_held_back_control_keeps_its_pending_trigger_alive():
+    controller, relay_controller, clock = make_controller(make_control_def(min_off_millis=120000))
+    controller.control_trigger_stale_ms = 10000
+    send(controller, clock, 0, 30.0)
+    send(controller, clock, 5000, 30.0)
+    send(controller, clock, 10000, 20.0)
+    assert len(relay_controller.commands) == 2
+
+    # held back by min_off_millis for far longer than the trigger would go stale
+    for time_ms in range(15000, 130000, 5000):
+        send(controller, clock, time_ms, 30.0)
+    assert len(relay_controller.commands) == 2
+    key = BangBangController.get_control_trigger_key(SensorMessageItem(1001, 248, 30.0, 0), controller.control_defs[0])
+    assert controller.control_triggers[key].get_time_exceeded_millis() == 15000
+
+    clock.time_ms = 130000
+    controller.run_due_deadlines()
+    assert relay_controller.commands[-1] == (WaveshareDef.CH1, 1)
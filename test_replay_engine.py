@@ -0,0 +1,97 @@
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+from control_defs import ControlDef, ControlFunc, ThresholdType
+from replay_engine import ReplayEngine, VirtualClock, load_sensor_messages, triangle_wave_messages
+from sensor_message_codec import SensorMessageCodec
+from sensor_message_item import SensorMessageItem
+
+
+def make_control_def(threshold_duration_millis: int = 10000) -> ControlDef:
+    return ControlDef(uuid="941a5640-82ac-11ee-b962-0242ac120002",
+                      macs={303721692},
+                      sensor_types=[248],
+                      threshold_value=28.0,
+                      hysteresis=1.5,
+                      threshold_type=ThresholdType.OVERSHOOT,
+                      threshold_duration_millis=threshold_duration_millis,
+                      control_func=ControlFunc.ON,
+                      control_channel=WaveshareDef.CH1,
+                      back_to_normal_func=ControlFunc.OFF,
+                      allow_back_to_normal=True,
+                      fuzz_ms=500)
+
+
+def test_virtual_clock_never_runs_backwards():
+    clock = VirtualClock(1000)
+    clock.set_time_ms(500)
+    assert clock.get_time_ms() == 1000
+    clock.set_time_ms(2500)
+    clock.advance_ms(500)
+    assert clock.time() == 3.0
+
+
+def test_triangle_wave_switches_once_per_period():
+    # 10 periods of 2 minutes, a reading every second
+    sensor_messages = triangle_wave_messages(303721692, 248, 0, 10 * 120000, 1000, (20.0, 30.0), 120000)
+
+    replay_engine = ReplayEngine([make_control_def()])
+    replay_engine.replay(sensor_messages)
+
+    transitions = replay_engine.get_timeline()["941a5640-82ac-11ee-b962-0242ac120002"]
+    assert [transition.get_state() for transition in transitions] == [1, 0] * 10
+    for turned_on, turned_off in zip(transitions[::2], transitions[1::2]):
+        assert turned_on.get_sensor_data() > 28.0
+        assert turned_off.get_sensor_data() < 26.5
+        assert turned_on.get_time_ms() < turned_off.get_time_ms()
+    assert replay_engine.get_channel_states()[WaveshareDef.CH1] == 0
+
+
+def test_short_excursion_expires_without_switching():
+    # above the threshold for 5 s, half the required duration, then back down for good
+    sensor_messages = [SensorMessageItem(303721692, 248, 29.0, time_ms) for time_ms in range(0, 5000, 1000)]
+    sensor_messages += [SensorMessageItem(303721692, 248, 27.5, time_ms) for time_ms in range(5000, 600000, 1000)]
+
+    replay_engine = ReplayEngine([make_control_def()])
+    replay_engine.replay(sensor_messages)
+
+    assert replay_engine.get_timeline() == {}
+    assert len(replay_engine.controller.control_triggers) == 0
+
+
+def test_readings_further_apart_than_the_duration_still_switch():
+    # a reading every 60 s against a 30 s duration, and a 0 duration def
+    for threshold_duration_millis in (30000, 0):
+        sensor_messages = [SensorMessageItem(303721692, 248, 29.0, time_ms) for time_ms in range(0, 300000, 60000)]
+
+        replay_engine = ReplayEngine([make_control_def(threshold_duration_millis)])
+        replay_engine.replay(sensor_messages)
+
+        transitions = replay_engine.get_timeline()["941a5640-82ac-11ee-b962-0242ac120002"]
+        assert [(transition.get_time_ms(), transition.get_state()) for transition in transitions] == [(60000, 1)]
+        assert replay_engine.controller.control_triggers.get_n_expired() == 0
+
+
+def test_recorded_stream_is_replayed_in_timestamp_order(tmp_path):
+    sensor_messages = triangle_wave_messages(303721692, 248, 0, 4 * 120000, 1000, (20.0, 30.0), 120000)
+    messages_file = tmp_path / "messages.txt"
+    messages_file.write_text("\n".join(SensorMessageCodec.encode_compact(sensor_message)
+                                       for sensor_message in reversed(sensor_messages)) + "\n")
+
+    loaded = load_sensor_messages(str(messages_file))
+    assert [sensor_message.get_timestamp() for sensor_message in loaded] == \
+           [sensor_message.get_timestamp() for sensor_message in sensor_messages]
+
+    replay_engine = ReplayEngine([make_control_def()])
+    replay_engine.replay(loaded)
+    assert len(replay_engine.get_timeline()["941a5640-82ac-11ee-b962-0242ac120002"]) == 8
+
+
+def test_replay_writes_inline_even_with_dispatchers_configured(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "config.cfg").write_text("[RELAY_CONTROLLER]\nasync_relay_commands = True\n")
+    control_def = make_control_def()
+    control_def.set_board_id("boiler_room")
+
+    replay_engine = ReplayEngine([control_def])
+    assert replay_engine.controller.get_relay_dispatchers() == {}
+    replay_engine.replay(triangle_wave_messages(303721692, 248, 0, 120000, 1000, (20.0, 30.0), 120000))
+    assert replay_engine.relay_boards["boiler_room"].get_channel_states()[WaveshareDef.CH1] == 0
@@ -0,0 +1,172 @@
+import queue
+import random
+import threading
+
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+from bang_bang_controller import BangBangController
+from control_defs import ControlDef, ControlDefUtils, ControlFunc, ThresholdType
+from mock_relay_controller import MockRelayController
+from sensor_liveness import SensorLivenessTracker
+from sensor_message_item import SensorMessageItem
+from timing_wheel import HierarchicalTimingWheel
+
+
+class ManualClock:
+
+    def __init__(self):
+        self.time_ms = 0
+
+    def __call__(self) -> float:
+        return self.time_ms / 1000.0
+
+
+def make_control_def(macs: set, **kwargs) -> ControlDef:
+    return ControlDef(uuid="941a5640-82ac-11ee-b962-0242ac120002",
+                      macs=macs,
+                      sensor_types=[248],
+                      threshold_value=25.0,
+                      hysteresis=1.0,
+                      threshold_type=ThresholdType.OVERSHOOT,
+                      threshold_duration_millis=0,
+                      control_func=ControlFunc.ON,
+                      control_channel=WaveshareDef.CH1,
+                      back_to_normal_func=ControlFunc.OFF,
+                      allow_back_to_normal=True,
+                      fuzz_ms=0,
+                      **kwargs)
+
+
+def make_controller(control_defs: list[ControlDef]) -> tuple[BangBangController, MockRelayController, ManualClock]:
+    clock = ManualClock()
+    relay_controller = MockRelayController()
+    controller = BangBangController(queue.Queue(), threading.Event(), relay_controller=relay_controller,
+                                    control_defs=control_defs, report_to_api=False, clock=clock,
+                                    control_state_file="")
+    return controller, relay_controller, clock
+
+
+def send(controller: BangBangController, clock: ManualClock, time_ms: int, mac: int, value: float):
+    # the run loop: the deadlines due by now, then the reading
+    clock.time_ms = time_ms
+    controller.run_due_deadlines()
+    controller.process_message(SensorMessageItem(mac, 248, value, time_ms))
+
+
+def test_timing_wheel_matches_a_sorted_list_of_deadlines():
+    rnd = random.Random(11)
+    wheel = HierarchicalTimingWheel(tick_ms=10, wheel_bits=3, n_levels=3)
+    deadlines = dict()
+    now_ms = 0
+    wheel.start(now_ms)
+
+    for _ in range(3000):
+        action = rnd.random()
+        key = rnd.randrange(200)
+        if action < 0.6:
+            # mostly short timers, some beyond the span of the top level
+            deadline_ms = now_ms + rnd.choice([rnd.randrange(1000), rnd.randrange(20000)])
+            wheel.schedule(key, deadline_ms)
+            deadlines[key] = max(-(-deadline_ms // 10), now_ms // 10 + 1)
+        elif action < 0.7:
+            assert wheel.cancel(key) == (key in deadlines)
+            deadlines.pop(key, None)
+        else:
+            now_ms += rnd.choice([rnd.randrange(100), rnd.randrange(50000)])
+            expected = sorted((deadline_tick, key) for key, deadline_tick in deadlines.items()
+                              if deadline_tick <= now_ms // 10)
+            fired = wheel.advance(now_ms)
+            assert sorted(fired) == sorted(key for _, key in expected)
+            for key in fired:
+                del deadlines[key]
+        assert len(wheel) == len(deadlines)
+
+
+def test_tracker_uses_the_shortest_timeout_and_tracks_named_macs_from_load():
+    tracker = SensorLivenessTracker(default_timeout_ms=60000, tick_ms=1000)
+    named = make_control_def({1001})
+    wildcard = make_control_def(set(), stale_timeout_millis=30000)
+    untracked = make_control_def({1002}, stale_timeout_millis=0)
+    tracker.compile([named, wildcard], 0)
+    assert tracker.get_sensor_timeout_ms(1001, 248) == 30000
+    assert tracker.get_sensor_timeout_ms(1003, 1) == 0
+    # the named mac is tracked before its first reading, a wildcard sensor only from its first reading
+    assert tracker.get_n_tracked() == 1
+
+    tracker.seen(1003, 248, 10000)
+    assert tracker.advance(30000) == [(1001, 248)]
+    assert tracker.advance(40000) == [(1003, 248)]
+    assert tracker.get_n_stale() == 2
+    assert tracker.seen(1001, 248, 45000) is True
+    assert tracker.seen(1001, 248, 50000) is False
+
+    tracker = SensorLivenessTracker()
+    tracker.compile([untracked], 0)
+    assert (tracker.is_tracking() is False) and (tracker.get_n_tracked() == 0)
+
+
+def test_stale_sensor_returns_its_control_to_normal():
+    controller, relay_controller, clock = make_controller([make_control_def({1001}, stale_timeout_millis=60000)])
+    send(controller, clock, 0, 1001, 30.0)
+    send(controller, clock, 10000, 1001, 30.0)
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1)]
+    control_trigger = controller.control_triggers.get("1001-248-941a5640-82ac-11ee-b962-0242ac120002")
+    assert control_trigger.get_last_sensor_read_ms() == 10000
+
+    clock.time_ms = 69000
+    controller.run_due_deadlines()
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1)]
+    assert controller.get_next_deadline_ms() <= 70000
+    clock.time_ms = 70000
+    controller.run_due_deadlines()
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1), (WaveshareDef.CH1, 0)]
+    assert len(controller.control_triggers) == 0
+    assert controller.sensor_liveness.is_stale(1001, 248)
+
+    # back from the next reading, the control starts over
+    send(controller, clock, 80000, 1001, 30.0)
+    send(controller, clock, 90000, 1001, 30.0)
+    assert controller.sensor_liveness.get_n_stale() == 0
+    assert relay_controller.commands[-1] == (WaveshareDef.CH1, 1)
+
+
+def test_stale_func_is_the_failsafe_state():
+    control_def = ControlDefUtils.parse_control_def({
+        "uuid": "941a5640-82ac-11ee-b962-0242ac120002", "macs": [1001, 1002], "sensor_types": [248],
+        "threshold_value": 25.0, "hysteresis": 1.0, "threshold_type": 1, "threshold_duration_millis": 60000,
+        "control_func": 1, "control_channel": 1, "back_to_normal_func": 0, "allow_back_to_normal": True,
+        "fuzz_ms": 0, "stale_timeout_millis": 120000, "stale_func": 1})
+    assert control_def.get_stale_func() is ControlFunc.ON
+    controller, relay_controller, clock = make_controller([control_def])
+
+    # a pending trigger of the stale sensor is dropped, the sensor that never reported is stale too
+    for time_ms in range(0, 130000, 20000):
+        send(controller, clock, time_ms, 1001, 20.0 if time_ms < 100000 else 30.0)
+    clock.time_ms = 120000
+    controller.run_due_deadlines()
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1)]
+    assert len(controller.control_triggers) == 1
+
+    clock.time_ms = 250000
+    controller.run_due_deadlines()
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1), (WaveshareDef.CH1, 1)]
+    assert len(controller.control_triggers) == 0
+
+
+def test_stale_leaf_returns_its_rule_to_normal():
+    control_rule = ControlDefUtils.parse_control_def({
+        "uuid": "any-fan", "threshold_duration_millis": 0, "control_func": 1, "control_channel": 1,
+        "back_to_normal_func": 0, "allow_back_to_normal": True, "fuzz_ms": 0, "stale_timeout_millis": 60000,
+        "condition": {"op": "any", "conditions": [
+            {"macs": [mac], "sensor_types": [248], "threshold_value": 25.0, "hysteresis": 1.0, "threshold_type": 1}
+            for mac in (1001, 1002)]}})
+    controller, relay_controller, clock = make_controller([control_rule])
+    send(controller, clock, 0, 1002, 20.0)
+    send(controller, clock, 10000, 1001, 30.0)
+    send(controller, clock, 20000, 1001, 30.0)
+    send(controller, clock, 50000, 1002, 20.0)
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1)]
+
+    clock.time_ms = 80000
+    controller.run_due_deadlines()
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1), (WaveshareDef.CH1, 0)]
+    assert controller.control_rules.get_value(control_rule) is False
@@ -0,0 +1,80 @@
+import multiprocessing
+import queue
+import threading
+
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+from bang_bang_controller import BangBangController
+from control_defs import ControlDefUtils
+from mock_relay_controller import MockRelayController
+from sharded_daemon import RelayCommandProxy, RelayCommandConsumer
+
+
+def test_shards_partition_the_observables():
+    observables = {mac: {248, 531} for mac in range(1000, 1100)}
+    n_shards = 3
+
+    shards = [ControlDefUtils.get_shard_observables(observables, shard_id, n_shards) for shard_id in range(n_shards)]
+
+    # every mac is owned by exactly one shard
+    assert sum(len(shard) for shard in shards) == len(observables)
+    merged = dict()
+    for shard in shards:
+        merged.update(shard)
+    assert merged == observables
+
+
+def test_shard_commands_reach_the_relay_owner():
+    command_queue = multiprocessing.Queue()
+    sig_event = multiprocessing.Event()
+    relay_controller = MockRelayController()
+    consumer = RelayCommandConsumer(command_queue, relay_controller, sig_event, poll_timeout_s=0.05)
+    consumer.start()
+
+    shard_0 = RelayCommandProxy(command_queue, 0)
+    shard_1 = RelayCommandProxy(command_queue, 1)
+    shard_0.set_channel_on(WaveshareDef.CH1)
+    shard_1.set_channel_on(WaveshareDef.CH2)
+    shard_0.set_channel_off(WaveshareDef.CH1)
+
+    sig_event.set()
+    consumer.join()
+
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1), (WaveshareDef.CH2, 1), (WaveshareDef.CH1, 0)]
+    assert consumer.n_commands == {0: 2, 1: 1}
+    assert shard_0.get_channel_states() == {WaveshareDef.CH1: 0}
+
+
+def test_shard_controller_leaves_dispatch_and_outbox_to_the_relay_owner(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "config.cfg").write_text("[DEFAULT]\napi_outbox_file = api_outbox.db\n"
+                                         "[RELAY_CONTROLLER]\nasync_relay_commands = True\n")
+    proxy = RelayCommandProxy(multiprocessing.Queue(), 0)
+
+    controller = BangBangController(queue.Queue(), threading.Event(), relay_controller=proxy, control_defs=list(),
+                                    report_to_api=False, inline_relay_commands=True)
+
+    assert controller.relay_dispatcher is None
+    assert controller.relay_controller is proxy
+    assert controller.api_outbox is None
+    assert controller.api_outbox_sender is None
+    assert not (tmp_path / "api_outbox.db").exists()
+
+
+def test_shard_commands_reach_the_board_they_address():
+    command_queue = multiprocessing.Queue()
+    sig_event = multiprocessing.Event()
+    relay_controller = MockRelayController()
+    relay_board = MockRelayController()
+    consumer = RelayCommandConsumer(command_queue, relay_controller, sig_event, poll_timeout_s=0.05,
+                                    relay_boards={"boiler_room": relay_board})
+    consumer.start()
+
+    RelayCommandProxy(command_queue, 0).set_channel_on(WaveshareDef.CH1)
+    RelayCommandProxy(command_queue, 0, "boiler_room").set_channel_on(WaveshareDef.CH2)
+    RelayCommandProxy(command_queue, 1, "unknown").set_channel_on(WaveshareDef.CH3)
+
+    sig_event.set()
+    consumer.join()
+
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1)]
+    assert relay_board.commands == [(WaveshareDef.CH2, 1)]
@@ -0,0 +1,137 @@
+import math
+import queue
+import random
+import threading
+
+from WaveshareRelayControl.waveshare_defs import WaveshareDef
+from bang_bang_controller import BangBangController
+from control_defs import AggregateFunc, ControlDef, ControlDefUtils, ControlFunc, ThresholdType
+from mock_relay_controller import MockRelayController
+from sensor_message_item import SensorMessageItem
+from window_operators import SensorWindowStore, make_window
+
+
+def make_control_def(uuid: str, aggregate_func: AggregateFunc, aggregate_window_ms: int,
+                     threshold_value: float = 25.0, macs: set = None) -> ControlDef:
+    return ControlDef(uuid=uuid,
+                      macs={1001} if macs is None else macs,
+                      sensor_types=[248],
+                      threshold_value=threshold_value,
+                      hysteresis=1.0,
+                      threshold_type=ThresholdType.OVERSHOOT,
+                      threshold_duration_millis=0,
+                      control_func=ControlFunc.ON,
+                      control_channel=WaveshareDef.CH1,
+                      back_to_normal_func=ControlFunc.OFF,
+                      allow_back_to_normal=True,
+                      fuzz_ms=0,
+                      aggregate_func=aggregate_func,
+                      aggregate_window_ms=aggregate_window_ms)
+
+
+def brute_force(aggregate_func: AggregateFunc, window_ms: int, samples: list[tuple[int, float]]):
+    timestamp = samples[-1][0]
+    in_window = [value for sample_timestamp, value in samples if sample_timestamp >= timestamp - window_ms]
+    if aggregate_func is AggregateFunc.MOVING_AVERAGE:
+        return sum(in_window) / len(in_window)
+    elif aggregate_func is AggregateFunc.MIN:
+        return min(in_window)
+    elif aggregate_func is AggregateFunc.MAX:
+        return max(in_window)
+    # the rate spans from the last reading at or before the window start
+    before = [sample for sample in samples if sample[0] <= timestamp - window_ms]
+    first_timestamp, first_value = before[-1] if len(before) > 0 else samples[0]
+    if first_timestamp == timestamp:
+        return None
+    return (samples[-1][1] - first_value) * 60000.0 / (timestamp - first_timestamp)
+
+
+def test_windows_match_brute_force():
+    rnd = random.Random(3)
+    samples = list()
+    timestamp = 0
+    for _ in range(2000):
+        timestamp += rnd.choice([1000, 5000, 10000, 30000])
+        samples.append((timestamp, rnd.uniform(15.0, 35.0)))
+
+    for aggregate_func in (AggregateFunc.MOVING_AVERAGE, AggregateFunc.MIN, AggregateFunc.MAX,
+                           AggregateFunc.RATE_OF_CHANGE):
+        window = make_window(aggregate_func, 60000, 4096)
+        for i, (timestamp, value) in enumerate(samples):
+            window.push(timestamp, value)
+            expected = brute_force(aggregate_func, 60000, samples[:i + 1])
+            if expected is None:
+                assert window.get_value() is None
+            else:
+                assert math.isclose(window.get_value(), expected, rel_tol=1e-9, abs_tol=1e-9)
+
+
+def test_windows_are_bounded_by_max_samples():
+    window = make_window(AggregateFunc.MAX, 60000, 4)
+    for timestamp, value in enumerate([9.0, 1.0, 2.0, 3.0, 4.0]):
+        window.push(timestamp, value)
+    # the 9.0 fell out of the 4 reading ring buffer even though it is inside the 60 s window
+    assert window.get_value() == 4.0
+
+    window = make_window(AggregateFunc.MOVING_AVERAGE, 60000, 4)
+    for timestamp, value in enumerate([9.0, 1.0, 2.0, 3.0, 4.0]):
+        window.push(timestamp, value)
+    assert window.get_value() == 2.5
+
+
+def test_ewma_weights_by_elapsed_time():
+    window = make_window(AggregateFunc.EWMA, 60000, 1)
+    window.push(0, 20.0)
+    window.push(60000, 30.0)
+    assert math.isclose(window.get_value(), 20.0 + 10.0 * (1.0 - math.exp(-1.0)))
+
+
+def test_store_shares_windows_and_keeps_them_across_reloads():
+    average = make_control_def("a", AggregateFunc.MOVING_AVERAGE, 60000)
+    same_window = make_control_def("b", AggregateFunc.MOVING_AVERAGE, 60000, threshold_value=20.0)
+    wildcard_max = make_control_def("c", AggregateFunc.MAX, 60000, macs=set())
+    store = SensorWindowStore()
+    store.compile([average, same_window, wildcard_max])
+
+    store.update(1001, 248, 0, 20.0)
+    store.update(1001, 248, 10000, 30.0)
+    # a duplicate is left out
+    store.update(1001, 248, 10000, 90.0)
+    store.update(2002, 248, 0, 40.0)
+    store.update(1001, 531, 0, 40.0)
+    assert store.get_value(1001, 248, average) == 25.0
+    assert store.get_n_windows() == 3
+
+    store.compile([average])
+    assert store.get_value(1001, 248, average) == 25.0
+    assert store.get_value(2002, 248, wildcard_max) is None
+    assert store.get_n_windows() == 1
+
+
+def test_aggregate_func_is_parsed():
+    control_def = {"uuid": "941a5640-82ac-11ee-b962-0242ac120002", "macs": [1001], "sensor_types": [248],
+                   "threshold_value": 25.0, "hysteresis": 1.5, "threshold_type": 1, "threshold_duration_millis": 0,
+                   "control_func": 1, "control_channel": 1, "back_to_normal_func": 0,
+                   "allow_back_to_normal": True, "fuzz_ms": 0}
+    assert ControlDefUtils.parse_control_def(control_def).get_window_spec() == (AggregateFunc.RAW, 0)
+    control_def["aggregate_func"] = 1
+    control_def["aggregate_window_ms"] = 60000
+    assert ControlDefUtils.parse_control_def(control_def).get_window_spec() == (AggregateFunc.MOVING_AVERAGE, 60000)
+
+
+def test_moving_average_ignores_a_spike():
+    relay_controller = MockRelayController()
+    controller = BangBangController(queue.Queue(), threading.Event(), relay_controller=relay_controller,
+                                    control_defs=[make_control_def("a", AggregateFunc.MOVING_AVERAGE, 30000)],
+                                    report_to_api=False, control_state_file="")
+
+    # one reading far over the threshold among readings under it
+    for timestamp, value in enumerate([22.0, 22.0, 30.0, 22.0, 22.0, 22.0]):
+        controller.process_message(SensorMessageItem(1001, 248, value, timestamp * 10000))
+    assert relay_controller.commands == []
+
+    # a sustained rise moves the average over the threshold, and it takes the average back under the
+    # hysteresis point to return to normal
+    for timestamp, value in enumerate([30.0, 30.0, 30.0, 30.0, 20.0, 20.0, 20.0], start=6):
+        controller.process_message(SensorMessageItem(1001, 248, value, timestamp * 10000))
+    assert relay_controller.commands == [(WaveshareDef.CH1, 1), (WaveshareDef.CH1, 0)]
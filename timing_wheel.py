@@ -0,0 +1,152 @@
+from typing import Hashable
+
+
+class HierarchicalTimingWheel:
+    """
+    Keyed timers in a hierarchical timing wheel, for very many timers that are almost always pushed back
+    before they fire (one per sensor, re-armed on every reading)
+
+    Level 0 has 2 ** wheel_bits slots of tick_ms each, every level above has as many slots each spanning a whole
+    turn of the level below. A timer goes into the lowest level whose span reaches its deadline, and when the
+    wheel turns past the start of a higher level slot, that slot's timers cascade down to the levels below.
+    Every slot is a dict, so schedule, re-schedule and cancel are O(1) whatever the number of timers, and advance
+    costs O(1) per tick plus the timers it cascades or fires. Deadlines are kept to tick_ms resolution.
+    """
+
+    def __init__(self, tick_ms: int = 1000, wheel_bits: int = 6, n_levels: int = 4):
+        self._tick_ms = max(tick_ms, 1)
+        self._wheel_bits = wheel_bits
+        self._wheel_mask = (1 << wheel_bits) - 1
+        self._n_levels = n_levels
+        self._wheels: list[list[dict[Hashable, int]]] = [[dict() for _ in range(1 << wheel_bits)]
+                                                          for _ in range(n_levels)]
+        # key -> (level, slot, deadline tick)
+        self._locations: dict[Hashable, tuple[int, int, int]] = dict()
+        # the last tick advance() processed, None until the first schedule or advance
+        self._current_tick = None
+
+    def __len__(self):
+        return len(self._locations)
+
+    def __contains__(self, key: Hashable):
+        return key in self._locations
+
+    def get_keys(self) -> list[Hashable]:
+        return list(self._locations.keys())
+
+    def get_tick_ms(self) -> int:
+        return self._tick_ms
+
+    def start(self, now_ms: int):
+        if self._current_tick is None:
+            self._current_tick = now_ms // self._tick_ms
+
+    def schedule(self, key: Hashable, deadline_ms: int):
+        """
+        Set the key's timer to deadline_ms, replacing the one it had
+        :param key:
+        :param deadline_ms:
+        :return:
+        """
+        self.start(deadline_ms)
+        self.cancel(key)
+        # a deadline that has passed fires on the next tick
+        self.place(key, max(-(-deadline_ms // self._tick_ms), self._current_tick + 1))
+
+    def cancel(self, key: Hashable) -> bool:
+        location = self._locations.pop(key, None)
+        if location is None:
+            return False
+        level, slot, _ = location
+        del self._wheels[level][slot][key]
+        return True
+
+    def place(self, key: Hashable, deadline_tick: int):
+        delta = deadline_tick - self._current_tick
+        level = 0
+        while (level < self._n_levels - 1) and (delta >= (1 << (self._wheel_bits * (level + 1)))):
+            level += 1
+        # a deadline beyond the top level's span lands in a slot that cascades before it is due and is placed again
+        slot = (deadline_tick >> (self._wheel_bits * level)) & self._wheel_mask
+        self._wheels[level][slot][key] = deadline_tick
+        self._locations[key] = (level, slot, deadline_tick)
+
+    def get_next_tick_ms(self) -> int | None:
+        """
+        When advance() next has a tick to process, or None without timers
+        :return:
+        """
+        if (len(self._locations) == 0) or (self._current_tick is None):
+            return None
+        return (self._current_tick + 1) * self._tick_ms
+
+    def advance(self, now_ms: int) -> list[Hashable]:
+        """
+        Turn the wheel up to now_ms
+        :param now_ms:
+        :return: the keys whose timers fired, they are no longer scheduled
+        """
+        now_tick = now_ms // self._tick_ms
+        self.start(now_ms)
+        fired = list()
+
+        if now_tick - self._current_tick > len(self._locations) + (1 << self._wheel_bits):
+            # a jump (e.g. a replay or a suspended host) costs more to tick through than to place every timer again
+            return self.rebuild(now_tick)
+
+        while self._current_tick < now_tick:
+            if len(self._locations) == 0:
+                # nothing to cascade or fire, skip the idle ticks
+                self._current_tick = now_tick
+                break
+
+            self._current_tick += 1
+            tick = self._current_tick
+
+            # cascade the higher level slots that start at this tick, from the top down so a timer can drop
+            # through several levels in one go
+            level = 0
+            while (level < self._n_levels - 1) and ((tick & ((1 << (self._wheel_bits * (level + 1))) - 1)) == 0):
+                level += 1
+            while level > 0:
+                slot = (tick >> (self._wheel_bits * level)) & self._wheel_mask
+                timers = self._wheels[level][slot]
+                if len(timers) > 0:
+                    self._wheels[level][slot] = dict()
+                    for key, deadline_tick in timers.items():
+                        self.place(key, deadline_tick)
+                level -= 1
+
+            slot = tick & self._wheel_mask
+            timers = self._wheels[0][slot]
+            if len(timers) == 0:
+                continue
+            self._wheels[0][slot] = dict()
+            for key, deadline_tick in timers.items():
+                if deadline_tick > tick:
+                    self.place(key, deadline_tick)
+                    continue
+                del self._locations[key]
+                fired.append(key)
+
+        return fired
+
+    def rebuild(self, now_tick: int) -> list[Hashable]:
+        """
+        Move the wheel straight to now_tick
+        :param now_tick:
+        :return: the keys whose timers fired, in deadline order like ticking through would
+        """
+        timers = sorted(((deadline_tick, key) for key, (_, _, deadline_tick) in self._locations.items()),
+                        key=lambda timer: timer[0])
+        self._wheels = [[dict() for _ in range(1 << self._wheel_bits)] for _ in range(self._n_levels)]
+        self._locations = dict()
+        self._current_tick = now_tick
+
+        fired = list()
+        for deadline_tick, key in timers:
+            if deadline_tick <= now_tick:
+                fired.append(key)
+            else:
+                self.place(key, deadline_tick)
+        return fired
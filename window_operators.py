@@ -0,0 +1,272 @@
+"""
+Rolling window operators a control def can compare against its threshold instead of the raw reading, so a
+noisy sensor doesn't have to be tamed with a larger fuzz_ms and hysteresis
+
+Every operator takes the readings of one mac and type in timestamp order and updates its value in O(1)
+per reading (amortized, a reading leaves a window at most once). The windows are ring buffers (bounded deques)
+holding at most max_samples readings, when a sensor reports faster than that the oldest readings drop out of
+the window first, so the memory per window is bounded whatever the window length.
+
+SensorWindowStore keeps the windows per (mac, type), one per distinct (aggregate func, window ms) of the defs
+that match it, so defs sharing a window spec share the window and every reading is pushed into it once.
+"""
+import logging
+import math
+from collections import deque
+
+from control_defs import AggregateFunc, ControlDef
+
+
+class MovingAverageWindow:
+    """
+    Mean of the readings in the last window_ms
+    """
+
+    def __init__(self, window_ms: int, max_samples: int):
+        self._window_ms = window_ms
+        self._max_samples = max_samples
+        self._samples: deque[tuple[int, float]] = deque()
+        self._sum = 0.0
+        self._n_pushed = 0
+
+    def push(self, timestamp: int, value: float):
+        if len(self._samples) == self._max_samples:
+            self._sum -= self._samples.popleft()[1]
+        self._samples.append((timestamp, value))
+        self._sum += value
+
+        cutoff = timestamp - self._window_ms
+        while self._samples[0][0] < cutoff:
+            self._sum -= self._samples.popleft()[1]
+
+        # the running sum picks up rounding error from every add and subtract, resum it every max_samples
+        # readings which keeps it exact at an amortized O(1)
+        self._n_pushed += 1
+        if self._n_pushed >= self._max_samples:
+            self._sum = math.fsum(sample[1] for sample in self._samples)
+            self._n_pushed = 0
+
+    def get_value(self) -> float | None:
+        if len(self._samples) == 0:
+            return None
+        return self._sum / len(self._samples)
+
+
+class ExtremeWindow:
+    """
+    Minimum or maximum of the readings in the last window_ms, kept as a monotonic deque: the candidates for the
+    extreme in timestamp order, each one more extreme than the ones before it, so the extreme is the oldest
+    """
+
+    def __init__(self, window_ms: int, max_samples: int, is_max: bool):
+        self._window_ms = window_ms
+        self._max_samples = max_samples
+        # compare -value for the maximum so both are a minimum
+        self._sign = -1.0 if is_max is True else 1.0
+        self._candidates: deque[tuple[int, float]] = deque()
+        self._timestamps: deque[int] = deque()
+
+    def push(self, timestamp: int, value: float):
+        # the timestamps of the readings in the window, to know when the max_samples bound moves the window start
+        if len(self._timestamps) == self._max_samples:
+            self._timestamps.popleft()
+        self._timestamps.append(timestamp)
+
+        key = self._sign * value
+        # a reading makes every older, less extreme candidate irrelevant, it outlives them
+        while (len(self._candidates) > 0) and (self._sign * self._candidates[-1][1] >= key):
+            self._candidates.pop()
+        self._candidates.append((timestamp, value))
+
+        cutoff = timestamp - self._window_ms
+        while self._timestamps[0] < cutoff:
+            self._timestamps.popleft()
+        while self._candidates[0][0] < self._timestamps[0]:
+            self._candidates.popleft()
+
+    def get_value(self) -> float | None:
+        if len(self._candidates) == 0:
+            return None
+        return self._candidates[0][1]
+
+
+class EwmaWindow:
+    """
+    Exponentially weighted moving average with a time constant of window_ms, the weight of a reading
+    depends on the time since the previous one so irregular reporting intervals are weighted correctly
+    """
+
+    def __init__(self, window_ms: int):
+        self._window_ms = window_ms
+        self._timestamp = None
+        self._value = None
+
+    def push(self, timestamp: int, value: float):
+        if (self._value is None) or (self._window_ms <= 0):
+            self._value = value
+        else:
+            alpha = 1.0 - math.exp(-(timestamp - self._timestamp) / self._window_ms)
+            self._value += alpha * (value - self._value)
+        self._timestamp = timestamp
+
+    def get_value(self) -> float | None:
+        return self._value
+
+
+class RateOfChangeWindow:
+    """
+    Change per minute between the oldest and the newest reading in the last window_ms, None until the
+    window spans some time
+    """
+
+    def __init__(self, window_ms: int, max_samples: int):
+        self._window_ms = window_ms
+        self._samples: deque[tuple[int, float]] = deque(maxlen=max(max_samples, 2))
+
+    def push(self, timestamp: int, value: float):
+        self._samples.append((timestamp, value))
+        cutoff = timestamp - self._window_ms
+        # keep one reading at or before the cutoff so the rate spans the whole window
+        while (len(self._samples) > 2) and (self._samples[1][0] <= cutoff):
+            self._samples.popleft()
+
+    def get_value(self) -> float | None:
+        if len(self._samples) < 2:
+            return None
+        first_timestamp, first_value = self._samples[0]
+        last_timestamp, last_value = self._samples[-1]
+        if last_timestamp == first_timestamp:
+            return None
+        return (last_value - first_value) * 60000.0 / (last_timestamp - first_timestamp)
+
+
+def make_window(aggregate_func: AggregateFunc, window_ms: int, max_samples: int):
+    if aggregate_func is AggregateFunc.MOVING_AVERAGE:
+        return MovingAverageWindow(window_ms, max_samples)
+    elif aggregate_func is AggregateFunc.EWMA:
+        return EwmaWindow(window_ms)
+    elif aggregate_func is AggregateFunc.MIN:
+        return ExtremeWindow(window_ms, max_samples, is_max=False)
+    elif aggregate_func is AggregateFunc.MAX:
+        return ExtremeWindow(window_ms, max_samples, is_max=True)
+    elif aggregate_func is AggregateFunc.RATE_OF_CHANGE:
+        return RateOfChangeWindow(window_ms, max_samples)
+    return None
+
+
+class SensorWindowStore:
+    """
+    The rolling windows of the control defs, per (mac, type)
+
+    compile() the defs whenever they are loaded, update() every reading before evaluating the defs that match it,
+    then get_value() the window of each def that has an aggregate func. Windows whose spec survives a reload keep
+    their readings.
+    """
+
+    def __init__(self, max_samples: int = 1024):
+        self.logger = logging.getLogger(__name__)
+
+        self._max_samples = max(max_samples, 1)
+        # window specs by (mac, sensor type), and by sensor type for the wildcard defs
+        self._exact_specs: dict[tuple[int, int], tuple] = dict()
+        self._wildcard_specs: dict[int, tuple] = dict()
+        # (mac, sensor type) -> (timestamp of the latest reading pushed, {window spec: window})
+        self._windows: dict[tuple[int, int], list] = dict()
+
+    def compile(self, control_defs: list[ControlDef]):
+        """
+        Collect the window specs of the defs, call this whenever the defs are reloaded
+        :param control_defs:
+        :return:
+        """
+        exact: dict[tuple[int, int], set] = dict()
+        wildcard: dict[int, set] = dict()
+
+        for control_def in control_defs:
+            aggregate_func = control_def.get_aggregate_func()
+            if aggregate_func is AggregateFunc.RAW:
+                continue
+            if aggregate_func is None:
+                self.logger.error("Invalid aggregate func for control_def:{}".format(control_def.get_uuid()))
+                continue
+            spec = control_def.get_window_spec()
+            macs = control_def.get_macs()
+            for sensor_type in control_def.get_sensor_types():
+                if len(macs) == 0:
+                    wildcard.setdefault(sensor_type, set()).add(spec)
+                for mac in macs:
+                    exact.setdefault((mac, sensor_type), set()).add(spec)
+
+        for (mac, sensor_type), specs in exact.items():
+            specs.update(wildcard.get(sensor_type, set()))
+
+        self._exact_specs = {key: tuple(specs) for key, specs in exact.items()}
+        self._wildcard_specs = {key: tuple(specs) for key, specs in wildcard.items()}
+
+        # drop the windows no def uses anymore
+        for key, (_, windows) in list(self._windows.items()):
+            specs = self.get_specs(*key)
+            for spec in list(windows.keys()):
+                if spec not in specs:
+                    del windows[spec]
+            if len(windows) == 0:
+                del self._windows[key]
+
+    def get_specs(self, mac: int, sensor_type: int) -> tuple:
+        specs = self._exact_specs.get((mac, sensor_type), None)
+        if specs is None:
+            return self._wildcard_specs.get(sensor_type, ())
+        return specs
+
+    def has_windows(self) -> bool:
+        return (len(self._exact_specs) > 0) or (len(self._wildcard_specs) > 0)
+
+    def update(self, mac: int, sensor_type: int, timestamp: int, value: float):
+        """
+        Push a reading into the windows of its mac and type, a reading that is not newer than the latest one
+        pushed (a duplicate or out of order) is left out
+        :param mac:
+        :param sensor_type:
+        :param timestamp:
+        :param value:
+        :return:
+        """
+        key = (mac, sensor_type)
+        entry = self._windows.get(key, None)
+        if entry is None:
+            specs = self.get_specs(mac, sensor_type)
+            if len(specs) == 0:
+                return
+            entry = [None, dict()]
+            self._windows[key] = entry
+
+        if (entry[0] is not None) and (timestamp <= entry[0]):
+            return
+        entry[0] = timestamp
+
+        windows = entry[1]
+        for spec in self.get_specs(mac, sensor_type):
+            window = windows.get(spec, None)
+            if window is None:
+                window = make_window(spec[0], spec[1], self._max_samples)
+                windows[spec] = window
+            window.push(timestamp, value)
+
+    def get_value(self, mac: int, sensor_type: int, control_def: ControlDef) -> float | None:
+        """
+        The current value of the def's window for the mac and type
+        :param mac:
+        :param sensor_type:
+        :param control_def:
+        :return: None while the window has no value yet (or the def has no valid window)
+        """
+        entry = self._windows.get((mac, sensor_type), None)
+        if entry is None:
+            return None
+        window = entry[1].get(control_def.get_window_spec(), None)
+        if window is None:
+            return None
+        return window.get_value()
+
+    def get_n_windows(self) -> int:
+        return sum(len(windows) for _, windows in self._windows.values())